@@ -0,0 +1,343 @@
+"""
+Benchmarks pigeon end to end against local stand-ins for OSF, DataCite and IA (see `standin`), so
+throughput can be measured without touching a real service:
+
+    python -m benchmarks.run --jobs 20 --output baseline.json
+    python -m benchmarks.run --jobs 20 --compare baseline.json
+
+Archive jobs and then metadata syncs are run through the `Scheduler`, as the web app runs them.
+Reported are jobs per hour, the time jobs spent in each stage (from their `JobProgress`), the peak
+RSS of the pigeon process and the peak disk usage under PIGEON_TEMP_DIR. The stand-in runs in a
+process of its own, so its memory isn't counted.
+
+Pigeon's settings are read from the environment as usual, except for where the services are, so
+settings like ARCHIVE_CONCURRENCY can be varied between runs.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+import statistics
+import multiprocessing
+from dataclasses import asdict
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+
+from benchmarks.standin import StandInConfig, serve
+
+IA_HOSTS = ("archive.org", "s3.us.archive.org")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--jobs", type=int, default=10, help="registrations to archive")
+    parser.add_argument(
+        "--metadata-syncs", type=int, default=50, help="metadata syncs to run after the archives"
+    )
+    parser.add_argument("--pages", type=int, default=StandInConfig.pages)
+    parser.add_argument("--record-size", type=int, default=StandInConfig.record_size)
+    parser.add_argument("--file-count", type=int, default=StandInConfig.file_count)
+    parser.add_argument(
+        "--files-size", type=int, default=StandInConfig.files_size, help="bytes per registration"
+    )
+    parser.add_argument(
+        "--ranges",
+        action="store_true",
+        help="serve byte ranges of archived_files.zip, which the OSF files service doesn't",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=StandInConfig.latency, help="seconds per response"
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=StandInConfig.rate_limit,
+        help="share of OSF API requests answered with a 429",
+    )
+    parser.add_argument("--output", help="write the results here, e.g. as a baseline")
+    parser.add_argument("--compare", help="compare the results with an earlier run's")
+    return parser.parse_args(argv)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stand_in(config):
+    port = free_port()
+    process = multiprocessing.get_context("spawn").Process(
+        target=serve, args=(port, asdict(config)), daemon=True
+    )
+    process.start()
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            if time.monotonic() > deadline or not process.is_alive():
+                process.terminate()
+                raise RuntimeError("The stand-in didn't start")
+            time.sleep(0.1)
+
+
+def configure(base_url, temp_dir, ranges=False):
+    """
+    Points pigeon at the stand-in. Must run before `osf_pigeon` is imported.
+    """
+    os.environ.update(
+        {
+            "OSF_API_URL": f"{base_url}/",
+            "OSF_FILES_URL": f"{base_url}/",
+            "DATACITE_URL": f"{base_url}/datacite/",
+            "DATACITE_PREFIX": "10.0",
+            "DATACITE_USERNAME": "benchmark",
+            "DATACITE_PASSWORD": "benchmark",
+            "DOI_FORMAT": "{prefix}/{guid}",
+            "IA_S3_URL": f"{base_url}/ia/s3.us.archive.org/",
+            "IA_ACCESS_KEY": "benchmark",
+            "IA_SECRET_KEY": "benchmark",
+            "ID_VERSION": "benchmark",
+            "PIGEON_TEMP_DIR": temp_dir,
+            "IA_UPLOAD_STATE_DIR": temp_dir,
+            "JOB_STORE_PATH": os.path.join(temp_dir, "pigeon-jobs.db"),
+            "OSF_DOWNLOAD_RANGES": "true" if ranges else "false",
+        }
+    )
+
+
+class StandInAdapter(requests.adapters.HTTPAdapter):
+    """
+    Sends requests the IA SDK makes to archive.org hosts to the stand-in instead.
+    """
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = urlsplit(base_url)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = urlunsplit(
+            (
+                self.base_url.scheme,
+                self.base_url.netloc,
+                f"/ia/{url.hostname}{url.path}",
+                url.query,
+                url.fragment,
+            )
+        )
+        return super().send(request, **kwargs)
+
+
+def route_ia_to(base_url):
+    from osf_pigeon import pigeon
+
+    create = pigeon.ia_sessions._create
+
+    def create_routed():
+        session = create()
+        for host in IA_HOSTS:
+            session.mount(f"https://{host}", StandInAdapter(base_url))
+        return session
+
+    pigeon.ia_sessions._create = create_routed
+
+
+class DiskSampler:
+    """
+    Samples the bytes used under `path` in a background thread, keeping the peak.
+    """
+
+    def __init__(self, path, interval=0.05):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def usage(self):
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_size
+                except OSError:  # removed while walking
+                    pass
+        return total
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.usage())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_jobs(submit, count):
+    """
+    Submits `count` jobs with `submit(index)` and waits for all of them.
+    :return: how many failed and the seconds they all took
+    """
+    started = time.monotonic()
+    futures = [submit(index) for index in range(count)]
+    failed = 0
+    for future in futures:
+        try:
+            future.result()
+        except Exception:
+            failed += 1
+    return failed, time.monotonic() - started
+
+
+def summarize(jobs, failed, seconds):
+    stage_seconds = {}
+    for job in jobs:
+        for name, value in ((job["progress"] or {}).get("stage_seconds") or {}).items():
+            stage_seconds.setdefault(name, []).append(value)
+    return {
+        "jobs": len(jobs),
+        "failed": failed,
+        "seconds": round(seconds, 3),
+        "jobs_per_hour": round(len(jobs) / seconds * 3600, 1) if seconds else None,
+        "stage_seconds": {
+            name: {
+                "mean": round(statistics.mean(values), 3),
+                "max": round(max(values), 3),
+                "total": round(sum(values), 3),
+            }
+            for name, values in sorted(stage_seconds.items())
+        },
+        "bytes_downloaded": sum((job["progress"] or {}).get("bytes_downloaded", 0) for job in jobs),
+        "bytes_uploaded": sum((job["progress"] or {}).get("bytes_uploaded", 0) for job in jobs),
+        "retries": sum((job["progress"] or {}).get("retries", 0) for job in jobs),
+    }
+
+
+def benchmark(args, config, base_url, temp_dir):
+    configure(base_url, temp_dir, config.ranges)
+    route_ia_to(base_url)
+    from osf_pigeon import settings
+    from osf_pigeon.scheduler import Scheduler
+    from osf_pigeon.store import JobStore, ARCHIVE, METADATA
+
+    # every job gets a registration of its own, so no two submissions are folded into one job
+    guids = [f"bench{index:05d}" for index in range(max(args.jobs, args.metadata_syncs))]
+    store = JobStore(settings.JOB_STORE_PATH)
+    scheduler = Scheduler(store=store, metadata_debounce=0)
+    scheduler.start()
+    try:
+        with DiskSampler(temp_dir) as disk:
+            archive_failed, archive_seconds = run_jobs(
+                lambda index: scheduler.submit_archive(guids[index]), args.jobs
+            )
+            metadata_failed, metadata_seconds = run_jobs(
+                lambda index: scheduler.submit_metadata(guids[index], {"title": "Benchmarked"}),
+                args.metadata_syncs,
+            )
+        finished = [job for guid in guids for job in store.for_guid(guid)]
+    finally:
+        scheduler.stop()
+        store.close()
+
+    stand_in_stats = requests.get(f"{base_url}/stats").json()
+    return {
+        "config": {
+            **asdict(config),
+            "jobs": args.jobs,
+            "metadata_syncs": args.metadata_syncs,
+            "archive_concurrency": scheduler.archive_concurrency,
+            "download_concurrency": scheduler.download_concurrency,
+            "upload_concurrency": scheduler.upload_concurrency,
+            "metadata_concurrency": scheduler.metadata_concurrency,
+        },
+        "archive": summarize(
+            [job for job in finished if job["kind"] == ARCHIVE],
+            archive_failed,
+            archive_seconds,
+        ),
+        "sync_metadata": summarize(
+            [job for job in finished if job["kind"] == METADATA],
+            metadata_failed,
+            metadata_seconds,
+        ),
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "peak_disk_bytes": disk.peak,
+        "stand_in": stand_in_stats,
+    }
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if key in ("config", "stand_in"):
+            continue
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(baseline, results):
+    """
+    :return: a table of every measurement in `results` next to the baseline's
+    """
+    lines = []
+    if baseline["config"] != results["config"]:
+        lines.append("warning: the baseline was run with a different configuration")
+    before, after = flatten(baseline), flatten(results)
+    width = max(map(len, after), default=0)
+    lines.append(f"{'':{width}}  {'baseline':>14}  {'this run':>14}  {'change':>8}")
+    for key, value in after.items():
+        if key not in before:
+            lines.append(f"{key:{width}}  {'':>14}  {value:>14}")
+            continue
+        change = f"{(value - before[key]) / before[key] * 100:+.1f}%" if before[key] else ""
+        lines.append(f"{key:{width}}  {before[key]:>14}  {value:>14}  {change:>8}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = StandInConfig(
+        pages=args.pages,
+        record_size=args.record_size,
+        file_count=args.file_count,
+        files_size=args.files_size,
+        ranges=args.ranges,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+    )
+    process, base_url = start_stand_in(config)
+    try:
+        with tempfile.TemporaryDirectory(prefix="pigeon-benchmark") as temp_dir:
+            results = benchmark(args, config, base_url, temp_dir)
+    finally:
+        process.terminate()
+        process.join()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            print(compare(json.load(fp), results))
+    return 1 if results["archive"]["failed"] or results["sync_metadata"]["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+"""
+A local stand-in for the services pigeon talks to, for benchmarking: the OSF v2 API, the OSF files
+service, DataCite and IA (archive.org's metadata API and its S3 API). It serves plausible
+registrations for any guid, with as many pages, records and bytes as it's configured to, and can
+add latency and answer a share of OSF API requests with a 429.
+
+IA's SDK always talks to archive.org, so IA requests are expected under `/ia/{host}/...`, see
+`run.StandInAdapter`.
+"""
+import re
+import random
+import asyncio
+import hashlib
+from dataclasses import dataclass
+
+from aiohttp import web
+
+BLOCK_SIZE = 1024 * 1024
+
+
+@dataclass
+class StandInConfig:
+    pages: int = 3  # of each of the logs, wikis and contributors
+    per_page: int = 100
+    record_size: int = 512  # bytes of text padding each log and wiki record
+    users: int = 50  # distinct contributors across every registration
+    file_count: int = 10
+    files_size: int = 64 * 1024 * 1024  # bytes in each registration's archived_files.zip
+    ranges: bool = False  # serve byte ranges of archived_files.zip, which the files service can't
+    latency: float = 0.0  # seconds added to every response
+    rate_limit: float = 0.0  # share of OSF API requests answered with a 429
+    retry_after: float = 0.1  # seconds
+
+
+class StandIn:
+    def __init__(self, config):
+        self.config = config
+        self.base_url = None
+        self.requests = 0
+        self.rate_limited = 0
+        self.bytes_received = 0
+        # incompressible, so the files cost what real registration files would to zip
+        self._block = random.Random(0).getrandbits(BLOCK_SIZE * 8).to_bytes(BLOCK_SIZE, "big")
+        self._padding = "lorem ipsum " * (config.record_size // 12 + 1)
+        self._file_hashes = None
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware], client_max_size=1024 ** 3)
+        app.router.add_get("/v2/registrations/{guid}/", self.registration)
+        app.router.add_get("/v2/registrations/{guid}/logs/", self.logs)
+        app.router.add_get("/v2/registrations/{guid}/wikis/", self.wikis)
+        app.router.add_get("/v2/registrations/{guid}/contributors/", self.contributors)
+        app.router.add_get("/v2/registrations/{guid}/institutions/", self.institutions)
+        app.router.add_get("/v2/registrations/{guid}/subjects/", self.subjects)
+        app.router.add_get("/v2/registrations/{guid}/children/", self.children)
+        app.router.add_get("/v2/registrations/{guid}/files/osfstorage/", self.file_listing)
+        app.router.add_get("/v2/users/{user}/institutions/", self.institutions)
+        app.router.add_get("/v1/resources/{guid}/providers/osfstorage/", self.files_zip)
+        app.router.add_get("/v1/resources/{guid}/providers/osfstorage/{file}", self.file)
+        app.router.add_get("/datacite/metadata/{doi:.+}", self.datacite)
+        app.router.add_get("/ia/archive.org/metadata/{identifier}", self.ia_metadata)
+        app.router.add_post("/ia/archive.org/metadata/{identifier}", self.ia_modify_metadata)
+        app.router.add_get("/ia/s3.us.archive.org", self.ia_s3_limit)
+        app.router.add_get("/ia/s3.us.archive.org/", self.ia_s3_limit)
+        app.router.add_put("/ia/s3.us.archive.org/{identifier}/{filename}", self.ia_s3_put)
+        app.router.add_post("/ia/s3.us.archive.org/{identifier}/{filename}", self.ia_s3_post)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests += 1
+        if self.config.latency:
+            await asyncio.sleep(self.config.latency)
+        if request.path.startswith("/v2/") and random.random() < self.config.rate_limit:
+            self.rate_limited += 1
+            return web.json_response(
+                {"errors": [{"detail": "Request was throttled."}]},
+                status=429,
+                headers={"Retry-After": str(self.config.retry_after)},
+            )
+        return await handler(request)
+
+    def url(self, path):
+        return f"{self.base_url}{path}"
+
+    def paginated(self, request, make_record):
+        page = int(request.query.get("page", 1))
+        per_page = self.config.per_page
+        total = self.config.pages * per_page
+        records = [make_record(index) for index in range((page - 1) * per_page, page * per_page)]
+        next_url = None
+        if page < self.config.pages:
+            next_url = self.url(f"{request.path}?page={page + 1}")
+        meta = {"total": total, "per_page": per_page}
+        return web.json_response(
+            {"data": records, "links": {"next": next_url, "meta": meta}, "meta": meta}
+        )
+
+    async def registration(self, request):
+        guid = request.match_info["guid"]
+        return web.json_response(
+            {
+                "data": {
+                    "id": guid,
+                    "type": "registrations",
+                    "attributes": {
+                        "title": f"Benchmark registration {guid}",
+                        "description": self._padding,
+                        "category": "project",
+                        "tags": ["benchmark"],
+                        "date_created": "2020-01-01T00:00:00.000000Z",
+                        "date_modified": "2020-01-02T00:00:00.000000Z",
+                        "article_doi": None,
+                        "withdrawn": False,
+                    },
+                    "relationships": {
+                        "parent": {"data": None},
+                        "registered_from": {"data": {"id": f"{guid}-node"}},
+                        "files": {
+                            "links": {"related": {"meta": {"count": self.config.file_count}}}
+                        },
+                    },
+                    "embeds": {
+                        "license": {"errors": [{"detail": "Not found."}]},
+                        "identifiers": {
+                            "data": [
+                                {"attributes": {"category": "doi", "value": f"10.0/{guid}"}}
+                            ]
+                        },
+                        "provider": {"data": {"id": "osf", "attributes": {"name": "OSF"}}},
+                        "registration_schema": {
+                            "data": {"attributes": {"name": "Open-Ended Registration"}}
+                        },
+                    },
+                    "links": {"html": f"https://osf.io/{guid}/"},
+                }
+            }
+        )
+
+    async def logs(self, request):
+        return self.paginated(
+            request,
+            lambda index: {
+                "id": str(index),
+                "type": "logs",
+                "attributes": {"action": "registration_approved", "params": self._padding},
+            },
+        )
+
+    async def wikis(self, request):
+        return self.paginated(
+            request,
+            lambda index: {
+                "id": str(index),
+                "type": "wikis",
+                "attributes": {"name": f"wiki {index}", "content": self._padding},
+            },
+        )
+
+    async def contributors(self, request):
+        def contributor(index):
+            user = f"user{index % self.config.users}"
+            return {
+                "id": f"{request.match_info['guid']}-{user}",
+                "type": "contributors",
+                "embeds": {
+                    "users": {
+                        "data": {
+                            "id": user,
+                            "attributes": {"full_name": f"Benchmark User {user}"},
+                            "relationships": {
+                                "institutions": {
+                                    "links": {
+                                        "related": {
+                                            "href": self.url(f"/v2/users/{user}/institutions/")
+                                        }
+                                    }
+                                }
+                            },
+                        }
+                    }
+                },
+            }
+
+        return self.paginated(request, contributor)
+
+    async def institutions(self, request):
+        return web.json_response(
+            {"data": [{"id": "cos", "attributes": {"name": "Center for Open Science"}}]}
+        )
+
+    async def subjects(self, request):
+        return web.json_response({"data": [{"id": "psych", "attributes": {"text": "Psychology"}}]})
+
+    async def children(self, request):
+        return web.json_response({"data": []})
+
+    @property
+    def file_size(self):
+        return self.config.files_size // max(self.config.file_count, 1)
+
+    def file_hashes(self):
+        """
+        :return: the hashes of every file served, which are all the same bytes, as OSF has them
+        """
+        if self._file_hashes is None:
+            md5, sha256 = hashlib.md5(), hashlib.sha256()
+            for start in range(0, self.file_size, BLOCK_SIZE):
+                chunk = self._block[: min(self.file_size - start, BLOCK_SIZE)]
+                md5.update(chunk)
+                sha256.update(chunk)
+            self._file_hashes = {"md5": md5.hexdigest(), "sha256": sha256.hexdigest()}
+        return self._file_hashes
+
+    async def file_listing(self, request):
+        guid = request.match_info["guid"]
+        return web.json_response(
+            {
+                "data": [
+                    {
+                        "id": str(index),
+                        "type": "files",
+                        "attributes": {
+                            "kind": "file",
+                            "name": f"file{index}.bin",
+                            "materialized_path": f"/file{index}.bin",
+                            "size": self.file_size,
+                            "extra": {"hashes": self.file_hashes()},
+                        },
+                        "links": {
+                            "download": self.url(
+                                f"/v1/resources/{guid}/providers/osfstorage/{index}"
+                            )
+                        },
+                    }
+                    for index in range(self.config.file_count)
+                ],
+                "links": {"next": None},
+            }
+        )
+
+    async def send_bytes(self, request, size, content_type, ranges=True):
+        """
+        Streams `size` bytes, or the range of them in the `Range` header if `ranges`.
+        """
+        start, end, status, headers = 0, size - 1, 200, {"Content-Type": content_type}
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+        if ranges:
+            headers["Accept-Ranges"] = "bytes"
+        if ranges and match:
+            start, end = int(match.group(1)), min(int(match.group(2) or end), end)
+            status, headers["Content-Range"] = 206, f"bytes {start}-{end}/{size}"
+        resp = web.StreamResponse(status=status, headers=headers)
+        resp.content_length = remaining = end + 1 - start
+        await resp.prepare(request)
+        while remaining and request.method != "HEAD":
+            chunk = self._block[: min(remaining, BLOCK_SIZE)]
+            await resp.write(chunk)
+            remaining -= len(chunk)
+        await resp.write_eof()
+        return resp
+
+    async def files_zip(self, request):
+        return await self.send_bytes(
+            request, self.config.files_size, "application/zip", self.config.ranges
+        )
+
+    async def file(self, request):
+        return await self.send_bytes(request, self.file_size, "application/octet-stream")
+
+    async def datacite(self, request):
+        doi = request.match_info["doi"]
+        return web.Response(
+            text=f'<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<resource xmlns="http://datacite.org/schema/kernel-4">'
+            f'<identifier identifierType="DOI">{doi}</identifier></resource>',
+            content_type="application/xml",
+        )
+
+    async def ia_metadata(self, request):
+        identifier = request.match_info["identifier"]
+        return web.json_response(
+            {
+                "metadata": {"identifier": identifier, "title": "Benchmark registration"},
+                "files": [],
+            }
+        )
+
+    async def ia_modify_metadata(self, request):
+        await request.read()
+        return web.json_response({"success": True})
+
+    async def ia_s3_limit(self, request):
+        return web.json_response({"over_limit": 0})
+
+    async def _drain(self, request):
+        md5 = hashlib.md5()
+        async for chunk in request.content.iter_any():
+            md5.update(chunk)
+            self.bytes_received += len(chunk)
+        return f'"{md5.hexdigest()}"'
+
+    async def ia_s3_put(self, request):
+        etag = await self._drain(request)
+        return web.Response(headers={"ETag": etag})
+
+    async def ia_s3_post(self, request):
+        await self._drain(request)
+        if "uploads" in request.query:
+            return web.Response(
+                text="<InitiateMultipartUploadResult>"
+                f"<UploadId>{random.getrandbits(64):x}</UploadId>"
+                "</InitiateMultipartUploadResult>",
+                content_type="application/xml",
+            )
+        return web.Response(text="<CompleteMultipartUploadResult/>", content_type="application/xml")
+
+    async def stats(self, request):
+        return web.json_response(
+            {
+                "requests": self.requests,
+                "rate_limited": self.rate_limited,
+                "bytes_received": self.bytes_received,
+            }
+        )
+
+
+def serve(port, config):
+    """
+    Runs the stand-in on 127.0.0.1:`port` until the process is stopped.
+    """
+    stand_in = StandIn(StandInConfig(**config))
+    stand_in.base_url = f"http://127.0.0.1:{port}"
+    web.run_app(stand_in.app(), host="127.0.0.1", port=port, print=None, access_log=None)
@@ -2,6 +2,23 @@ import mock
 import pytest
 import responses
 from osf_pigeon import settings
+from osf_pigeon import pigeon
+
+
+@pytest.fixture(autouse=True)
+def clear_reference_cache():
+    pigeon.reference_cache.clear()
+    yield
+    pigeon.reference_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_ia_sessions():
+    pigeon.ia_sessions.clear()
+    pigeon.ia_items.clear()
+    yield
+    pigeon.ia_sessions.clear()
+    pigeon.ia_items.clear()
 
 
 @pytest.fixture
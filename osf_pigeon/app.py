@@ -1,9 +1,11 @@
+import asyncio
 import logging
 import requests
-from osf_pigeon import pigeon
-from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from osf_pigeon.scheduler import Scheduler
 from osf_pigeon import settings
 from aiohttp import web
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 import sentry_sdk
 from sentry_sdk.integrations.aiohttp import AioHttpIntegration
@@ -14,7 +16,6 @@ sentry_sdk.init(
     integrations=[AioHttpIntegration()],
 )
 
-pigeon_jobs = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pigeon_jobs")
 app = web.Application()
 routes = web.RouteTableDef()
 logging.basicConfig(level=logging.DEBUG)
@@ -27,43 +28,143 @@ def handle_exception(future):
         app.logger.exception(exception)
 
 
-def archive_task_done(future):
-    if future.result() and not future.exception():
-        ia_item, guid = future.result()
-        resp = requests.post(
-            f"{settings.OSF_API_URL}_/ia/{guid}/done/",
-            headers={"Authorization": f"Bearer {settings.OSF_BEARER_TOKEN}"},
-            json={"ia_url": ia_item.urls.details},
-        )
-        app.logger.info(f"{ia_item} called back with {resp}")
+def archive_task_done(result):
+    ia_item, guid = result
+    resp = requests.post(
+        f"{settings.OSF_API_URL}_/ia/{guid}/done/",
+        headers={"Authorization": f"Bearer {settings.OSF_BEARER_TOKEN}"},
+        json={"ia_url": ia_item.urls.details},
+    )
+    app.logger.info(f"{ia_item} called back with {resp}")
+    resp.raise_for_status()  # the job isn't done until osf.io knows about it
 
 
-def metadata_task_done(future):
-    if future.result() and not future.exception():
-        ia_item, updated_metadata = future.result()
-        app.logger.info(f"{ia_item} updated metadata {updated_metadata}")
+def metadata_task_done(result):
+    ia_item, updated_metadata = result
+    app.logger.info(f"{ia_item} updated metadata {updated_metadata}")
+
+
+pigeon_jobs = Scheduler(
+    on_archive_done=archive_task_done, on_metadata_done=metadata_task_done
+)
+
+
+async def start_pigeon_jobs(app):
+    pigeon_jobs.start()
+
+
+async def stop_pigeon_jobs(app):
+    pigeon_jobs.stop()
+
+
+app.on_startup.append(start_pigeon_jobs)
+app.on_cleanup.append(stop_pigeon_jobs)
 
 
 @routes.get("/")
 async def index(request):
     return web.json_response({"🐦": "👍"})
 
+
+@routes.get("/metrics")
+async def metrics(request):
+    """
+    Exposes pipeline throughput and latency metrics for Prometheus to scrape.
+    :param request:
+    :return: the metrics in the Prometheus text format
+    """
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+@routes.post("/archive/batch")
+async def archive_batch(request):
+    """
+    This endpoint begins archiving many registrations at once, for backfills. It takes either
+    `{"guids": [...]}` or `{"provider": "<provider id>"}` to archive every registration of a
+    registration provider. Each registration is archived once however often it's listed.
+    :param request:
+    :return: json_response the batch id, to poll `/archive/batch/{batch_id}` with
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="Send a JSON object")
+    guids, provider = body.get("guids"), body.get("provider")
+    if bool(guids) == bool(provider):
+        raise web.HTTPBadRequest(text="Send either a list of `guids` or a `provider`")
+    if guids and not (
+        isinstance(guids, list) and all(isinstance(guid, str) and guid for guid in guids)
+    ):
+        raise web.HTTPBadRequest(text="`guids` must be a list of guids")
+    if provider and not isinstance(provider, str):
+        raise web.HTTPBadRequest(text="`provider` must be a provider id")
+    batch_id = await asyncio.get_event_loop().run_in_executor(
+        None, partial(pigeon_jobs.submit_batch, guids=guids, provider=provider)
+    )
+    return web.json_response({"batch_id": batch_id})
+
+
+@routes.get(r"/archive/batch/{batch_id:\d+}")
+async def archive_batch_progress(request):
+    """
+    Reports a batch's progress: whether all its registrations have been listed yet, how many there
+    are, and how many of their archives are queued, running, done and failed.
+    :param request:
+    :return: json_response the batch
+    """
+    batch = pigeon_jobs.batch(int(request.match_info["batch_id"]))
+    if batch is None:
+        raise web.HTTPNotFound()
+    return web.json_response(batch)
+
+
 @routes.get("/archive/{guid}")
 @routes.post("/archive/{guid}")
 async def archive(request):
     """
     This endpoint is called by osf.io to begin the archive process for a registration, downloading,
-    copying data and uploading it to IA.
+    copying data and uploading it to IA. Registrations already archived are only re-archived if
+    they changed, unless `?force=true` is passed.
     :param request:
     :return: json_response this just sends a simple message showing the request was recieved
     """
     guid = request.match_info["guid"]
-    future = pigeon_jobs.submit(pigeon.run, pigeon.archive(guid))
+    if guid == "batch":  # only POST is routed to `archive_batch`, don't archive a guid "batch"
+        raise web.HTTPMethodNotAllowed(request.method, ["POST"])
+    force = request.query.get("force", "false").lower() == "true"
+    future = pigeon_jobs.submit_archive(guid, force=force)
     future.add_done_callback(handle_exception)
-    future.add_done_callback(archive_task_done)
     return web.json_response({guid: future._state})
 
 
+@routes.get("/jobs")
+async def jobs(request):
+    """
+    Reports every queued and running job: its queue position, or the stage it's in, the wall time
+    spent in each stage so far, bytes transferred and retries.
+    :param request:
+    :return: json_response a list of job statuses, oldest first
+    """
+    # a backfill can queue a lot of jobs, read them off the event loop
+    statuses = await asyncio.get_event_loop().run_in_executor(None, pigeon_jobs.jobs)
+    return web.json_response(statuses)
+
+
+@routes.get("/jobs/{guid}")
+async def guid_jobs(request):
+    """
+    Reports every job run for a registration, including finished ones with their final timings.
+    :param request:
+    :return: json_response a list of job statuses, newest first
+    """
+    statuses = await asyncio.get_event_loop().run_in_executor(
+        None, partial(pigeon_jobs.jobs, request.match_info["guid"])
+    )
+    return web.json_response(statuses)
+
+
 @routes.post("/metadata/{guid}")
 async def set_metadata(request):
     """
@@ -74,7 +175,6 @@ async def set_metadata(request):
     """
     guid = request.match_info["guid"]
     metadata = await request.json()
-    future = pigeon_jobs.submit(pigeon.sync_metadata, guid, metadata)
+    future = pigeon_jobs.submit_metadata(guid, metadata)
     future.add_done_callback(handle_exception)
-    future.add_done_callback(metadata_task_done)
     return web.json_response({guid: future._state})
@@ -0,0 +1,81 @@
+import re
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+# OSF endpoints requests are labelled by, everything else is "other" to keep the label bounded
+OSF_ENDPOINT_KINDS = ("registration", "logs", "wikis", "contributors", "institutions")
+OSF_ENDPOINT = re.compile(r"/v2/(?P<resource>registrations|users)/[^/?]+/(?P<relation>[^/?]*)")
+
+# seconds, bagging and zipping a registration takes anything from a moment to an hour
+PIPELINE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float("inf"))
+# bytes per second
+THROUGHPUT_BUCKETS = tuple(mib * 1024 * 1024 for mib in (1, 5, 10, 25, 50, 100, 250)) + (
+    float("inf"),
+)
+
+OSF_REQUEST_SECONDS = Histogram(
+    "pigeon_osf_request_seconds", "Latency of OSF API requests", ["endpoint"]
+)
+OSF_RATE_LIMITED = Counter(
+    "pigeon_osf_rate_limited", "OSF API responses retried after a 429", ["endpoint"]
+)
+OSF_RETRY_SLEEP_SECONDS = Counter(
+    "pigeon_osf_retry_sleep_seconds", "Time spent backing off before retrying OSF requests"
+)
+OSF_FILES_BYTES = Counter(
+    "pigeon_osf_files_downloaded_bytes", "Bytes of registration files downloaded"
+)
+BAG_SECONDS = Histogram(
+    "pigeon_bag_seconds", "Time taken to bag a registration", buckets=PIPELINE_BUCKETS
+)
+ZIP_SECONDS = Histogram(
+    "pigeon_zip_seconds", "Time taken to zip a registration's bag", buckets=PIPELINE_BUCKETS
+)
+IA_UPLOAD_BYTES = Counter("pigeon_ia_upload_bytes", "Bytes uploaded to IA")
+IA_UPLOAD_SECONDS = Histogram(
+    "pigeon_ia_upload_seconds", "Time taken to upload a bag to IA", buckets=PIPELINE_BUCKETS
+)
+IA_UPLOAD_THROUGHPUT = Histogram(
+    "pigeon_ia_upload_bytes_per_second",
+    "Throughput of each upload to IA",
+    buckets=THROUGHPUT_BUCKETS,
+)
+ARCHIVES = Counter(
+    "pigeon_archives",
+    "Archive jobs by what they did: archived, metadata_synced or skipped as unchanged",
+    ["outcome"],
+)
+JOBS_IN_FLIGHT = Gauge("pigeon_jobs_in_flight", "Jobs running", ["kind"])
+
+
+class QueuedJobs:
+    """
+    Reports pigeon_jobs_queued from the `store` of queued jobs when scraped, so jobs the scheduler
+    hasn't picked up yet, e.g. most of a batch, are counted too.
+    """
+
+    def __init__(self):
+        self.store = None
+
+    def collect(self):
+        gauge = GaugeMetricFamily("pigeon_jobs_queued", "Jobs waiting to start", labels=["kind"])
+        for kind, count in (self.store.queued_counts() if self.store else {}).items():
+            gauge.add_metric([kind], count)
+        yield gauge
+
+
+JOBS_QUEUED = QueuedJobs()
+REGISTRY.register(JOBS_QUEUED)
+
+
+def endpoint_kind(url):
+    """
+    :return: which of the OSF_ENDPOINT_KINDS `url` is a request to, or "other"
+    """
+    match = OSF_ENDPOINT.search(url)
+    if not match:
+        return "other"
+    if not match["relation"]:
+        return "registration" if match["resource"] == "registrations" else "other"
+    return match["relation"] if match["relation"] in OSF_ENDPOINT_KINDS else "other"
@@ -1,62 +1,818 @@
+import io
 import os
 import re
 import math
+import queue
 import json
+import time
+import zlib
+import shutil
+import hashlib
+import logging
+import random
+import threading
+import contextvars
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
 import zipfile
 import bagit
 import asyncio
-from datetime import datetime
+from datetime import date, datetime
 from asyncio import events
-from ratelimit import sleep_and_retry
-from ratelimit.exception import RateLimitException
-from aiohttp import ClientSession, http_exceptions
-
+from functools import partial
+from contextlib import contextmanager, asynccontextmanager
+from xml.etree import ElementTree
+from aiohttp import (
+    ClientSession,
+    TCPConnector,
+    ClientConnectionError,
+    ClientPayloadError,
+    ClientResponseError,
+    http_exceptions,
+)
+
+import requests
 import internetarchive
+from internetarchive.auth import S3Auth
+from internetarchive.iarequest import S3Request
 from datacite import DataCiteMDSClient
 from datacite.errors import DataCiteNotFoundError
 
 from osf_pigeon import settings
+from osf_pigeon import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Blocking work (bagging, zipping, the DataCite and IA SDKs) runs here, never on the event loop.
+# Every running archive may be bagging or zipping, so there's a thread for each on top of the
+# BLOCKING_IO_WORKERS for short calls, which never wait behind them
+blocking_io = ThreadPoolExecutor(
+    max_workers=settings.BLOCKING_IO_WORKERS + settings.ARCHIVE_CONCURRENCY,
+    thread_name_prefix="pigeon_blocking_io",
+)
+# Uploads to IA take hours, so they get threads of their own, one per upload allowed at once
+ia_uploads = ThreadPoolExecutor(
+    max_workers=settings.ARCHIVE_UPLOAD_CONCURRENCY, thread_name_prefix="pigeon_ia_uploads"
+)
+
+
+async def run_in_pool(pool, func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()  # so the thread records into the caller's job
+    return await loop.run_in_executor(pool, partial(context.run, func, *args, **kwargs))
+
+
+async def run_in_thread(func, *args, **kwargs):
+    return await run_in_pool(blocking_io, func, *args, **kwargs)
+
+
+class JobProgress:
+    """
+    What an archive or metadata job is doing: the stage it's in, the wall time spent in each
+    stage, the bytes it has downloaded and uploaded and how many requests it retried. Pipeline
+    code finds the running job's progress through `current_job` rather than having it passed
+    down. Counters are updated from several threads.
+    """
+
+    def __init__(self):
+        self.current_stage = None
+        self.stage_seconds = {}
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self.retries = 0
+        self._stage_started = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        previous_stage, previous_started = self.current_stage, self._stage_started
+        self.current_stage, self._stage_started = name, time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                elapsed = time.monotonic() - self._stage_started
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0) + elapsed
+            self.current_stage, self._stage_started = previous_stage, previous_started
+
+    def add(self, **counts):
+        with self._lock:
+            for counter, value in counts.items():
+                setattr(self, counter, getattr(self, counter) + value)
+
+    def as_dict(self):
+        with self._lock:
+            stage_seconds = dict(self.stage_seconds)
+            if self.current_stage:
+                elapsed = time.monotonic() - self._stage_started
+                stage_seconds[self.current_stage] = (
+                    stage_seconds.get(self.current_stage, 0) + elapsed
+                )
+            return {
+                "stage": self.current_stage,
+                "stage_seconds": {
+                    name: round(seconds, 3) for name, seconds in stage_seconds.items()
+                },
+                "bytes_downloaded": self.bytes_downloaded,
+                "bytes_uploaded": self.bytes_uploaded,
+                "retries": self.retries,
+            }
+
+
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+@contextmanager
+def tracking(progress):
+    """
+    Records everything the pipeline does inside the block into `progress`.
+    """
+    token = current_job.set(progress)
+    try:
+        yield progress
+    finally:
+        current_job.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the block as stage `name` of the current job, if there is one.
+    """
+    job = current_job.get()
+    if job is None:
+        yield
+    else:
+        with job.stage(name):
+            yield
+
+
+def record(**counts):
+    job = current_job.get()
+    if job is not None:
+        job.add(**counts)
+
+
+@asynccontextmanager
+async def limit(limits, name):
+    """
+    Holds a slot of the semaphore `limits[name]` for the block, if the caller limited how many jobs
+    may be in stage `name` at once. Time spent waiting for the slot is its own stage.
+    """
+    semaphore = (limits or {}).get(name)
+    if semaphore is None:
+        yield
+        return
+    with stage(f"{name}_queue"):
+        await semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def create_session():
+    """
+    Creates a pooled ClientSession meant to be shared by every OSF request made during an archive
+    job (or by every job on a worker), so connections, DNS lookups and TLS handshakes are reused.
+    The caller is responsible for closing it.
+    """
+    connector = TCPConnector(
+        limit=settings.OSF_CONNECTION_POOL_SIZE,
+        limit_per_host=settings.OSF_CONNECTION_POOL_SIZE_PER_HOST,
+        keepalive_timeout=settings.OSF_KEEPALIVE_TIMEOUT,
+        use_dns_cache=True,
+        ttl_dns_cache=settings.OSF_DNS_CACHE_TTL,
+    )
+    return ClientSession(connector=connector)
+
+
+@asynccontextmanager
+async def session_or_new(session=None):
+    """
+    Yields the given session untouched, or a fresh pooled session that is closed on exit when none
+    was passed in.
+    """
+    if session is not None:
+        yield session
+    else:
+        async with create_session() as session:
+            yield session
+
 
+class HashingFile:
+    """
+    A file opened for writing through a `BagPayload`. Everything written is hashed on the way to
+    disk, and the digests and size are recorded on the payload when the file is closed cleanly.
+    Accepts both `str` (written as UTF-8) and `bytes`. If `expected` digests are given, the file
+    is checked against them when closed, and raises a BagValidationError if it doesn't match.
+
+    Writes are collected into blocks of PAYLOAD_WRITE_BUFFER_SIZE, and each full block is hashed
+    and written by a thread of the file's own, so files downloaded on the event loop aren't hashed
+    on it. Writing only waits for that thread once PAYLOAD_HASH_QUEUE_SIZE blocks are queued, and
+    flushing or closing the file waits for it to catch up.
+    """
+
+    def __init__(self, path, payload, expected=None):
+        self.path = path
+        self.payload = payload
+        self.expected = expected or {}
+        self.size = 0
+        self._hashers = bagit.get_hashers(sorted({*payload.algorithms, *self.expected}))
+        self._fp = open(path, "wb", buffering=0)
+        self._buffer = bytearray()
+        self._blocks = queue.Queue(settings.PAYLOAD_HASH_QUEUE_SIZE)
+        self._writer = None  # started once the first block fills
+        self._error = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._raise_failure()
+        self._buffer += data
+        self.size += len(data)
+        if len(self._buffer) >= settings.PAYLOAD_WRITE_BUFFER_SIZE:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_blocks, name="pigeon_hashing_file", daemon=True
+                )
+                self._writer.start()
+            block, self._buffer = self._buffer, bytearray()
+            self._blocks.put(block)
+        return len(data)
+
+    def _write_blocks(self):
+        while True:
+            block = self._blocks.get()
+            if block is None:
+                return
+            if self._error is None:  # after a failure, blocks are only taken off the queue
+                try:
+                    self._write_block(block)
+                except BaseException as e:
+                    self._error = e
+
+    def _write_block(self, block):
+        for hasher in self._hashers.values():
+            hasher.update(block)
+        self._fp.write(block)
+
+    def _stop_writer(self):
+        if self._writer is not None:
+            self._blocks.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def _raise_failure(self):
+        if self._error:
+            raise self._error
+
+    def seek(self, offset):
+        # only to where it's written to, the file has to be written in order to be hashed
+        if offset != self.size:
+            raise io.UnsupportedOperation("a HashingFile can only be written in order")
+        return offset
+
+    def flush(self):
+        self._stop_writer()
+        self._raise_failure()
+        self._write_block(self._buffer)
+        self._buffer = bytearray()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._stop_writer()
+            self._fp.close()
+            return
+        self.close()
+        digests = {alg: hasher.hexdigest() for alg, hasher in self._hashers.items()}
+        mismatches = [
+            bagit.ChecksumMismatch(self.path, alg, expected, digests[alg])
+            for alg, expected in self.expected.items()
+            if digests[alg] != expected.lower()
+        ]
+        if mismatches:
+            raise bagit.BagValidationError(f"{self.path} failed validation", mismatches)
+        self.payload.add(
+            self.path, {alg: digests[alg] for alg in self.payload.algorithms}, self.size
+        )
+
+
+class BagPayload:
+    """
+    The payload of a bag being built in `bag_dir/data`. Files written through `open` are hashed as
+    they are written, so `make_bag` can write the manifests without reading the payload back.
+    """
 
-async def stream_files_to_dir(from_url, to_dir, name):
-    async with ClientSession() as session:
+    def __init__(self, bag_dir, algorithms=None):
+        self.bag_dir = bag_dir
+        self.data_dir = os.path.join(bag_dir, "data")
+        self.algorithms = (
+            settings.BAG_CHECKSUM_ALGORITHMS if algorithms is None else algorithms
+        )
+        self.entries = {}  # path relative to bag_dir -> (digests, size)
+
+    def open(self, path, expected=None):
+        return HashingFile(path, self, expected)
+
+    def add(self, path, digests, size):
+        self.entries[os.path.relpath(path, self.bag_dir)] = (digests, size)
+
+
+def open_output_file(to_dir, name, mode="w", payload=None):
+    """
+    Opens `to_dir/name` for writing, through `payload` when given so it's hashed as it's written.
+    """
+    path = os.path.join(to_dir, name)
+    if payload:
+        return payload.open(path)
+    return open(path, mode, buffering=settings.PAYLOAD_WRITE_BUFFER_SIZE)
+
+
+async def stream_files_to_dir(from_url, to_dir, name, session=None, payload=None):
+    async with session_or_new(session) as session:
         async with session.get(from_url) as resp:
-            with open(os.path.join(to_dir, name), "wb") as fp:
+            with open_output_file(to_dir, name, "wb", payload) as fp:
                 async for chunk in resp.content.iter_any():
                     fp.write(chunk)
+                    record(bytes_downloaded=len(chunk))
+                    metrics.OSF_FILES_BYTES.inc(len(chunk))
+                # hash and write what's still buffered off the event loop, closing is quick then
+                await run_in_thread(fp.flush)
+
+
+async def get_range_size(url, session):
+    """
+    :return: the size of the file at `url` if a HEAD request says the server serves byte ranges
+    of it, else None. The files service doesn't for zips it generates as they're downloaded.
+    """
+    async with session.head(url) as resp:
+        if resp.status >= 400 or resp.headers.get("Accept-Ranges") != "bytes":
+            return None
+        try:
+            return int(resp.headers["Content-Length"])
+        except (KeyError, ValueError):
+            return None
+
+
+async def download_range(url, fp, start=0, end=None, session=None):
+    """
+    Writes bytes `start` to `end` (inclusive, or to the end of the file) of `url` at the same
+    offsets of the open file `fp`. A download that breaks off, fails with a server error or is
+    rate limited is retried, up to OSF_MAX_RETRIES times, with a `Range` request for the bytes
+    that are left, so it resumes from the last byte written. If the server ignores the `Range`,
+    what has already been written is skipped.
+    """
+    async with session_or_new(session) as session:
+        position = start
+        attempt = 0
+        while True:
+            headers = {}
+            if position or end is not None:
+                headers["Range"] = f"bytes={position}-{'' if end is None else end}"
+            delay = None
+            try:
+                async with session.get(url, headers=headers) as resp:
+                    if resp.status == 429 and attempt < settings.OSF_MAX_RETRIES:
+                        delay = get_retry_delay(resp, attempt)
+                        metrics.OSF_RATE_LIMITED.labels(metrics.endpoint_kind(url)).inc()
+                    else:
+                        resp.raise_for_status()
+                        offset = position if resp.status == 206 else 0  # where the body starts
+                        fp.seek(position)
+                        async for chunk in resp.content.iter_any():
+                            record(bytes_downloaded=len(chunk))
+                            metrics.OSF_FILES_BYTES.inc(len(chunk))
+                            chunk_start, offset = offset, offset + len(chunk)
+                            stop = None if end is None else end + 1 - chunk_start
+                            chunk = chunk[position - chunk_start:stop]
+                            fp.write(chunk)
+                            position += len(chunk)
+                            if end is not None and position > end:
+                                break
+                if delay is None:
+                    if end is not None and position <= end:
+                        raise ClientPayloadError(f"{url} ended at byte {position} of {end + 1}")
+                    return
+            except (
+                ClientPayloadError,
+                ClientConnectionError,
+                ClientResponseError,
+                asyncio.TimeoutError,
+            ) as e:
+                if isinstance(e, ClientResponseError) and e.status < 500:
+                    raise
+                if attempt == settings.OSF_MAX_RETRIES:
+                    raise
+                logger.info(f"Resuming {url} from byte {position} after {e!r}")
+                delay = get_backoff(attempt)
+            metrics.OSF_RETRY_SLEEP_SECONDS.inc(delay)
+            record(retries=1)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def download_segments(url, path, size, session=None):
+    """
+    Downloads the `size` bytes at `url` into a file preallocated at `path`, in up to
+    OSF_DOWNLOAD_SEGMENTS byte ranges at once, each at least OSF_DOWNLOAD_SEGMENT_SIZE.
+    """
+    with open(path, "wb") as fp:
+        if hasattr(os, "posix_fallocate") and size:
+            os.posix_fallocate(fp.fileno(), 0, size)
+        else:
+            fp.truncate(size)
+    segment_size = max(
+        settings.OSF_DOWNLOAD_SEGMENT_SIZE, math.ceil(size / settings.OSF_DOWNLOAD_SEGMENTS)
+    )
+
+    async def download_segment(start):
+        with open(path, "r+b", buffering=settings.PAYLOAD_WRITE_BUFFER_SIZE) as fp:
+            await download_range(url, fp, start, min(start + segment_size, size) - 1, session)
+
+    await asyncio.gather(*map(download_segment, range(0, size, segment_size)))
+
+
+def zip_files(entries, fp):
+    """
+    Zips the files `entries` lists as (path, name in the zip) into `fp`, removing each once it's
+    in, and compressing each according to `get_compress_type`.
+    """
+    with zipfile.ZipFile(fp, "w") as zip_file:
+        for path, name in entries:
+            zip_file.write(path, arcname=name, compress_type=get_compress_type(name))
+            os.remove(path)
+
+
+async def download_files_as_zip(guid, to_dir, name, session=None, payload=None):
+    """
+    Builds `to_dir/name` like the files service's zip of the registration's osfstorage, from its
+    files downloaded one by one, OSF_DOWNLOAD_CONCURRENCY at once, each checked against the hashes
+    OSF has for it like `download_file` does.
+    """
+    async with session_or_new(session) as session:
+        files = [file async for file in walk_files(guid, session=session)]
+        slots = asyncio.Semaphore(settings.OSF_DOWNLOAD_CONCURRENCY)
+        with tempfile.TemporaryDirectory(dir=settings.PIGEON_TEMP_DIR) as staging_dir:
+            # only the zip goes into the bag, so staged files are hashed just to be checked
+            staging = BagPayload(staging_dir, algorithms=())
+
+            async def stage_file(file):
+                name = file["attributes"]["materialized_path"].lstrip("/")
+                async with slots:
+                    await download_file(file, staging_dir, staging, session=session)
+                return os.path.join(staging_dir, name), name
+
+            entries = await asyncio.gather(*map(stage_file, files))
+            with open_output_file(to_dir, name, "wb", payload) as fp:
+                await run_in_thread(zip_files, entries, fp)
+                await run_in_thread(fp.flush)
+
+
+async def download_archived_files(guid, to_dir, name, session=None, payload=None):
+    """
+    Downloads the zip of the registration's osfstorage to `to_dir/name`: in parallel byte ranges
+    if OSF_DOWNLOAD_RANGES and the files service serves ranges of it (read back to be hashed when
+    bagged, since it isn't written in order), otherwise file by file if
+    OSF_DOWNLOAD_PER_FILE_FALLBACK, otherwise as one stream.
+    """
+    url = f"{settings.OSF_FILES_URL}v1/resources/{guid}/providers/osfstorage/?zip="
+    async with session_or_new(session) as session:
+        size = await get_range_size(url, session) if settings.OSF_DOWNLOAD_RANGES else None
+        if size is not None:
+            await download_segments(url, os.path.join(to_dir, name), size, session=session)
+        elif settings.OSF_DOWNLOAD_PER_FILE_FALLBACK:
+            await download_files_as_zip(guid, to_dir, name, session=session, payload=payload)
+        else:
+            await stream_files_to_dir(url, to_dir, name, session=session, payload=payload)
+
+
+def get_file_hashes(file):
+    """
+    :return: the digests OSF has for the file record `file`, of the algorithms hashlib has
+    """
+    hashes = (file["attributes"].get("extra") or {}).get("hashes") or {}
+    return {
+        alg: digest
+        for alg, digest in hashes.items()
+        if digest and alg in hashlib.algorithms_guaranteed
+    }
+
+
+async def download_file(file, to_dir, payload, session=None):
+    """
+    Downloads the file record `file` to its path under `to_dir`, through `payload`, checked
+    against the hashes OSF has for it as it arrives. A download that breaks off resumes, and one
+    that doesn't match its hashes is downloaded again, up to OSF_MAX_RETRIES times.
+    """
+    path = os.path.normpath(
+        os.path.join(to_dir, file["attributes"]["materialized_path"].lstrip("/"))
+    )
+    if os.path.commonpath([to_dir, path]) != os.path.normpath(to_dir):
+        raise ValueError(f"{path} is outside of {to_dir}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    size = file["attributes"]["size"]
+    attempt = 0
+    while True:
+        try:
+            with payload.open(path, get_file_hashes(file)) as fp:
+                await download_range(
+                    file["links"]["download"],
+                    fp,
+                    end=size - 1 if size else None,
+                    session=session,
+                )
+                await run_in_thread(fp.flush)
+            return
+        except bagit.BagValidationError as e:
+            if attempt == settings.OSF_MAX_RETRIES:
+                raise
+            logger.warning(f"Downloading {path} again after {e}")
+        record(retries=1)
+        attempt += 1
+
+
+async def download_files_to_dir(guid, to_dir, payload, session=None):
+    """
+    Downloads every file in the registration's osfstorage to its path under `to_dir`,
+    OSF_DOWNLOAD_CONCURRENCY at once, so each gets its own manifest entries in the bag. Only
+    files that fail are retried, and the first failure is raised once every file is done.
+    """
+    async with session_or_new(session) as session:
+        slots = asyncio.Semaphore(settings.OSF_DOWNLOAD_CONCURRENCY)
+
+        async def download(file):
+            async with slots:
+                await download_file(file, to_dir, payload, session=session)
+
+        tasks = []
+        try:  # files are downloaded as the listing is walked
+            async for file in walk_files(guid, session=session):
+                tasks.append(asyncio.ensure_future(download(file)))
+        finally:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+
+async def dump_json_to_dir(
+    from_url, to_dir, name, parse_json=None, session=None, payload=None
+):
+    """
+    Writes the data at `from_url` to `to_dir/name`. Paginated lists are streamed to disk page by
+    page as they arrive and come out byte for byte as `json.dump` of the joined list would.
+    """
+    async with session_or_new(session) as session:
+        throttle = Throttle(settings.OSF_MAX_PAGES_IN_FLIGHT)
+        data, is_paginated = await get_first_page(from_url, parse_json, session, throttle)
+
+        with open_output_file(to_dir, name, payload=payload) as fp:
+            if not is_paginated:
+                json.dump(data, fp)
+                return
+
+            fp.write("[")
+            separator = ""
+            async for page in iter_pages(from_url, data, parse_json, session, throttle):
+                for record in page:
+                    fp.write(separator + json.dumps(record))
+                    separator = ", "
+            fp.write("]")
+            await run_in_thread(fp.flush)
+
+
+def hash_file(path, algorithms):
+    """
+    :return: the (digests, size) of the file at `path`
+    """
+    hashers = bagit.get_hashers(algorithms)
+    size = 0
+    with open(path, "rb") as fp:
+        for block in iter(partial(fp.read, settings.BAG_HASH_BLOCK_SIZE), b""):
+            size += len(block)
+            for hasher in hashers.values():
+                hasher.update(block)
+    return {alg: hasher.hexdigest() for alg, hasher in hashers.items()}, size
 
 
-async def dump_json_to_dir(from_url, to_dir, name, parse_json=None):
-    pages = await get_paginated_data(from_url, parse_json)
-    with open(os.path.join(to_dir, name), "w") as fp:
-        json.dump(pages, fp)
+def hash_files(paths, algorithms):
+    """
+    Hashes `paths` in parallel across BAG_HASH_WORKERS threads, hashlib releases the GIL while it
+    works on large blocks.
+    :return: a dict of path -> (digests, size)
+    """
+    with ThreadPoolExecutor(
+        max_workers=settings.BAG_HASH_WORKERS, thread_name_prefix="pigeon_hash"
+    ) as pool:
+        return dict(zip(paths, pool.map(partial(hash_file, algorithms=algorithms), paths)))
+
+
+def validate_bag(bag):
+    """
+    Fully validates `bag` by rehashing every payload and tag file in parallel and comparing the
+    digests against its manifests.
+    """
+    bag.validate(completeness_only=True)
+    paths = {os.path.join(bag.path, rel_path): rel_path for rel_path in bag.entries}
+    mismatches = [
+        bagit.ChecksumMismatch(paths[path], alg, expected, digests[alg])
+        for path, (digests, _) in hash_files(list(paths), bag.algorithms).items()
+        for alg, expected in bag.entries[paths[path]].items()
+        if alg in digests and digests[alg] != expected
+    ]
+    if mismatches:
+        raise bagit.BagValidationError("Bag validation failed", mismatches)
+
+
+def make_bag(bag_dir, payload=None):
+    """
+    Turns `bag_dir`, whose payload has already been written to `bag_dir/data`, into a bag whose
+    tag files are byte for byte what `bagit.make_bag` writes. Digests `payload` recorded while the
+    files were written are used as they are, only files written some other way are read back to be
+    hashed. Unlike `bagit.make_bag` this never changes the working directory, so bags can be made
+    in several threads at once.
+
+    The bag is checked for completeness (Payload-Oxum and every manifest entry present) rather than
+    rehashed, since its digests were computed from the bytes written, unless BAG_FULL_VALIDATION is
+    set.
+    """
+    payload = payload or BagPayload(bag_dir)
+    manifest = [os.path.relpath(path, bag_dir) for path in bagit._walk(payload.data_dir)]
+    unhashed = [
+        os.path.join(bag_dir, rel_path)
+        for rel_path in manifest
+        if rel_path not in payload.entries
+    ]
+    for path, (digests, size) in hash_files(unhashed, payload.algorithms).items():
+        payload.add(path, digests, size)
+
+    for alg in payload.algorithms:
+        with open(os.path.join(bag_dir, f"manifest-{alg}.txt"), "w", encoding="utf-8") as fp:
+            for rel_path in manifest:
+                digests, _ = payload.entries[rel_path]
+                fp.write("%s  %s\n" % (digests[alg], bagit._encode_filename(rel_path)))
+
+    with open(os.path.join(bag_dir, "bagit.txt"), "w", encoding="utf-8") as fp:
+        fp.write("BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n")
+
+    total_bytes = sum(payload.entries[rel_path][1] for rel_path in manifest)
+    bagit._make_tag_file(
+        os.path.join(bag_dir, "bag-info.txt"),
+        {
+            "Bagging-Date": date.strftime(date.today(), "%Y-%m-%d"),
+            "Bag-Software-Agent": f"bagit.py v{bagit.VERSION} <{bagit.PROJECT_URL}>",
+            "Payload-Oxum": f"{total_bytes}.{len(manifest)}",
+        },
+    )
+
+    tag_files = sorted(
+        name
+        for name in os.listdir(bag_dir)
+        if os.path.isfile(os.path.join(bag_dir, name)) and not name.startswith("tagmanifest-")
+    )
+    for alg in payload.algorithms:
+        with open(os.path.join(bag_dir, f"tagmanifest-{alg}.txt"), "w", encoding="utf-8") as fp:
+            for name in tag_files:
+                digests, _ = hash_file(os.path.join(bag_dir, name), [alg])
+                fp.write("%s %s\n" % (digests[alg], name))
+
+    bag = bagit.Bag(bag_dir)
+    if settings.BAG_FULL_VALIDATION:
+        validate_bag(bag)
+    else:
+        bag.validate(completeness_only=True)
+    return bag
+
+
+def get_compress_type(name):
+    """
+    :return: how the zip entry `name` is compressed: deflated if it's one of
+    ZIP_DEFLATE_EXTENSIONS (the JSON, XML and tag files compress well), otherwise stored, since
+    registration files like `archived_files.zip` are mostly compressed already.
+    """
+    extension = os.path.splitext(name)[1].lower()
+    if extension in settings.ZIP_DEFLATE_EXTENSIONS:
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
 
-    return pages
 
+def deflate_file(path, arcname, spool_dir):
+    """
+    Deflates the file at `path` as zipfile would for a ZIP_DEFLATED entry, but into a spooled
+    temporary file, so files can be deflated in several threads at once (zlib releases the GIL) and
+    written to the zip afterwards with `write_deflated`.
+    :return: the entry's ZipInfo, with its CRC and sizes, and its deflated data
+    """
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    compressor = zlib.compressobj(settings.ZIP_COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+    data = tempfile.SpooledTemporaryFile(settings.ZIP_SPOOL_SIZE, dir=spool_dir)
+    crc = size = 0
+    with open(path, "rb") as fp:
+        for block in iter(partial(fp.read, settings.BAG_HASH_BLOCK_SIZE), b""):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            data.write(compressor.compress(block))
+    data.write(compressor.flush())
+    zinfo.CRC, zinfo.file_size, zinfo.compress_size = crc, size, data.tell()
+    data.seek(0)
+    return zinfo, data
+
+
+def write_deflated(zip_file, zinfo, data):
+    """
+    Appends an entry deflated by `deflate_file` to `zip_file`, with ZIP64 extensions if it needs
+    them. zipfile has no API for writing compressed data as it is, so this does what
+    `ZipFile.write` does around compressing. The CRC and sizes are known up front, so the entry
+    needs no data descriptor even when the zip is written to a stream.
+    """
+    with zip_file._lock:
+        if zip_file._seekable:
+            zip_file.fp.seek(zip_file.start_dir)
+        zinfo.header_offset = zip_file.fp.tell()
+        zip_file._writecheck(zinfo)
+        zip_file._didModify = True
+        zip_file.fp.write(zinfo.FileHeader())
+        shutil.copyfileobj(data, zip_file.fp, settings.BAG_HASH_BLOCK_SIZE)
+        zip_file.filelist.append(zinfo)
+        zip_file.NameToInfo[zinfo.filename] = zinfo
+        zip_file.start_dir = zip_file.fp.tell()
+
+
+def create_zip(temp_dir, fp=None):
+    """
+    Zips the bag in `temp_dir/bag` into `temp_dir/bag.zip`, or into the file object `fp`, which
+    needn't be seekable, compressing each entry according to `get_compress_type`. Entries to
+    deflate are deflated across ZIP_WORKERS threads while stored entries are copied in, at most
+    2 * ZIP_WORKERS ahead of the one being written, so only that many are held at once, and
+    everything is written in the order the bag is walked. Entries and zips bigger than 4 GiB get
+    ZIP64 extensions.
+    """
+    entries = [
+        (os.path.join(root, file), re.sub(f"^{temp_dir}", "", os.path.join(root, file)))
+        for root, dirs, files in os.walk(os.path.join(temp_dir, "bag"))
+        for file in files
+    ]
+    to_deflate = iter(
+        [entry for entry in entries if get_compress_type(entry[1]) == zipfile.ZIP_DEFLATED]
+    )
+    deflated = collections.OrderedDict()  # path -> future, in the order they're written
+    with ThreadPoolExecutor(
+        max_workers=settings.ZIP_WORKERS, thread_name_prefix="pigeon_zip"
+    ) as pool:
+
+        def deflate_ahead():
+            while len(deflated) < 2 * settings.ZIP_WORKERS:
+                file_path, file_name = next(to_deflate, (None, None))
+                if file_path is None:
+                    return
+                deflated[file_path] = pool.submit(deflate_file, file_path, file_name, temp_dir)
 
-def create_zip(temp_dir):
-    with zipfile.ZipFile(os.path.join(temp_dir, "bag.zip"), "w") as fp:
-        for root, dirs, files in os.walk(os.path.join(temp_dir, "bag")):
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_name = re.sub(f"^{temp_dir}", "", file_path)
-                fp.write(file_path, arcname=file_name)
+        try:
+            deflate_ahead()
+            with zipfile.ZipFile(fp or os.path.join(temp_dir, "bag.zip"), "w") as zip_file:
+                for file_path, file_name in entries:
+                    if get_compress_type(file_name) != zipfile.ZIP_DEFLATED:
+                        zip_file.write(
+                            file_path, arcname=file_name, compress_type=zipfile.ZIP_STORED
+                        )
+                        continue
+                    zinfo, data = deflated.pop(file_path).result()
+                    deflate_ahead()
+                    with data:
+                        write_deflated(zip_file, zinfo, data)
+        finally:
+            for future in deflated.values():  # close any not written, e.g. after a failure
+                if not future.cancel() and not future.exception():
+                    future.result()[1].close()
 
 
-async def get_relationship_attribute(key, url, func):
-    data = await get_paginated_data(url)
+async def get_relationship_attribute(key, url, func, session=None):
+    data = await get_paginated_data(url, session=session)
     if "data" in data:
         return {key: list(map(func, data["data"]))}
     return {key: list(map(func, data))}
 
 
-async def get_metadata_for_ia_item(json_metadata):
+async def get_metadata_for_ia_item(json_metadata, session=None):
     """
     This is meant to take the response JSON metadata and format it for IA buckets, this is not
     used to generate JSON to be uploaded as raw data into the buckets.
     :param json_metadata: metadata from OSF registration view contains attributes and relationship
     urls.
+    :param session: an optional shared ClientSession used for the relationship requests.
 
     Note: Internet Archive advises that all metadata that points to internal OSF features should
     have a specific `osf_` prefix. Example: `registry` should be `osf_registry`, however metadata
@@ -82,38 +838,43 @@ async def get_metadata_for_ia_item(json_metadata):
         - affiliated_institutions
         - license
     """
-    relationship_data = [
-        get_relationship_attribute(
-            "creator",
-            f'{settings.OSF_API_URL}v2/registrations/{json_metadata["data"]["id"]}/contributors/'
-            f"?filter[bibliographic]=true&",
-            lambda contrib: contrib["embeds"]["users"]["data"]["attributes"][
-                "full_name"
-            ],
-        ),
-        get_relationship_attribute(
-            "affiliated_institutions",
-            f'{settings.OSF_API_URL}v2/registrations/{json_metadata["data"]["id"]}/institutions/',
-            lambda institution: institution["attributes"]["name"],
-        ),
-        get_relationship_attribute(
-            "osf_subjects",
-            f'{settings.OSF_API_URL}v2/registrations/{json_metadata["data"]["id"]}/subjects/',
-            lambda subject: subject["attributes"]["text"],
-        ),
-        get_relationship_attribute(
-            "children",
-            f'{settings.OSF_API_URL}v2/registrations/{json_metadata["data"]["id"]}/children/',
-            lambda child: f"https://archive.org/details/"
-            f'{settings.REG_ID_TEMPLATE.format(guid=child["id"])}',
-        ),
-    ]
+    registration_url = f'{settings.OSF_API_URL}v2/registrations/{json_metadata["data"]["id"]}/'
+    async with session_or_new(session) as session:
+        relationship_data = [
+            get_relationship_attribute(
+                "creator",
+                f"{registration_url}contributors/?filter[bibliographic]=true&",
+                lambda contrib: contrib["embeds"]["users"]["data"]["attributes"][
+                    "full_name"
+                ],
+                session=session,
+            ),
+            get_relationship_attribute(
+                "affiliated_institutions",
+                f"{registration_url}institutions/",
+                lambda institution: institution["attributes"]["name"],
+                session=session,
+            ),
+            get_relationship_attribute(
+                "osf_subjects",
+                f"{registration_url}subjects/",
+                lambda subject: subject["attributes"]["text"],
+                session=session,
+            ),
+            get_relationship_attribute(
+                "children",
+                f"{registration_url}children/",
+                lambda child: f"https://archive.org/details/"
+                f'{settings.REG_ID_TEMPLATE.format(guid=child["id"])}',
+                session=session,
+            ),
+        ]
 
-    relationship_data = {
-        k: v
-        for pair in await asyncio.gather(*relationship_data)
-        for k, v in pair.items()
-    }  # merge all the pairs
+        relationship_data = {
+            k: v
+            for pair in await asyncio.gather(*relationship_data)
+            for k, v in pair.items()
+        }  # merge all the pairs
 
     parent = json_metadata["data"]["relationships"]["parent"]["data"]
     if parent:
@@ -184,7 +945,7 @@ async def write_datacite_metadata(guid, temp_dir, metadata):
         prefix=settings.DATACITE_PREFIX,
     )
     try:
-        xml_metadata = client.metadata_get(doi)
+        xml_metadata = await run_in_thread(client.metadata_get, doi)
     except DataCiteNotFoundError:
         raise DataCiteNotFoundError(
             f"Datacite DOI {doi} not found for registration {guid} on Datacite server."
@@ -196,95 +957,419 @@ async def write_datacite_metadata(guid, temp_dir, metadata):
     return xml_metadata
 
 
-@sleep_and_retry
-async def get_with_retry(url, retry_on=(), sleep_period=None, headers=None):
+class Throttle:
+    """
+    Shared backoff for a group of requests to the same API, e.g. all the pages of one pagination.
+    At most `max_in_flight` requests hold a slot at once, and once any of them is told to back off
+    (a 429 with `Retry-After`) none of them send another request until that time has passed, so a
+    burst of 429s doesn't turn into a thundering herd of retries.
+    """
+
+    def __init__(self, max_in_flight):
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._resume_at = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._slots:
+            yield
+
+    async def wait(self):
+        loop = asyncio.get_event_loop()
+        while self._resume_at > loop.time():
+            await asyncio.sleep(self._resume_at - loop.time())
+
+    def back_off(self, delay):
+        loop = asyncio.get_event_loop()
+        self._resume_at = max(self._resume_at, loop.time() + delay)
+
+
+class ReferenceCache:
+    """
+    A size bounded LRU cache with a TTL for OSF reference data that is the same for many
+    registrations, like a contributor's institutions. Concurrent misses for the same key on one
+    event loop share a single in-flight request. `hits`, `misses` and `coalesced` count lookups.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = collections.OrderedDict()  # key -> (expires_at, value)
+        self._in_flight = {}  # (loop, key) -> task
+        self._lock = threading.Lock()
+
+    async def get(self, key, fetch):
+        """
+        :param fetch: a coroutine function called to fetch the value on a miss.
+        """
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            expires_at, value = self._entries.get(key, (0, None))
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+            task = self._in_flight.get((loop, key))
+            if task:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                task = asyncio.ensure_future(fetch())
+                self._in_flight[loop, key] = task
+                task.add_done_callback(partial(self._store, loop, key))
+
+        # shielded so one cancelled caller doesn't cancel the request for everyone sharing it
+        return await asyncio.shield(task)
+
+    def _store(self, loop, key, task):
+        with self._lock:
+            del self._in_flight[loop, key]
+            if task.cancelled() or task.exception():
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, task.result())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.coalesced = 0
+
+
+reference_cache = ReferenceCache(
+    settings.REFERENCE_CACHE_SIZE, settings.REFERENCE_CACHE_TTL
+)
+
+
+async def get_reference_data(url, session=None, throttle=None):
+    """
+    `get_with_retry` through the `reference_cache`, keyed by URL and the auth context it was
+    requested with.
+    """
+    return await reference_cache.get(
+        (url, settings.OSF_BEARER_TOKEN),
+        partial(get_with_retry, url, retry_on=(429,), session=session, throttle=throttle),
+    )
+
+
+def get_retry_delay(resp, attempt, sleep_period=None):
+    """
+    How long to wait before retrying `resp`: an explicit `sleep_period`, else the server's
+    `Retry-After` (in seconds), else jittered exponential backoff.
+    """
+    if sleep_period:
+        return sleep_period
+    try:
+        return float(resp.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return get_backoff(attempt)
+
+
+def get_backoff(attempt):
+    """
+    :return: the jittered exponential backoff before retry `attempt`, in seconds
+    """
+    backoff = min(settings.OSF_RETRY_BACKOFF * 2 ** attempt, settings.OSF_RETRY_MAX_BACKOFF)
+    return backoff + random.uniform(0, settings.OSF_RETRY_BACKOFF)
+
+
+async def get_with_retry(
+    url, retry_on=(), sleep_period=None, headers=None, session=None, throttle=None
+):
     if not headers:
         headers = {}
 
     if settings.OSF_BEARER_TOKEN:
         headers["Authorization"] = f"Bearer {settings.OSF_BEARER_TOKEN}"
 
-    async with ClientSession() as session:
-        async with session.get(url, headers=headers) as resp:
-            if resp.status in retry_on:
-                raise RateLimitException(
-                    message="Too many requests, sleeping.",
-                    period_remaining=sleep_period
-                    or int(resp.headers.get("Retry-After") or 0),
-                )  # This will be caught by @sleep_and_retry and retried
-            resp.raise_for_status()
-            return await resp.json()
-
-
-async def get_pages(url, page, result={}, parse_json=None):
-    url = f"{url}?page={page}&page={page}"
-    data = await get_with_retry(url, retry_on=(429,))
-
-    result[page] = data["data"]
+    endpoint = metrics.endpoint_kind(url)
+    async with session_or_new(session) as session:
+        attempt = 0
+        while True:
+            if throttle:
+                await throttle.wait()
+            started = time.monotonic()
+            async with session.get(url, headers=headers) as resp:
+                if resp.status in retry_on and attempt < settings.OSF_MAX_RETRIES:
+                    delay = get_retry_delay(resp, attempt, sleep_period)
+                else:
+                    resp.raise_for_status()
+                    record(bytes_downloaded=len(await resp.read()))
+                    metrics.OSF_REQUEST_SECONDS.labels(endpoint).observe(
+                        time.monotonic() - started
+                    )
+                    return await resp.json()
+            metrics.OSF_REQUEST_SECONDS.labels(endpoint).observe(time.monotonic() - started)
+            if resp.status == 429:
+                metrics.OSF_RATE_LIMITED.labels(endpoint).inc()
+            metrics.OSF_RETRY_SLEEP_SECONDS.inc(delay)
+            record(retries=1)
+            if throttle:
+                throttle.back_off(delay)
+            else:
+                await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def get_pages(url, page, parse_json=None, session=None, throttle=None):
+    """
+    :return: the records on page `page` of `url`. Nothing is shared between calls, so any number of
+    paginations can run at once on one event loop.
+    """
+    url = f"{url}{'&' if '?' in url else '?'}page={page}&page={page}"
+    throttle = throttle or Throttle(1)
+    async with throttle.slot():
+        data = await get_with_retry(
+            url, retry_on=(429,), session=session, throttle=throttle
+        )
 
-    if parse_json:
-        result[page] = parse_json(data)["data"]
+        if parse_json:
+            data = await parse_json(data)
 
-    return result
+    return data["data"]
 
 
-async def get_additional_contributor_info(response):
-    contributor_data_list = []
-    for contributor in response["data"]:
-        contributor_data = {}
-        embed_data = contributor["embeds"]["users"]["data"]
-        institution_url = embed_data["relationships"]["institutions"]["links"][
+async def get_additional_contributor_info(response, session=None):
+    """
+    Adds each contributor's `affiliated_institutions` to a page of contributors. The lookups run
+    concurrently, at most OSF_INSTITUTION_LOOKUP_CONCURRENCY at once, and a user listed more than
+    once is only looked up once. Contributor order is kept.
+    """
+    institution_urls = [
+        contributor["embeds"]["users"]["data"]["relationships"]["institutions"]["links"][
             "related"
         ]["href"]
-        data = await get_with_retry(institution_url)
-        institution_data = data["data"]
-        institution_list = [
-            institution["attributes"]["name"] for institution in institution_data
-        ]
-        contributor_data["affiliated_institutions"] = institution_list
-        contributor.update(contributor_data)
-        contributor_data_list.append(contributor)
-    response["data"] = contributor_data_list
+        for contributor in response["data"]
+    ]
+    throttle = Throttle(settings.OSF_INSTITUTION_LOOKUP_CONCURRENCY)
+
+    async def get_institution_names(institution_url):
+        async with throttle.slot():
+            data = await get_reference_data(
+                institution_url, session=session, throttle=throttle
+            )
+        return [institution["attributes"]["name"] for institution in data["data"]]
+
+    async with session_or_new(session) as session:
+        unique_urls = list(dict.fromkeys(institution_urls))
+        institution_names = dict(
+            zip(
+                unique_urls,
+                await asyncio.gather(*map(get_institution_names, unique_urls)),
+            )
+        )
+
+    for contributor, institution_url in zip(response["data"], institution_urls):
+        contributor["affiliated_institutions"] = list(institution_names[institution_url])
     return response
 
 
-async def get_paginated_data(url, parse_json=None):
-    data = await get_with_retry(url, retry_on=(429,))
-    tasks = []
+async def get_first_page(url, parse_json, session, throttle):
+    """
+    :return: the (parsed) response for `url` and whether it is the first of several pages.
+    """
+    data = await get_with_retry(url, retry_on=(429,), session=session, throttle=throttle)
     is_paginated = data.get("links", {}).get("next")
 
     if parse_json:
         data = await parse_json(data)
 
-    if is_paginated:
-        result = {1: data["data"]}
-        total = data["links"].get("meta", {}).get("total") or data["meta"].get("total")
-        per_page = data["links"].get("meta", {}).get("per_page") or data["meta"].get(
-            "per_page"
-        )
+    return data, bool(is_paginated)
 
-        pages = math.ceil(int(total) / int(per_page))
-        for i in range(1, pages):
-            task = get_pages(url, i + 1, result)
-            tasks.append(task)
-
-        await asyncio.gather(*tasks)
-        pages_as_list = []
-        # through the magic of async all our pages have loaded.
-        for page in list(result.values()):
-            pages_as_list += page
-        return pages_as_list
-    else:
-        return data
 
+async def iter_pages(url, data, parse_json, session, throttle):
+    """
+    Yields the records of every page of a paginated endpoint in page order, starting with the
+    already fetched first page `data`. At most OSF_MAX_PAGES_IN_FLIGHT pages are requested ahead of
+    the one being consumed, so memory stays bounded by a few pages however long the list is.
+    """
+    total = data["links"].get("meta", {}).get("total") or data["meta"].get("total")
+    per_page = data["links"].get("meta", {}).get("per_page") or data["meta"].get(
+        "per_page"
+    )
+    pages = iter(range(2, math.ceil(int(total) / int(per_page)) + 1))
+    pending = collections.deque()  # page requests in page order, owned by this pagination only
+
+    def request_next_page():
+        page = next(pages, None)
+        if page:
+            task = get_pages(
+                url, page, parse_json=parse_json, session=session, throttle=throttle
+            )
+            pending.append(asyncio.ensure_future(task))
+
+    for _ in range(settings.OSF_MAX_PAGES_IN_FLIGHT):
+        request_next_page()
 
-def get_ia_item(guid):
-    session = internetarchive.get_session(
-        config={
-            "s3": {"access": settings.IA_ACCESS_KEY, "secret": settings.IA_SECRET_KEY},
-        },
+    try:
+        yield data["data"]
+        while pending:
+            records = await pending.popleft()
+            request_next_page()
+            yield records
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def iter_records(url, session, throttle):
+    """
+    Yields the records at `url` a page at a time, whether or not the list is paginated.
+    """
+    data, is_paginated = await get_first_page(url, None, session, throttle)
+    if not is_paginated:
+        yield data["data"]
+        return
+    async for page in iter_pages(url, data, None, session, throttle):
+        yield page
+
+
+async def iter_provider_registrations(provider_id, session=None):
+    """
+    Yields the guids of every registration of the registration provider `provider_id`, a page at
+    a time.
+    """
+    url = (
+        f"{settings.OSF_API_URL}v2/providers/registrations/{provider_id}/registrations/"
+        f"?page[size]=100"
     )
-    return session.get_item(guid)
+    async with session_or_new(session) as session:
+        throttle = Throttle(settings.OSF_MAX_PAGES_IN_FLIGHT)
+        async for page in iter_records(url, session, throttle):
+            yield [registration["id"] for registration in page]
+
+
+async def walk_files(guid, session=None):
+    """
+    Yields the record of every file in the registration's osfstorage, recursing into folders.
+    """
+    async with session_or_new(session) as session:
+        throttle = Throttle(settings.OSF_MAX_PAGES_IN_FLIGHT)
+        folders = [f"{settings.OSF_API_URL}v2/registrations/{guid}/files/osfstorage/"]
+        while folders:
+            async for page in iter_records(folders.pop(), session, throttle):
+                for record in page:
+                    if record["attributes"]["kind"] == "folder":
+                        folders.append(
+                            record["relationships"]["files"]["links"]["related"]["href"]
+                        )
+                    else:
+                        yield record
+
+
+async def get_archive_footprint(guid, session=None):
+    """
+    :return: an estimate of the disk space, in bytes, archiving the registration needs at once
+    """
+    size = 0
+    async for file in walk_files(guid, session=session):
+        size += file["attributes"]["size"] or 0
+    return int(size * settings.ARCHIVE_DISK_FACTOR) + settings.ARCHIVE_DISK_OVERHEAD
+
+
+async def get_paginated_data(url, parse_json=None, session=None):
+    async with session_or_new(session) as session:
+        throttle = Throttle(settings.OSF_MAX_PAGES_IN_FLIGHT)
+        data, is_paginated = await get_first_page(url, parse_json, session, throttle)
+
+        if is_paginated:
+            pages_as_list = []
+            async for page in iter_pages(url, data, parse_json, session, throttle):
+                pages_as_list += page
+            return pages_as_list
+        else:
+            return data
+
+
+class IASessions:
+    """
+    Configured internetarchive sessions, one for each thread that talks to IA, kept for the life
+    of the process so connections to archive.org and IA's S3 API stay alive between jobs. There's
+    one session per worker thread, so the sessions scale with the worker pools, and each keeps as
+    many connections per host as a multipart upload sends parts at once.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self._create()
+        return session
+
+    @staticmethod
+    def _create():
+        adapter_kwargs = {"pool_maxsize": settings.IA_MULTIPART_CONCURRENCY}
+        session = internetarchive.get_session(
+            config={
+                "s3": {"access": settings.IA_ACCESS_KEY, "secret": settings.IA_SECRET_KEY},
+            },
+            http_adapter_kwargs=dict(adapter_kwargs),
+        )
+        session.mount(settings.IA_S3_URL, requests.adapters.HTTPAdapter(**adapter_kwargs))
+        return session
+
+    def clear(self):
+        self._local = threading.local()
+
+
+ia_sessions = IASessions()
+
+
+class ItemCache:
+    """
+    A size bounded LRU cache of IA item handles, kept for a short TTL, so a burst of metadata
+    syncs for one item doesn't refetch its metadata every time. Unlike `ReferenceCache` it's used
+    from worker threads, and concurrent misses each fetch the item.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # identifier -> (expires_at, item)
+        self._lock = threading.Lock()
+
+    def get(self, identifier, fetch):
+        with self._lock:
+            expires_at, item = self._entries.get(identifier, (0, None))
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(identifier)
+                return item
+
+        item = fetch()
+        with self._lock:
+            self._entries[identifier] = (time.monotonic() + self.ttl, item)
+            self._entries.move_to_end(identifier)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return item
+
+    def invalidate(self, identifier):
+        with self._lock:
+            self._entries.pop(identifier, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+ia_items = ItemCache(settings.IA_ITEM_CACHE_SIZE, settings.IA_ITEM_CACHE_TTL)
+
+
+def get_ia_item(identifier, cached=False):
+    """
+    :param cached: allow a handle fetched up to IA_ITEM_CACHE_TTL seconds ago. Anything that
+    changes the item must `ia_items.invalidate` it.
+    """
+    if cached:
+        return ia_items.get(identifier, partial(get_ia_item, identifier))
+    return ia_sessions.get().get_item(identifier)
 
 
 def sync_metadata(guid, metadata):
@@ -301,11 +1386,14 @@ def sync_metadata(guid, metadata):
         - license
         - article_doi
 
-    `moderation_state` is an allowable key, but only to determine a withdrawal status of a
-     registration.
+    `withdrawal_justification` is an allowable key, but also marks the registration withdrawn,
+    which is written together with `noindex`.
+
+    Only values that differ from the item's current metadata are written, in a single
+    `modify_metadata` call, or none at all if nothing changed.
     :param guid:
     :param metadata:
-    :return:
+    :return: the IA item and the keys that were written
     """
 
     if not metadata:
@@ -335,41 +1423,493 @@ def sync_metadata(guid, metadata):
         )
 
     item_name = settings.REG_ID_TEMPLATE.format(guid=guid)
-    ia_item = get_ia_item(item_name)
-    if not metadata.get("withdrawal_justification"):  # withdrawn == not searchable
-        ia_item.modify_metadata(metadata)
-    else:
-        description = ia_item.metadata.get("description")
-        if description:
-            metadata[
-                "description"
-            ] = f"Note this registration has been withdrawn: \n{description}"
-        else:
-            metadata["description"] = "This registration has been withdrawn"
+    with stage("get_item"):
+        ia_item = get_ia_item(item_name, cached=True)
+    if metadata.get("withdrawal_justification"):  # withdrawn == not searchable
+        metadata = {
+            **metadata,
+            "description": get_withdrawn_description(ia_item.metadata.get("description")),
+            "noindex": True,
+        }
 
-        ia_item.modify_metadata(metadata)
-        ia_item.modify_metadata({"noindex": True})
+    changes = get_metadata_changes(ia_item.metadata, metadata)
+    if changes:
+        with stage("modify_metadata"):
+            ia_items.invalidate(item_name)  # its metadata is out of date now
+            ia_item.modify_metadata(changes)
 
-    return ia_item, list(metadata.keys())
+    return ia_item, list(changes.keys())
 
 
-async def upload(item_name, temp_dir, metadata):
-    ia_item = get_ia_item(item_name)
-    ia_metadata = await get_metadata_for_ia_item(metadata)
-    provider_id = metadata["data"]["embeds"]["provider"]["data"]["id"]
-    ia_item.upload(
-        os.path.join(temp_dir, "bag.zip"),
-        metadata={
-            "collection": settings.PROVIDER_ID_TEMPLATE.format(provider_id=provider_id),
-            **ia_metadata,
-        },
+WITHDRAWN_NOTE = "Note this registration has been withdrawn: \n"
+WITHDRAWN_DESCRIPTION = "This registration has been withdrawn"
+
+
+def get_withdrawn_description(description):
+    if not description or description == WITHDRAWN_DESCRIPTION:
+        return WITHDRAWN_DESCRIPTION
+    if description.startswith(WITHDRAWN_NOTE):  # noted by an earlier sync
+        return description
+    return f"{WITHDRAWN_NOTE}{description}"
+
+
+def as_ia_values(value):
+    """
+    :return: `value` as IA returns it, for comparison: IA stores every value as a string, a list
+    of one as just that value, and drops empty values.
+    """
+    values = value if isinstance(value, (list, tuple)) else [value]
+    return [
+        str(value).lower() if isinstance(value, bool) else str(value)
+        for value in values
+        if value not in ("", None)
+    ]
+
+
+def get_metadata_changes(ia_metadata, metadata):
+    """
+    :return: the entries of `metadata` whose values differ from the IA item's `ia_metadata`
+    """
+    return {
+        key: value
+        for key, value in metadata.items()
+        if as_ia_values(ia_metadata.get(key)) != as_ia_values(value)
+    }
+
+
+class UploadProgress:
+    """
+    Tracks the bytes sent by an upload, logging the throughput every IA_PROGRESS_INTERVAL seconds.
+    Parts are uploaded from several threads, so `add` is thread-safe.
+    """
+
+    def __init__(self, name, total_bytes):
+        self.name = name
+        self.total_bytes = total_bytes
+        self.bytes_sent = 0
+        self.started = time.monotonic()
+        self.job = current_job.get()  # parts are sent from threads that don't share its context
+        self._last_report = self.started
+        self._lock = threading.Lock()
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes_sent / max(time.monotonic() - self.started, 1e-6)
+
+    def add(self, byte_count):
+        metrics.IA_UPLOAD_BYTES.inc(byte_count)
+        if self.job:
+            self.job.add(bytes_uploaded=byte_count)
+        with self._lock:
+            self.bytes_sent += byte_count
+            now = time.monotonic()
+            if now - self._last_report < settings.IA_PROGRESS_INTERVAL:
+                return
+            self._last_report = now
+        total = f"/{self.total_bytes}" if self.total_bytes is not None else ""
+        logger.info(
+            f"{self.name}: {self.bytes_sent}{total} bytes uploaded "
+            f"({self.bytes_per_second / 1024 / 1024:.1f} MiB/s)"
+        )
+
+
+def get_upload_state_path(identifier, filename):
+    state_dir = settings.IA_UPLOAD_STATE_DIR or tempfile.gettempdir()
+    return os.path.join(state_dir, f"{identifier}-{filename}.upload.json")
+
+
+def save_upload_state(state_path, state):
+    with open(f"{state_path}.tmp", "w") as fp:
+        json.dump(state, fp)
+    os.replace(f"{state_path}.tmp", state_path)
+
+
+def load_upload_state(state_path):
+    """
+    :return: the saved state of an earlier attempt to upload the same file, or None if there wasn't
+    one.
+    """
+    try:
+        with open(state_path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def is_missing_upload(error):
+    """
+    :return: whether `error` is S3's NoSuchUpload, i.e. the upload id expired, was aborted or was
+    already completed, so it can't be resumed.
+    """
+    resp = getattr(error, "response", None)
+    return resp is not None and resp.status_code == 404 and "NoSuchUpload" in resp.text
+
+
+def start_multipart_upload(session, url, metadata):
+    """
+    :return: the id of a new S3 multipart upload to `url`, which will have the IA `metadata`.
+    """
+    request = S3Request(
+        method="POST",
+        url=url,
+        params="uploads",
+        metadata=metadata,
         access_key=settings.IA_ACCESS_KEY,
         secret_key=settings.IA_SECRET_KEY,
     )
+    resp = session.send(request.prepare())
+    resp.raise_for_status()
+    return next(
+        element.text
+        for element in ElementTree.fromstring(resp.content).iter()
+        if element.tag.endswith("UploadId")
+    )
+
+
+def put_part(session, url, upload_id, number, data, progress):
+    """
+    Sends part `number` of a multipart upload, retrying it IA_MULTIPART_RETRIES times.
+    :return: the part's ETag
+    """
+    auth = S3Auth(settings.IA_ACCESS_KEY, settings.IA_SECRET_KEY)
+    for attempt in range(settings.IA_MULTIPART_RETRIES + 1):
+        try:
+            resp = session.put(
+                url, params={"partNumber": number, "uploadId": upload_id}, data=data, auth=auth
+            )
+            resp.raise_for_status()
+            return resp.headers.get("ETag", f'"{hashlib.md5(data).hexdigest()}"')
+        except requests.RequestException as e:
+            if attempt == settings.IA_MULTIPART_RETRIES or is_missing_upload(e):
+                raise
+            if progress.job:
+                progress.job.add(retries=1)
+            time.sleep(settings.IA_MULTIPART_RETRY_DELAY * 2 ** attempt)
+
+
+def complete_multipart_upload(session, url, upload_id, etags):
+    """
+    :param etags: the ETag of every part, in order.
+    """
+    parts = "".join(
+        f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>"
+        for number, etag in enumerate(etags, 1)
+    )
+    resp = session.post(
+        url,
+        params={"uploadId": upload_id},
+        data=f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>",
+        auth=S3Auth(settings.IA_ACCESS_KEY, settings.IA_SECRET_KEY),
+    )
+    resp.raise_for_status()
+    return resp
+
+
+def abort_multipart_upload(session, url, upload_id):
+    """
+    Aborts a multipart upload, so IA drops the parts sent for it. Failing to is only logged, since
+    IA expires abandoned uploads eventually anyway.
+    """
+    try:
+        resp = session.delete(
+            url,
+            params={"uploadId": upload_id},
+            auth=S3Auth(settings.IA_ACCESS_KEY, settings.IA_SECRET_KEY),
+        )
+        if resp.status_code != 404:  # already gone
+            resp.raise_for_status()
+    except requests.RequestException as e:
+        logger.warning(f"Couldn't abort upload {upload_id} to {url}: {e!r}")
+
+
+def upload_multipart(identifier, path, metadata, session=None):
+    """
+    Uploads the file at `path` to the IA item `identifier` with the S3 multipart API, in parts of
+    IA_MULTIPART_PART_SIZE bytes sent IA_MULTIPART_CONCURRENCY at a time. Completed parts are
+    recorded in a state file under IA_UPLOAD_STATE_DIR, so if the job is retried the upload resumes
+    with the same upload id and skips every part whose bytes (by MD5, which is the part's S3 ETag)
+    were already sent. Blocking, run it in a thread.
+
+    Saved state for a file of a different size or split into different parts is thrown away and
+    its upload aborted. If IA no longer has the saved upload, it's started over.
+    """
+    session = session or ia_sessions.get()
+    filename = os.path.basename(path)
+    url = f"{settings.IA_S3_URL}{identifier}/{filename}"
+    size = os.path.getsize(path)
+    part_size = settings.IA_MULTIPART_PART_SIZE
+    part_count = max(1, math.ceil(size / part_size))
+
+    state_path = get_upload_state_path(identifier, filename)
+    state = load_upload_state(state_path)
+    if state and (state.get("size"), state.get("part_size")) != (size, part_size):
+        logger.info(f"{identifier}: {filename} changed, aborting upload {state['upload_id']}")
+        abort_multipart_upload(session, url, state["upload_id"])
+        state = None
+
+    progress = UploadProgress(identifier, size)
+    state_lock = threading.Lock()
+
+    def upload_parts(state):
+        def upload_part(number):
+            with open(path, "rb") as fp:
+                fp.seek((number - 1) * part_size)
+                data = fp.read(part_size)
+            if state["parts"].get(str(number)) != f'"{hashlib.md5(data).hexdigest()}"':
+                etag = put_part(session, url, state["upload_id"], number, data, progress)
+                with state_lock:
+                    state["parts"][str(number)] = etag
+                    save_upload_state(state_path, state)
+            progress.add(len(data))
+
+        with ThreadPoolExecutor(
+            max_workers=settings.IA_MULTIPART_CONCURRENCY, thread_name_prefix="pigeon_upload"
+        ) as pool:
+            list(pool.map(upload_part, range(1, part_count + 1)))
+
+        return complete_multipart_upload(
+            session,
+            url,
+            state["upload_id"],
+            [state["parts"][str(number)] for number in range(1, part_count + 1)],
+        )
+
+    resp = None
+    if state:
+        logger.info(f"{identifier}: resuming upload {state['upload_id']}")
+        try:
+            resp = upload_parts(state)
+        except requests.HTTPError as e:
+            if not is_missing_upload(e):
+                raise
+            logger.warning(f"{identifier}: upload {state['upload_id']} is gone, starting over")
+    if resp is None:
+        upload_id = start_multipart_upload(session, url, metadata)
+        state = {"upload_id": upload_id, "size": size, "part_size": part_size, "parts": {}}
+        save_upload_state(state_path, state)
+        resp = upload_parts(state)
+    os.remove(state_path)
+    logger.info(
+        f"{identifier}: uploaded {size} bytes at "
+        f"{progress.bytes_per_second / 1024 / 1024:.1f} MiB/s"
+    )
+    return resp
+
+
+class MultipartStream:
+    """
+    A write-only file object whose contents are uploaded to the IA item `identifier` as they are
+    written, with the S3 multipart API in parts of IA_MULTIPART_PART_SIZE bytes sent
+    IA_MULTIPART_CONCURRENCY at a time. Writes block while that many parts are in flight, so no
+    more than that many parts are held in memory. The upload is completed when the stream is
+    closed, and fails on the first write or close after a part failed for good. If it fails, or
+    the block it's used in does, the upload is aborted.
+
+    Unlike `upload_multipart` it can't be resumed, since what's written is only known once it has
+    been written. Blocking, use it from a thread.
+    """
+
+    def __init__(self, identifier, filename, metadata, session=None):
+        self.session = session or ia_sessions.get()
+        self.url = f"{settings.IA_S3_URL}{identifier}/{filename}"
+        self.upload_id = start_multipart_upload(self.session, self.url, metadata)
+        self.progress = UploadProgress(identifier, None)
+        self.size = 0
+        self._buffer = bytearray()
+        self._parts = []  # futures of each part's ETag, in order
+        self._error = None
+        self._slots = threading.BoundedSemaphore(settings.IA_MULTIPART_CONCURRENCY)
+        self._pool = ThreadPoolExecutor(
+            max_workers=settings.IA_MULTIPART_CONCURRENCY, thread_name_prefix="pigeon_upload"
+        )
+
+    def write(self, data):
+        self._raise_failure()
+        self._buffer += data
+        self.size += len(data)
+        part_size = settings.IA_MULTIPART_PART_SIZE
+        while len(self._buffer) >= part_size:
+            self._send(bytes(self._buffer[:part_size]))
+            del self._buffer[:part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _send(self, data):
+        self._slots.acquire()
+        self._raise_failure()
+        future = self._pool.submit(
+            put_part,
+            self.session,
+            self.url,
+            self.upload_id,
+            len(self._parts) + 1,
+            data,
+            self.progress,
+        )
+        future.add_done_callback(partial(self._part_done, len(data)))
+        self._parts.append(future)
+
+    def _part_done(self, size, future):
+        self._slots.release()
+        if future.cancelled():
+            return
+        if future.exception():
+            self._error = self._error or future.exception()
+        else:
+            self.progress.add(size)
+
+    def _raise_failure(self):
+        if self._error:
+            raise self._error
+
+    def close(self):
+        """
+        Sends what's left and completes the upload.
+        """
+        try:
+            if self._buffer or not self._parts:
+                self._send(bytes(self._buffer))
+                self._buffer.clear()
+            etags = [future.result() for future in self._parts]
+        finally:
+            self._pool.shutdown()
+        return complete_multipart_upload(self.session, self.url, self.upload_id, etags)
+
+    def abort(self):
+        """
+        Stops sending parts and aborts the upload, so IA drops the parts already sent.
+        """
+        for future in self._parts:
+            future.cancel()
+        self._pool.shutdown()
+        abort_multipart_upload(self.session, self.url, self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.close()
+        except BaseException:
+            self.abort()
+            raise
+
+
+def stream_zip(temp_dir, identifier, metadata):
+    """
+    Zips the bag in `temp_dir/bag` straight into a multipart upload of `bag.zip` to the IA item
+    `identifier`, so the zip is never written to disk and its first parts are uploaded while the
+    rest is still being zipped. Blocking, run it in a thread.
+    :return: the size of the zip
+    """
+    with MultipartStream(identifier, "bag.zip", metadata) as stream:
+        create_zip(temp_dir, stream)
+    logger.info(
+        f"{identifier}: streamed {stream.size} bytes at "
+        f"{stream.progress.bytes_per_second / 1024 / 1024:.1f} MiB/s"
+    )
+    return stream.size
+
+
+async def upload(item_name, temp_dir, metadata, session=None):
+    ia_item, ia_metadata = await asyncio.gather(
+        run_in_thread(get_ia_item, item_name),
+        get_metadata_for_ia_item(metadata, session=session),
+    )
+    provider_id = metadata["data"]["embeds"]["provider"]["data"]["id"]
+    ia_metadata = {
+        "collection": settings.PROVIDER_ID_TEMPLATE.format(provider_id=provider_id),
+        **ia_metadata,
+        **get_archived_version(metadata),
+    }
+    path = os.path.join(temp_dir, "bag.zip")
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    started = time.monotonic()
+    if settings.IA_STREAM_UPLOAD:
+        size = await run_in_pool(ia_uploads, stream_zip, temp_dir, item_name, ia_metadata)
+    elif os.path.exists(path) and size >= settings.IA_MULTIPART_THRESHOLD:
+        await run_in_pool(ia_uploads, upload_multipart, item_name, path, ia_metadata)
+    else:
+        await run_in_pool(
+            ia_uploads,
+            ia_item.upload,
+            path,
+            metadata=ia_metadata,
+            access_key=settings.IA_ACCESS_KEY,
+            secret_key=settings.IA_SECRET_KEY,
+        )
+        record(bytes_uploaded=size)
+        metrics.IA_UPLOAD_BYTES.inc(size)
+    if ia_item.exists:
+        # uploads only set the metadata of items they create, record the archived version on
+        # items that were already there, or they're never seen as current
+        await run_in_thread(ia_item.modify_metadata, get_archived_version(metadata))
+    ia_items.invalidate(item_name)
+    elapsed = time.monotonic() - started
+    metrics.IA_UPLOAD_SECONDS.observe(elapsed)
+    metrics.IA_UPLOAD_THROUGHPUT.observe(size / max(elapsed, 1e-6))
     return ia_item
 
 
-async def get_registration_metadata(guid, temp_dir, filename):
+def get_file_count(metadata):
+    return metadata["data"]["relationships"]["files"]["links"]["related"]["meta"].get("count", 0)
+
+
+def get_archived_version(metadata):
+    """
+    :return: the IA item metadata recording which version of the registration was archived, see
+    `get_changes_since_archived`.
+    """
+    return {
+        "osf_date_modified": metadata["data"]["attributes"]["date_modified"],
+        "osf_file_count": str(get_file_count(metadata)),
+    }
+
+
+FILES_CHANGED = "files"
+METADATA_CHANGED = "metadata"
+
+
+def get_changes_since_archived(ia_item, metadata):
+    """
+    Compares the registration `metadata` with the version recorded on its IA item when it was
+    archived. Registered files can't be edited, so a registration with the same file count and
+    `date_modified` is unchanged, and one with the same file count only had its metadata edited.
+    :return: FILES_CHANGED if the bag should be (re)uploaded, METADATA_CHANGED if only the item's
+    metadata is out of date, or None if the item is current.
+    """
+    if not ia_item.exists or not any(file["name"] == "bag.zip" for file in ia_item.files):
+        return FILES_CHANGED
+    archived, current = ia_item.metadata, get_archived_version(metadata)
+    if archived.get("osf_file_count") != current["osf_file_count"]:
+        return FILES_CHANGED
+    if archived.get("osf_date_modified") != current["osf_date_modified"]:
+        return METADATA_CHANGED
+    return None
+
+
+async def sync_archived_metadata(ia_item, metadata, session=None):
+    """
+    Brings the metadata of an already archived registration's IA item up to date, leaving the bag
+    as it is.
+    """
+    ia_metadata = await get_metadata_for_ia_item(metadata, session=session)
+    ia_items.invalidate(ia_item.identifier)
+    await run_in_thread(
+        ia_item.modify_metadata, {**ia_metadata, **get_archived_version(metadata)}
+    )
+
+
+async def get_registration(guid, session=None):
+    """
+    :return: the registration's metadata, with the embeds an archive needs
+    :raises PermissionError: if the registration is withdrawn
+    """
     metadata = await get_paginated_data(
         f"{settings.OSF_API_URL}v2/registrations/{guid}/"
         f"?embed=parent"
@@ -379,71 +1919,141 @@ async def get_registration_metadata(guid, temp_dir, filename):
         f"&embed=license"
         f"&embed=registration_schema"
         f"&related_counts=true"
-        f"&version=2.20"
+        f"&version=2.20",
+        session=session,
     )
     if metadata["data"]["attributes"]["withdrawn"]:
         raise PermissionError(f"Registration {guid} is withdrawn")
-
-    with open(os.path.join(temp_dir, filename), "w") as fp:
-        json.dump(metadata, fp)
-
     return metadata
 
 
-async def archive(guid):
-    with tempfile.TemporaryDirectory(
-        dir=settings.PIGEON_TEMP_DIR, prefix=settings.REG_ID_TEMPLATE.format(guid=guid)
-    ) as temp_dir:
-        os.mkdir(os.path.join(temp_dir, "bag"))
-        # await first to check if withdrawn
-        metadata = await get_registration_metadata(guid, os.path.join(temp_dir, "bag"), "registration.json")
-        tasks = [
-            write_datacite_metadata(guid, temp_dir, metadata),
-            dump_json_to_dir(
-                from_url=f"{settings.OSF_API_URL}v2/registrations/{guid}/wikis/"
-                f"?page[size]=100",
-                to_dir=os.path.join(temp_dir, "bag"),
-                name="wikis.json",
-            ),
-            dump_json_to_dir(
-                from_url=f"{settings.OSF_API_URL}v2/registrations/{guid}/logs/"
-                f"?page[size]=100",
-                to_dir=os.path.join(temp_dir, "bag"),
-                name="logs.json",
-            ),
-            dump_json_to_dir(
-                from_url=f"{settings.OSF_API_URL}v2/registrations/{guid}/contributors/"
-                f"?page[size]=100",
-                to_dir=os.path.join(temp_dir, "bag"),
-                name="contributors.json",
-                parse_json=get_additional_contributor_info,
-            ),
-        ]
-        # only download archived data if there are files
-        file_count = metadata["data"]["relationships"]["files"]["links"]["related"][
-            "meta"
-        ]["count"]
-        if file_count:
-            tasks.append(
-                stream_files_to_dir(
-                    f"{settings.OSF_FILES_URL}v1/resources/{guid}/providers/osfstorage/?zip=",
-                    os.path.join(temp_dir, "bag"),
-                    "archived_files.zip",
-                )
-            )
+@asynccontextmanager
+async def admit_now(guid):
+    """
+    The default `admission` of `archive`: files are archived as soon as they're known to be needed.
+    """
+    yield
 
-        await asyncio.gather(*tasks)
 
-        bagit.make_bag(os.path.join(temp_dir, "bag"))
-        bag = bagit.Bag(os.path.join(temp_dir, "bag"))
-        assert bag.is_valid()
+async def archive(
+    guid, session=None, limits=None, incremental=None, per_file=None, admission=None
+):
+    """
+    :param limits: optional asyncio.Semaphores bounding how many archives are in the "download"
+    (from OSF) or "upload" (to IA) stage at once, shared between the jobs they should bound.
+    :param incremental: when the registration's IA item is current, skip it, and when only its
+    metadata changed, only update the item's metadata. Defaults to ARCHIVE_INCREMENTAL.
+    :param per_file: bag each file at its path under data/files rather than the files service's
+    zip of them as data/archived_files.zip. Defaults to ARCHIVE_PER_FILE.
+    :param admission: called with the guid once its files are known to be needed, i.e. it wasn't
+    skipped by the incremental check, for an async context manager held while they're archived,
+    e.g. to wait for disk space for them.
+    """
+    if incremental is None:
+        incremental = settings.ARCHIVE_INCREMENTAL
+    if per_file is None:
+        per_file = settings.ARCHIVE_PER_FILE
+    async with session_or_new(session) as session:
+        return await _archive(guid, session, limits, incremental, per_file, admission or admit_now)
 
-        create_zip(temp_dir)
-        ia_item = await upload(
-            settings.REG_ID_TEMPLATE.format(guid=guid), temp_dir, metadata
-        )
 
-        return ia_item, guid
+async def _archive(guid, session, limits, incremental, per_file, admission):
+    item_name = settings.REG_ID_TEMPLATE.format(guid=guid)
+    # fetched first to check if withdrawn, or already archived
+    async with limit(limits, "download"):
+        with stage("metadata"):
+            metadata = await get_registration(guid, session=session)
+
+    if incremental:
+        with stage("compare"):
+            ia_item = await run_in_thread(get_ia_item, item_name)
+            changes = get_changes_since_archived(ia_item, metadata)
+        if changes is None:
+            logger.info(f"{item_name} is current, skipping it")
+            metrics.ARCHIVES.labels("skipped").inc()
+            return ia_item, guid
+        if changes == METADATA_CHANGED:
+            logger.info(f"{item_name} only needs its metadata updated")
+            with stage("sync_metadata"):
+                await sync_archived_metadata(ia_item, metadata, session=session)
+            metrics.ARCHIVES.labels("metadata_synced").inc()
+            return ia_item, guid
+
+    async with admission(guid):
+        with tempfile.TemporaryDirectory(
+            dir=settings.PIGEON_TEMP_DIR, prefix=item_name
+        ) as temp_dir:
+            # the payload is written straight into the bag and hashed on the way to disk
+            payload = BagPayload(os.path.join(temp_dir, "bag"))
+            os.makedirs(payload.data_dir)
+            with open_output_file(payload.data_dir, "registration.json", payload=payload) as fp:
+                json.dump(metadata, fp)
+
+            async with limit(limits, "download"):
+                tasks = [
+                    write_datacite_metadata(guid, temp_dir, metadata),
+                    dump_json_to_dir(
+                        from_url=f"{settings.OSF_API_URL}v2/registrations/{guid}/wikis/"
+                        f"?page[size]=100",
+                        to_dir=payload.data_dir,
+                        name="wikis.json",
+                        session=session,
+                        payload=payload,
+                    ),
+                    dump_json_to_dir(
+                        from_url=f"{settings.OSF_API_URL}v2/registrations/{guid}/logs/"
+                        f"?page[size]=100",
+                        to_dir=payload.data_dir,
+                        name="logs.json",
+                        session=session,
+                        payload=payload,
+                    ),
+                    dump_json_to_dir(
+                        from_url=f"{settings.OSF_API_URL}v2/registrations/{guid}/contributors/"
+                        f"?page[size]=100",
+                        to_dir=payload.data_dir,
+                        name="contributors.json",
+                        parse_json=partial(get_additional_contributor_info, session=session),
+                        session=session,
+                        payload=payload,
+                    ),
+                ]
+                # only download archived data if there are files
+                if get_file_count(metadata) and per_file:
+                    tasks.append(
+                        download_files_to_dir(
+                            guid, os.path.join(payload.data_dir, "files"), payload, session=session
+                        )
+                    )
+                elif get_file_count(metadata):
+                    tasks.append(
+                        download_archived_files(
+                            guid,
+                            payload.data_dir,
+                            "archived_files.zip",
+                            session=session,
+                            payload=payload,
+                        )
+                    )
+
+                with stage("download"):
+                    await asyncio.gather(*tasks)
+
+            # bagging and zipping are CPU/disk bound, keep them off the event loop. The payload
+            # is written to disk once, as it's downloaded, since several downloads write it at
+            # once, and is read back once more to be zipped, into bag.zip or, with
+            # IA_STREAM_UPLOAD, into the upload itself
+            with stage("bag"), metrics.BAG_SECONDS.time():
+                await run_in_thread(make_bag, payload.bag_dir, payload)
+            if not settings.IA_STREAM_UPLOAD:  # otherwise the bag is zipped as it's uploaded
+                with stage("zip"), metrics.ZIP_SECONDS.time():
+                    await run_in_thread(create_zip, temp_dir)
+            async with limit(limits, "upload"):
+                with stage("upload"):
+                    ia_item = await upload(item_name, temp_dir, metadata, session=session)
+
+            metrics.ARCHIVES.labels("archived").inc()
+            return ia_item, guid
 
 
 def run(coroutine):
@@ -0,0 +1,424 @@
+import os
+import time
+import shutil
+import itertools
+import logging
+import asyncio
+import collections
+import tempfile
+import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from osf_pigeon import pigeon
+from osf_pigeon import metrics
+from osf_pigeon import settings
+from osf_pigeon.store import JobStore, ARCHIVE, METADATA, QUEUED
+
+logger = logging.getLogger(__name__)
+
+
+def is_temporary(path):
+    """
+    :return: whether the file at `path` is under the system's temporary directory
+    """
+    if path == ":memory:":
+        return True
+    temp_dir = os.path.realpath(tempfile.gettempdir())
+    return os.path.commonpath([os.path.realpath(path), temp_dir]) == temp_dir
+
+
+class DiskSpace:
+    """
+    Admits archive jobs to the disk under `path` by their estimated footprint. A job fits when the
+    free space, less the reservations of admitted jobs and `headroom`, covers it. A job that holds
+    the disk alone is always admitted, so one bigger than the disk still gets to try.
+
+    Smaller jobs are admitted around a big one that doesn't fit yet, but only until it has waited
+    `max_wait` seconds. From then on no job that started waiting after it is admitted, so the disk
+    drains until it fits.
+
+    A job's whole reservation counts until it finishes, even though the free space already
+    reflects what it has written, so admission errs on the side of caution. Only used from the
+    scheduler's event loop.
+    """
+
+    def __init__(self, path, headroom, poll_interval, max_wait):
+        self.path = path
+        self.headroom = headroom
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.reserved = 0
+        self.holders = 0
+        self.waiting = {}  # ticket -> when its job started waiting
+        self.released = asyncio.Event()  # replaced each time, so it's set once per release
+        self._tickets = itertools.count()
+
+    def free_space(self):
+        return shutil.disk_usage(self.path).free
+
+    def wait(self):
+        """
+        :return: a ticket for a job that's about to wait for disk space, its place in line.
+        """
+        ticket = next(self._tickets)
+        self.waiting[ticket] = time.monotonic()
+        return ticket
+
+    def stop_waiting(self, ticket):
+        self.waiting.pop(ticket, None)
+
+    def try_reserve(self, footprint, ticket):
+        now = time.monotonic()
+        if any(
+            earlier < ticket and now - since >= self.max_wait
+            for earlier, since in self.waiting.items()
+        ):
+            return False
+        if self.holders and self.free_space() - self.reserved - self.headroom < footprint:
+            return False
+        self.reserved += footprint
+        self.holders += 1
+        self.stop_waiting(ticket)
+        return True
+
+    def release(self, footprint):
+        self.reserved -= footprint
+        self.holders -= 1
+        self.released.set()
+        self.released = asyncio.Event()
+
+    async def wait_for_release(self, released):
+        """
+        Waits for `released`, a `released` event from before the reservation was tried, or for the
+        poll interval, in case something other than pigeon freed space.
+        """
+        try:
+            await asyncio.wait_for(released.wait(), self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+class Scheduler:
+    """
+    Runs pigeon jobs for the web app.
+
+    Archive jobs are coroutines scheduled on one long-lived event loop running in a background
+    thread, at most `archive_concurrency` at a time, all sharing one pooled ClientSession. Metadata
+    syncs get their own thread pool, so a quick sync never waits behind a multi-GB archive. A
+    metadata sync only starts once its registration has gone `metadata_debounce` seconds without
+    another edit, so a burst of edits is merged (by the `JobStore`) into one sync.
+
+    With `disk_admission`, an archive also has to fit on the disk under PIGEON_TEMP_DIR before it
+    downloads anything, see `DiskSpace`. Its footprint is estimated from the registration's file
+    sizes once it holds an archive slot and is known to need archiving, so at most
+    `archive_concurrency` registrations are listed at once, and a job that doesn't fit gives up
+    its slot while it waits, so smaller jobs keep starting.
+
+    Every job is recorded in a `JobStore`, jobs left unfinished by a previous process are requeued
+    on `start`, and duplicate submissions for a guid are folded into the job already pending. A job
+    only counts as done once its `on_*_done` hook (e.g. the callback to osf.io) has run.
+
+    While a job runs its stages, transfers and retries are tracked in a `pigeon.JobProgress`,
+    which is saved with the job when it finishes, see `jobs`.
+
+    However many archives are running, at most `download_concurrency` download from OSF and at
+    most `upload_concurrency` upload to IA at once. Batches (`submit_batch`) keep at most
+    `batch_concurrency` of their jobs scheduled at a time, so other archives are still scheduled
+    while a backfill runs.
+
+    Both `submit_*` methods return `concurrent.futures.Future`s.
+    """
+
+    def __init__(
+        self,
+        archive_concurrency=None,
+        metadata_concurrency=None,
+        store=None,
+        on_archive_done=None,
+        on_metadata_done=None,
+        download_concurrency=None,
+        upload_concurrency=None,
+        batch_concurrency=None,
+        metadata_debounce=None,
+        disk_admission=None,
+    ):
+        self.archive_concurrency = archive_concurrency or settings.ARCHIVE_CONCURRENCY
+        self.metadata_concurrency = metadata_concurrency or settings.METADATA_CONCURRENCY
+        self.download_concurrency = download_concurrency or settings.ARCHIVE_DOWNLOAD_CONCURRENCY
+        self.upload_concurrency = upload_concurrency or settings.ARCHIVE_UPLOAD_CONCURRENCY
+        self.batch_concurrency = batch_concurrency or settings.ARCHIVE_BATCH_CONCURRENCY
+        self.metadata_debounce = (
+            settings.METADATA_DEBOUNCE if metadata_debounce is None else metadata_debounce
+        )
+        self.disk_admission = (
+            settings.ARCHIVE_DISK_ADMISSION if disk_admission is None else disk_admission
+        )
+        self.disk = None
+        self.store = store
+        self.on_archive_done = on_archive_done
+        self.on_metadata_done = on_metadata_done
+        self.loop = None
+        self.session = None
+        self._thread = None
+        self._archive_slots = None
+        self._stage_limits = None
+        self._metadata_jobs = None
+        self._futures = {}  # job id -> future, for jobs not yet finished
+        self._futures_lock = threading.Lock()
+        self._progress = {}  # job id -> JobProgress, for running jobs
+
+    def start(self):
+        if not self.store:
+            if is_temporary(settings.JOB_STORE_PATH):
+                logger.warning(
+                    f"The job store {settings.JOB_STORE_PATH} is in a temporary directory, "
+                    f"queued and running jobs will be lost if it's cleared, e.g. on a redeploy. "
+                    f"Set PIGEON_STATE_DIR or JOB_STORE_PATH to somewhere persistent."
+                )
+            self.store = JobStore(settings.JOB_STORE_PATH)
+        metrics.JOBS_QUEUED.store = self.store
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name="pigeon_archive_loop", daemon=True
+        )
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self.loop).result()
+        self._metadata_jobs = ThreadPoolExecutor(
+            max_workers=self.metadata_concurrency, thread_name_prefix="pigeon_metadata_jobs"
+        )
+        for job in self.store.unfinished():
+            logger.info(f"Requeuing {job['kind']} job {job['id']} for {job['guid']}")
+            self._schedule(job["id"], job["kind"])
+        for batch_id in self.store.unfinished_batches():
+            logger.info(f"Resuming batch {batch_id}")
+            self._schedule_batch(batch_id)
+
+    async def _setup(self):
+        self._archive_slots = asyncio.Semaphore(self.archive_concurrency)
+        self._stage_limits = {
+            "download": asyncio.Semaphore(self.download_concurrency),
+            "upload": asyncio.Semaphore(self.upload_concurrency),
+        }
+        self.session = pigeon.create_session()
+        if self.disk_admission:
+            self.disk = DiskSpace(
+                settings.PIGEON_TEMP_DIR or tempfile.gettempdir(),
+                settings.ARCHIVE_DISK_HEADROOM,
+                settings.ARCHIVE_DISK_POLL,
+                settings.ARCHIVE_DISK_MAX_WAIT,
+            )
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._teardown(), self.loop).result()
+        self._metadata_jobs.shutdown(wait=True)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    async def _teardown(self):
+        tasks = [
+            task for task in asyncio.all_tasks() if task is not asyncio.current_task()
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.session.close()
+
+    def submit_archive(self, guid, force=False):
+        """
+        :param force: archive the registration again even if its IA item is current.
+        """
+        job_id, created = self.store.enqueue(ARCHIVE, guid, {"force": True} if force else None)
+        return self._schedule(job_id, ARCHIVE)
+
+    def submit_metadata(self, guid, metadata):
+        job_id, created = self.store.enqueue(METADATA, guid, metadata)
+        return self._schedule(job_id, METADATA)
+
+    def submit_batch(self, guids=None, provider=None):
+        """
+        Archives each of `guids`, or every registration of the registration provider `provider`,
+        once.
+        :return: the batch id, see `batch` for its progress.
+        """
+        batch_id = self.store.create_batch(provider)
+        if guids:
+            self.store.add_to_batch(batch_id, guids)
+        if not provider:
+            self.store.finish_enumerating(batch_id)
+        self._schedule_batch(batch_id)
+        return batch_id
+
+    def batch(self, batch_id):
+        """
+        :return: the batch, with how many of its jobs are in each state, or None.
+        """
+        return self.store.get_batch(batch_id)
+
+    def _schedule_batch(self, batch_id):
+        future = asyncio.run_coroutine_threadsafe(self._run_batch(batch_id), self.loop)
+        future.add_done_callback(self._log_batch_failure)
+        return future
+
+    @staticmethod
+    def _log_batch_failure(future):
+        if not future.cancelled() and future.exception():
+            logger.error("Batch failed", exc_info=future.exception())
+
+    async def _run_batch(self, batch_id):
+        batch = self.store.get_batch(batch_id)
+        if not batch["enumerated"]:
+            async for guids in pigeon.iter_provider_registrations(
+                batch["provider"], session=self.session
+            ):
+                self.store.add_to_batch(batch_id, guids)
+            self.store.finish_enumerating(batch_id)
+
+        slots = asyncio.Semaphore(self.batch_concurrency)
+        scheduled = set()
+
+        def done(future):
+            scheduled.discard(future)
+            slots.release()
+            if not future.cancelled() and future.exception():
+                logger.error(f"Batch {batch_id} job failed", exc_info=future.exception())
+
+        for job_id in self.store.batch_job_ids(batch_id):
+            await slots.acquire()
+            if self.store.get(job_id)["state"] != QUEUED:  # archived outside the batch meanwhile
+                slots.release()
+                continue
+            future = asyncio.wrap_future(self._schedule(job_id, ARCHIVE))
+            scheduled.add(future)
+            future.add_done_callback(done)
+        await asyncio.gather(*scheduled, return_exceptions=True)
+
+    def _schedule(self, job_id, kind):
+        with self._futures_lock:
+            future = self._futures.get(job_id)
+            if future:
+                return future
+            job = self._archive(job_id) if kind == ARCHIVE else self._metadata(job_id)
+            future = asyncio.run_coroutine_threadsafe(job, self.loop)
+            self._futures[job_id] = future
+        future.add_done_callback(lambda _: self._forget(job_id))
+        return future
+
+    def jobs(self, guid=None):
+        """
+        :return: the status of every queued and running job, or of every job for `guid`.
+        """
+        if guid:
+            return [
+                self._status(job, job["state"] == QUEUED and self.store.queue_position(job))
+                for job in self.store.for_guid(guid)
+            ]
+        # active jobs come oldest first, so a queued job's position is how many queued jobs of its
+        # kind have been seen, counted in one pass rather than a query per job
+        statuses, queued = [], collections.Counter()
+        for job in self.store.active():
+            if job["state"] == QUEUED:
+                queued[job["kind"]] += 1
+            statuses.append(self._status(job, job["state"] == QUEUED and queued[job["kind"]]))
+        return statuses
+
+    def _status(self, job, queue_position=None):
+        status = {
+            key: job[key] for key in ("id", "kind", "guid", "state", "error", "created", "updated")
+        }
+        if queue_position:
+            status["queue_position"] = queue_position
+        progress = self._progress.get(job["id"])
+        status["progress"] = progress.as_dict() if progress else job["progress"]
+        return status
+
+    def _forget(self, job_id):
+        with self._futures_lock:
+            self._futures.pop(job_id, None)
+
+    @asynccontextmanager
+    async def _disk_reservation(self, guid):
+        """
+        The `admission` of archives with disk admission: a reservation for the job's estimated
+        footprint, entered while the job holds an archive slot. The slot is given up while the job
+        waits for space.
+        """
+        with pigeon.stage("estimate"):
+            footprint = await pigeon.get_archive_footprint(guid, session=self.session)
+        ticket = self.disk.wait()
+        try:
+            with pigeon.stage("disk_queue"):
+                while True:
+                    released = self.disk.released
+                    if self.disk.try_reserve(footprint, ticket):
+                        break
+                    self._archive_slots.release()
+                    try:
+                        await self.disk.wait_for_release(released)
+                    finally:
+                        await self._archive_slots.acquire()
+        finally:
+            self.disk.stop_waiting(ticket)
+        try:
+            yield
+        finally:
+            self.disk.release(footprint)
+
+    async def _archive(self, job_id):
+        progress = pigeon.JobProgress()
+        try:
+            with pigeon.tracking(progress):
+                async with self._archive_slots:
+                    job = self.store.start(job_id)
+                    self._progress[job_id] = progress
+                    # reserving disk space waits for the incremental check, skipped jobs need none
+                    admission = {"admission": self._disk_reservation} if self.disk else {}
+                    with metrics.JOBS_IN_FLIGHT.labels(ARCHIVE).track_inprogress():
+                        result = await pigeon.archive(
+                            job["guid"],
+                            session=self.session,
+                            limits=self._stage_limits,
+                            incremental=False if (job["payload"] or {}).get("force") else None,
+                            **admission,
+                        )
+                        if self.on_archive_done:
+                            with pigeon.stage("callback"):
+                                await pigeon.run_in_thread(self.on_archive_done, result)
+        except asyncio.CancelledError:
+            raise  # shutting down, leave the job to be requeued
+        except Exception as e:
+            self.store.fail(job_id, repr(e), progress.as_dict())
+            raise
+        finally:
+            self._progress.pop(job_id, None)
+        self.store.finish(job_id, progress.as_dict())
+        return result
+
+    async def _metadata(self, job_id):
+        while True:
+            quiet_for = time.time() - self.store.get(job_id)["updated"]
+            if quiet_for >= self.metadata_debounce:
+                break
+            await asyncio.sleep(self.metadata_debounce - quiet_for)
+        return await asyncio.get_event_loop().run_in_executor(
+            self._metadata_jobs, self._sync_metadata, job_id
+        )
+
+    def _sync_metadata(self, job_id):
+        job = self.store.start(job_id)
+        progress = self._progress[job_id] = pigeon.JobProgress()
+        try:
+            in_flight = metrics.JOBS_IN_FLIGHT.labels(METADATA)
+            with pigeon.tracking(progress), in_flight.track_inprogress():
+                result = pigeon.sync_metadata(job["guid"], job["payload"])
+                if self.on_metadata_done:
+                    with pigeon.stage("callback"):
+                        self.on_metadata_done(result)
+        except Exception as e:
+            self.store.fail(job_id, repr(e), progress.as_dict())
+            raise
+        finally:
+            self._progress.pop(job_id)
+        self.store.finish(job_id, progress.as_dict())
+        return result
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 DATACITE_USERNAME = os.environ.get("DATACITE_USERNAME")
 DATACITE_PASSWORD = os.environ.get("DATACITE_PASSWORD")
@@ -22,6 +23,138 @@ PIGEON_TEMP_DIR = os.environ.get(
     "PIGEON_TEMP_DIR", None
 )  # setting to None allows tempfile.py to decide
 
+# Connection pool shared by every OSF request made by an archive worker
+OSF_CONNECTION_POOL_SIZE = int(os.environ.get("OSF_CONNECTION_POOL_SIZE", 100))
+OSF_CONNECTION_POOL_SIZE_PER_HOST = int(
+    os.environ.get("OSF_CONNECTION_POOL_SIZE_PER_HOST", 20)
+)
+OSF_KEEPALIVE_TIMEOUT = int(os.environ.get("OSF_KEEPALIVE_TIMEOUT", 30))  # seconds
+OSF_DNS_CACHE_TTL = int(os.environ.get("OSF_DNS_CACHE_TTL", 300))  # seconds
+
+# Pagination: pages requested at once per paginated endpoint, and retry policy for 429s
+OSF_MAX_PAGES_IN_FLIGHT = int(os.environ.get("OSF_MAX_PAGES_IN_FLIGHT", 5))
+OSF_MAX_RETRIES = int(os.environ.get("OSF_MAX_RETRIES", 5))
+OSF_RETRY_BACKOFF = float(os.environ.get("OSF_RETRY_BACKOFF", 1))  # seconds
+OSF_RETRY_MAX_BACKOFF = float(os.environ.get("OSF_RETRY_MAX_BACKOFF", 60))  # seconds
+OSF_INSTITUTION_LOOKUP_CONCURRENCY = int(
+    os.environ.get("OSF_INSTITUTION_LOOKUP_CONCURRENCY", 10)
+)
+
+# Ask the files service, with a HEAD request, whether it serves byte ranges of archived_files.zip.
+# It doesn't for the zips it generates, so this is only worth it in front of one that can
+OSF_DOWNLOAD_RANGES = os.environ.get("OSF_DOWNLOAD_RANGES", "false").lower() == "true"
+# if it does, it's downloaded in this many byte ranges at once, each at least
+# OSF_DOWNLOAD_SEGMENT_SIZE
+OSF_DOWNLOAD_SEGMENTS = int(os.environ.get("OSF_DOWNLOAD_SEGMENTS", 4))
+OSF_DOWNLOAD_SEGMENT_SIZE = int(
+    os.environ.get("OSF_DOWNLOAD_SEGMENT_SIZE", 64 * 1024 * 1024)
+)  # bytes
+# when it doesn't, or isn't asked, the zip is streamed as one download, unless this is set, then
+# its files are downloaded one by one, OSF_DOWNLOAD_CONCURRENCY at once, and zipped by pigeon
+OSF_DOWNLOAD_PER_FILE_FALLBACK = (
+    os.environ.get("OSF_DOWNLOAD_PER_FILE_FALLBACK", "false").lower() == "true"
+)
+OSF_DOWNLOAD_CONCURRENCY = int(os.environ.get("OSF_DOWNLOAD_CONCURRENCY", 8))
+
+# In-process cache for OSF data shared between registrations, e.g. a user's institutions
+REFERENCE_CACHE_SIZE = int(os.environ.get("REFERENCE_CACHE_SIZE", 4096))  # entries
+REFERENCE_CACHE_TTL = int(os.environ.get("REFERENCE_CACHE_TTL", 3600))  # seconds
+
+# Threads for short blocking calls made by archive jobs, e.g. to DataCite and IA, on top of one per
+# running archive for bagging and zipping. Uploads have ARCHIVE_UPLOAD_CONCURRENCY threads of their
+# own
+BLOCKING_IO_WORKERS = int(os.environ.get("BLOCKING_IO_WORKERS", 8))
+
+# Archive jobs run concurrently on one event loop, metadata syncs on their own thread pool
+ARCHIVE_CONCURRENCY = int(os.environ.get("ARCHIVE_CONCURRENCY", 2))
+METADATA_CONCURRENCY = int(os.environ.get("METADATA_CONCURRENCY", 4))
+# A metadata sync waits until its registration has had no edits for this long, merging them all
+METADATA_DEBOUNCE = float(os.environ.get("METADATA_DEBOUNCE", 5))  # seconds
+# Of the archive jobs running, how many may be downloading from OSF or uploading to IA at once
+ARCHIVE_DOWNLOAD_CONCURRENCY = int(
+    os.environ.get("ARCHIVE_DOWNLOAD_CONCURRENCY", ARCHIVE_CONCURRENCY)
+)
+ARCHIVE_UPLOAD_CONCURRENCY = int(os.environ.get("ARCHIVE_UPLOAD_CONCURRENCY", ARCHIVE_CONCURRENCY))
+# Archive jobs a batch keeps scheduled at once, so one backfill doesn't hold up everything else
+ARCHIVE_BATCH_CONCURRENCY = int(os.environ.get("ARCHIVE_BATCH_CONCURRENCY", ARCHIVE_CONCURRENCY))
+# Archive jobs only start when PIGEON_TEMP_DIR has room for them, estimated from their files
+ARCHIVE_DISK_ADMISSION = os.environ.get("ARCHIVE_DISK_ADMISSION", "true").lower() == "true"
+# a job holds its files, a bag of them and a zip of the bag on disk
+ARCHIVE_DISK_FACTOR = float(os.environ.get("ARCHIVE_DISK_FACTOR", 2.5))
+ARCHIVE_DISK_OVERHEAD = int(
+    os.environ.get("ARCHIVE_DISK_OVERHEAD", 64 * 1024 * 1024)
+)  # bytes per job, for metadata, wikis, logs and contributors
+ARCHIVE_DISK_HEADROOM = int(
+    os.environ.get("ARCHIVE_DISK_HEADROOM", 1024 * 1024 * 1024)
+)  # bytes always left free
+# how often waiting jobs recheck free space that something other than pigeon freed
+ARCHIVE_DISK_POLL = float(os.environ.get("ARCHIVE_DISK_POLL", 30))  # seconds
+# once a job has waited this long for disk space, jobs queued after it stop going around it
+ARCHIVE_DISK_MAX_WAIT = float(os.environ.get("ARCHIVE_DISK_MAX_WAIT", 3600))  # seconds
+# Skip re-archiving registrations whose IA item is current, or only update its metadata
+ARCHIVE_INCREMENTAL = os.environ.get("ARCHIVE_INCREMENTAL", "true").lower() == "true"
+# Bag each file at its path under data/files, checked against OSF's hashes, rather than bagging the
+# files service's zip of them as data/archived_files.zip
+ARCHIVE_PER_FILE = os.environ.get("ARCHIVE_PER_FILE", "false").lower() == "true"
+
+# Where state that must survive a redeploy is kept, by default the volume docker-compose mounts
+PIGEON_STATE_DIR = os.environ.get(
+    "PIGEON_STATE_DIR", "/srv" if os.access("/srv", os.W_OK) else None
+)  # None falls back to PIGEON_TEMP_DIR, which pigeon warns about on startup
+# Durable record of queued and running jobs, requeued when pigeon restarts
+JOB_STORE_PATH = os.environ.get(
+    "JOB_STORE_PATH",
+    os.path.join(
+        PIGEON_STATE_DIR or PIGEON_TEMP_DIR or tempfile.gettempdir(), "pigeon-jobs.db"
+    ),
+)
+
+# Digests computed for the bag manifests as the payload is downloaded, any of hashlib's algorithms
+BAG_CHECKSUM_ALGORITHMS = os.environ.get("BAG_CHECKSUM_ALGORITHMS", "sha256,sha512").split(",")
+PAYLOAD_WRITE_BUFFER_SIZE = int(
+    os.environ.get("PAYLOAD_WRITE_BUFFER_SIZE", 8 * 1024 * 1024)
+)  # bytes
+# Each full write buffer is hashed and written by a thread of the file's own, off the event loop.
+# A download only waits for it once this many buffers are queued
+PAYLOAD_HASH_QUEUE_SIZE = int(os.environ.get("PAYLOAD_HASH_QUEUE_SIZE", 4))  # buffers
+
+# Files that weren't hashed as they were written are hashed in parallel when bagging
+BAG_HASH_WORKERS = int(os.environ.get("BAG_HASH_WORKERS", os.cpu_count() or 1))
+BAG_HASH_BLOCK_SIZE = int(os.environ.get("BAG_HASH_BLOCK_SIZE", 8 * 1024 * 1024))  # bytes
+# Rehash the whole bag after making it, instead of only checking it's complete
+BAG_FULL_VALIDATION = os.environ.get("BAG_FULL_VALIDATION", "false").lower() == "true"
+
+# Bag zip entries with these extensions are deflated, the rest (mostly already compressed) stored
+ZIP_DEFLATE_EXTENSIONS = os.environ.get("ZIP_DEFLATE_EXTENSIONS", ".json,.xml,.txt").split(",")
+ZIP_COMPRESSION_LEVEL = int(os.environ.get("ZIP_COMPRESSION_LEVEL", 6))
+# Entries are deflated in parallel, each into a temporary file kept in memory up to this size
+ZIP_WORKERS = int(os.environ.get("ZIP_WORKERS", os.cpu_count() or 1))
+ZIP_SPOOL_SIZE = int(os.environ.get("ZIP_SPOOL_SIZE", 8 * 1024 * 1024))  # bytes
+
+# Bags at least IA_MULTIPART_THRESHOLD bytes are uploaded with the S3 multipart API, resumably
+IA_S3_URL = os.environ.get("IA_S3_URL", "https://s3.us.archive.org/")
+IA_MULTIPART_THRESHOLD = int(
+    os.environ.get("IA_MULTIPART_THRESHOLD", 512 * 1024 * 1024)
+)  # bytes
+IA_MULTIPART_PART_SIZE = int(
+    os.environ.get("IA_MULTIPART_PART_SIZE", 64 * 1024 * 1024)
+)  # bytes
+IA_MULTIPART_CONCURRENCY = int(os.environ.get("IA_MULTIPART_CONCURRENCY", 4))
+IA_MULTIPART_RETRIES = int(os.environ.get("IA_MULTIPART_RETRIES", 3))
+IA_MULTIPART_RETRY_DELAY = float(os.environ.get("IA_MULTIPART_RETRY_DELAY", 5))  # seconds
+IA_PROGRESS_INTERVAL = float(os.environ.get("IA_PROGRESS_INTERVAL", 30))  # seconds
+# Zip bags straight into a multipart upload instead of writing bag.zip to disk first. Halves the
+# disk a job needs (ARCHIVE_DISK_FACTOR can be lowered to match) but the upload can't be resumed
+IA_STREAM_UPLOAD = os.environ.get("IA_STREAM_UPLOAD", "false").lower() == "true"
+# IA item handles, with their metadata, are reused by metadata syncs for this long
+IA_ITEM_CACHE_SIZE = int(os.environ.get("IA_ITEM_CACHE_SIZE", 1024))  # entries
+IA_ITEM_CACHE_TTL = int(os.environ.get("IA_ITEM_CACHE_TTL", 60))  # seconds
+# Where multipart upload state is kept so a retried job can resume, must outlive the job and, since
+# jobs are requeued after one, a redeploy: by default PIGEON_STATE_DIR, else PIGEON_TEMP_DIR
+IA_UPLOAD_STATE_DIR = os.environ.get(
+    "IA_UPLOAD_STATE_DIR", PIGEON_STATE_DIR or PIGEON_TEMP_DIR
+)
+
 HOST = "0.0.0.0"
 PORT = 2020
 
@@ -18,3 +18,67 @@ OSF_BEARER_TOKEN = "Temple U is rated"
 
 REG_ID_TEMPLATE = f"osf-registrations-{{guid}}-{ID_VERSION}"
 PROVIDER_ID_TEMPLATE = f"osf-registration-providers-{{provider_id}}-{ID_VERSION}"
+
+PIGEON_TEMP_DIR = None
+
+OSF_CONNECTION_POOL_SIZE = 100
+OSF_CONNECTION_POOL_SIZE_PER_HOST = 20
+OSF_KEEPALIVE_TIMEOUT = 30
+OSF_DNS_CACHE_TTL = 300
+
+ARCHIVE_CONCURRENCY = 2
+METADATA_CONCURRENCY = 4
+METADATA_DEBOUNCE = 0
+ARCHIVE_DOWNLOAD_CONCURRENCY = 2
+ARCHIVE_UPLOAD_CONCURRENCY = 2
+ARCHIVE_BATCH_CONCURRENCY = 2
+ARCHIVE_DISK_ADMISSION = False
+ARCHIVE_DISK_FACTOR = 2.5
+ARCHIVE_DISK_OVERHEAD = 64 * 1024 * 1024
+ARCHIVE_DISK_HEADROOM = 1024 * 1024 * 1024
+ARCHIVE_DISK_POLL = 30
+ARCHIVE_DISK_MAX_WAIT = 3600
+ARCHIVE_INCREMENTAL = True
+ARCHIVE_PER_FILE = False
+PIGEON_STATE_DIR = None
+JOB_STORE_PATH = ":memory:"
+
+OSF_MAX_PAGES_IN_FLIGHT = 5
+OSF_MAX_RETRIES = 5
+OSF_RETRY_BACKOFF = 0
+OSF_RETRY_MAX_BACKOFF = 0
+OSF_INSTITUTION_LOOKUP_CONCURRENCY = 10
+OSF_DOWNLOAD_RANGES = True
+OSF_DOWNLOAD_SEGMENTS = 4
+OSF_DOWNLOAD_SEGMENT_SIZE = 64 * 1024 * 1024
+OSF_DOWNLOAD_PER_FILE_FALLBACK = True
+OSF_DOWNLOAD_CONCURRENCY = 8
+
+REFERENCE_CACHE_SIZE = 4096
+REFERENCE_CACHE_TTL = 3600
+
+BAG_CHECKSUM_ALGORITHMS = ["sha256", "sha512"]
+PAYLOAD_WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+PAYLOAD_HASH_QUEUE_SIZE = 4
+BAG_HASH_WORKERS = 4
+BAG_HASH_BLOCK_SIZE = 8 * 1024 * 1024
+BAG_FULL_VALIDATION = False
+
+ZIP_DEFLATE_EXTENSIONS = [".json", ".xml", ".txt"]
+ZIP_COMPRESSION_LEVEL = 6
+ZIP_WORKERS = 4
+ZIP_SPOOL_SIZE = 8 * 1024 * 1024
+
+IA_S3_URL = "https://s3.us.archive.org/"
+IA_MULTIPART_THRESHOLD = 512 * 1024 * 1024
+IA_MULTIPART_PART_SIZE = 64 * 1024 * 1024
+IA_MULTIPART_CONCURRENCY = 4
+IA_MULTIPART_RETRIES = 3
+IA_MULTIPART_RETRY_DELAY = 0
+IA_PROGRESS_INTERVAL = 30
+IA_STREAM_UPLOAD = False
+IA_ITEM_CACHE_SIZE = 1024
+IA_ITEM_CACHE_TTL = 60
+IA_UPLOAD_STATE_DIR = None
+
+BLOCKING_IO_WORKERS = 8
@@ -0,0 +1,330 @@
+import json
+import time
+import sqlite3
+import threading
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+ARCHIVE = "archive"
+METADATA = "metadata"
+
+
+class JobStore:
+    """
+    A durable record of pigeon jobs in SQLite (in WAL mode), so jobs queued or running when the
+    process stops can be requeued when it starts again.
+
+    Submitting an archive for a guid that already has one queued or running returns that job
+    instead of a new one. Submitting metadata for a guid with a sync still queued merges the new
+    metadata into it, a sync that's already running gets a new job queued behind it.
+
+    Archives can also be submitted in batches. A batch holds each guid once, linked to the archive
+    job for it, which may be one that was already pending when the guid was added.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                guid TEXT NOT NULL,
+                payload TEXT,
+                state TEXT NOT NULL,
+                error TEXT,
+                progress TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, kind, guid)"
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                provider TEXT,
+                enumerated INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS batch_jobs (
+                batch_id INTEGER NOT NULL REFERENCES batches (id),
+                guid TEXT NOT NULL,
+                job_id INTEGER NOT NULL REFERENCES jobs (id),
+                PRIMARY KEY (batch_id, guid)
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS batch_jobs_by_job ON batch_jobs (job_id)"
+        )
+
+    def close(self):
+        self._connection.close()
+
+    def _transaction(self, statements):
+        """
+        Runs `statements(cursor)` in an immediate transaction and returns its result.
+        """
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(cursor)
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+            return result
+
+    def enqueue(self, kind, guid, payload=None):
+        """
+        :return: (job_id, created) where `created` is False if the submission was deduplicated into
+        an existing job.
+        """
+        return self._transaction(lambda cursor: self._enqueue(cursor, kind, guid, payload))
+
+    @staticmethod
+    def _enqueue(cursor, kind, guid, payload=None):
+        active_states = (QUEUED, RUNNING) if kind == ARCHIVE else (QUEUED,)
+        existing = cursor.execute(
+            f"SELECT id, payload FROM jobs WHERE kind = ? AND guid = ? "
+            f"AND state IN ({', '.join('?' * len(active_states))}) ORDER BY id LIMIT 1",
+            (kind, guid, *active_states),
+        ).fetchone()
+        now = time.time()
+        encoded = json.dumps(payload) if payload is not None else None
+        if existing:
+            if payload is not None:
+                merged = {**json.loads(existing["payload"] or "{}"), **payload}
+                cursor.execute(
+                    "UPDATE jobs SET payload = ?, updated = ? WHERE id = ?",
+                    (json.dumps(merged), now, existing["id"]),
+                )
+            return existing["id"], False
+
+        cursor.execute(
+            "INSERT INTO jobs (kind, guid, payload, state, created, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, guid, encoded, QUEUED, now, now),
+        )
+        return cursor.lastrowid, True
+
+    def start(self, job_id):
+        """
+        Marks a job running.
+        :return: the job, with the payload it should run with.
+        """
+
+        def statements(cursor):
+            cursor.execute(
+                "UPDATE jobs SET state = ?, updated = ? WHERE id = ?",
+                (RUNNING, time.time(), job_id),
+            )
+            return cursor.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+        return self._as_dict(self._transaction(statements))
+
+    def finish(self, job_id, progress=None):
+        self._set_state(job_id, DONE, progress=progress)
+
+    def fail(self, job_id, error, progress=None):
+        self._set_state(job_id, FAILED, error, progress)
+
+    def _set_state(self, job_id, state, error=None, progress=None):
+        self._transaction(
+            lambda cursor: cursor.execute(
+                "UPDATE jobs SET state = ?, error = ?, progress = ?, updated = ? WHERE id = ?",
+                (state, error, json.dumps(progress), time.time(), job_id),
+            )
+        )
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._as_dict(row)
+
+    def active(self):
+        """
+        :return: every queued or running job, oldest first.
+        """
+        return self._select(
+            "SELECT * FROM jobs WHERE state IN (?, ?) ORDER BY id", (QUEUED, RUNNING)
+        )
+
+    def for_guid(self, guid):
+        """
+        :return: every job for `guid`, newest first.
+        """
+        return self._select("SELECT * FROM jobs WHERE guid = ? ORDER BY id DESC", (guid,))
+
+    def queue_position(self, job):
+        """
+        :return: the place of a queued `job` among queued jobs of its kind, 1 being the next to
+        start.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE kind = ? AND state = ? AND id <= ?",
+                (job["kind"], QUEUED, job["id"]),
+            ).fetchone()
+        return row[0]
+
+    def queued_counts(self):
+        """
+        :return: how many jobs of each kind are queued, including batch jobs not scheduled yet.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT kind, COUNT(*) FROM jobs WHERE state = ? GROUP BY kind", (QUEUED,)
+            ).fetchall()
+        return {ARCHIVE: 0, METADATA: 0, **{kind: count for kind, count in rows}}
+
+    def _select(self, query, parameters):
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return [self._as_dict(row) for row in rows]
+
+    def create_batch(self, provider=None):
+        """
+        :param provider: the registration provider whose registrations the batch will archive, if
+        it's not a list of guids.
+        :return: the new batch's id
+        """
+        return self._transaction(
+            lambda cursor: cursor.execute(
+                "INSERT INTO batches (provider, created) VALUES (?, ?)", (provider, time.time())
+            ).lastrowid
+        )
+
+    def add_to_batch(self, batch_id, guids):
+        """
+        Queues an archive for each of `guids` not already in the batch.
+        :return: how many guids were added
+        """
+
+        def statements(cursor):
+            added = 0
+            for guid in guids:
+                if cursor.execute(
+                    "SELECT 1 FROM batch_jobs WHERE batch_id = ? AND guid = ?", (batch_id, guid)
+                ).fetchone():
+                    continue
+                job_id, _ = self._enqueue(cursor, ARCHIVE, guid)
+                cursor.execute(
+                    "INSERT INTO batch_jobs (batch_id, guid, job_id) VALUES (?, ?, ?)",
+                    (batch_id, guid, job_id),
+                )
+                added += 1
+            return added
+
+        return self._transaction(statements)
+
+    def finish_enumerating(self, batch_id):
+        """
+        Marks every guid of the batch added.
+        """
+        self._transaction(
+            lambda cursor: cursor.execute(
+                "UPDATE batches SET enumerated = 1 WHERE id = ?", (batch_id,)
+            )
+        )
+
+    def get_batch(self, batch_id):
+        """
+        :return: the batch, with how many of its jobs are in each state, or None.
+        """
+        with self._lock:
+            batch = self._connection.execute(
+                "SELECT * FROM batches WHERE id = ?", (batch_id,)
+            ).fetchone()
+            if batch is None:
+                return None
+            counts = self._connection.execute(
+                "SELECT jobs.state, COUNT(*) FROM batch_jobs "
+                "JOIN jobs ON jobs.id = batch_jobs.job_id "
+                "WHERE batch_jobs.batch_id = ? GROUP BY jobs.state",
+                (batch_id,),
+            ).fetchall()
+        jobs = {state: 0 for state in (QUEUED, RUNNING, DONE, FAILED)}
+        jobs.update({state: count for state, count in counts})
+        return {
+            **dict(batch),
+            "enumerated": bool(batch["enumerated"]),
+            "total": sum(jobs.values()),
+            "jobs": jobs,
+        }
+
+    def batch_job_ids(self, batch_id, state=QUEUED):
+        """
+        :return: the ids of the batch's jobs in `state`, in the order they were added.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT jobs.id FROM batch_jobs JOIN jobs ON jobs.id = batch_jobs.job_id "
+                "WHERE batch_jobs.batch_id = ? AND jobs.state = ? ORDER BY batch_jobs.rowid",
+                (batch_id, state),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def unfinished_batches(self):
+        """
+        :return: the ids of batches still being enumerated or with jobs queued or running.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id FROM batches WHERE NOT enumerated OR EXISTS ("
+                "SELECT 1 FROM batch_jobs JOIN jobs ON jobs.id = batch_jobs.job_id "
+                "WHERE batch_jobs.batch_id = batches.id AND jobs.state IN (?, ?)"
+                ") ORDER BY id",
+                (QUEUED, RUNNING),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def unfinished(self):
+        """
+        :return: every job that was queued or running and isn't part of a batch, oldest first, all
+        marked queued again. Running jobs in batches are marked queued again too, they're resumed
+        with their batch (see `unfinished_batches`).
+        """
+
+        def statements(cursor):
+            rows = cursor.execute(
+                "SELECT * FROM jobs WHERE state IN (?, ?) "
+                "AND id NOT IN (SELECT job_id FROM batch_jobs) ORDER BY id",
+                (QUEUED, RUNNING),
+            ).fetchall()
+            cursor.execute(
+                "UPDATE jobs SET state = ?, updated = ? WHERE state = ?",
+                (QUEUED, time.time(), RUNNING),
+            )
+            return rows
+
+        return [self._as_dict(row, state=QUEUED) for row in self._transaction(statements)]
+
+    @staticmethod
+    def _as_dict(row, **overrides):
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"]) if job["payload"] else None
+        job["progress"] = json.loads(job["progress"]) if job["progress"] else None
+        job.update(overrides)
+        return job
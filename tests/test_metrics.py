@@ -0,0 +1,61 @@
+import json
+
+import pytest
+from aioresponses import aioresponses
+from prometheus_client import REGISTRY
+
+from osf_pigeon import metrics
+from osf_pigeon import settings
+from osf_pigeon.metrics import endpoint_kind
+from osf_pigeon.pigeon import get_with_retry
+from osf_pigeon.store import JobStore, ARCHIVE, METADATA
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestMetrics:
+    @pytest.mark.parametrize(
+        "path, kind",
+        [
+            ("v2/registrations/guid0/?embed=parent&version=2.20", "registration"),
+            ("v2/registrations/guid0/logs/?page[size]=100", "logs"),
+            ("v2/registrations/guid0/wikis/?page=2&page=2", "wikis"),
+            ("v2/registrations/guid0/contributors/", "contributors"),
+            ("v2/registrations/guid0/institutions/", "institutions"),
+            ("v2/users/user0/institutions/", "institutions"),
+            ("v2/registrations/guid0/subjects/", "other"),
+            ("v2/users/user0/", "other"),
+        ],
+    )
+    def test_endpoint_kind(self, path, kind):
+        assert endpoint_kind(f"{settings.OSF_API_URL}{path}") == kind
+
+    async def test_requests_are_measured(self):
+        url = f"{settings.OSF_API_URL}v2/registrations/guid0/logs/"
+        requests_before = sample("pigeon_osf_request_seconds_count", endpoint="logs")
+        rate_limited_before = sample("pigeon_osf_rate_limited_total", endpoint="logs")
+        sleep_before = sample("pigeon_osf_retry_sleep_seconds_total")
+
+        with aioresponses() as m:
+            m.get(url, status=429, headers={"Retry-After": "0.01"})
+            m.get(url, body=json.dumps({"data": []}))
+            await get_with_retry(url, retry_on=(429,))
+
+        assert sample("pigeon_osf_request_seconds_count", endpoint="logs") == requests_before + 2
+        assert sample("pigeon_osf_rate_limited_total", endpoint="logs") == rate_limited_before + 1
+        assert sample("pigeon_osf_retry_sleep_seconds_total") == pytest.approx(
+            sleep_before + 0.01
+        )
+
+    def test_queued_jobs_are_counted_from_the_store(self, monkeypatch):
+        store = JobStore(":memory:")
+        monkeypatch.setattr(metrics.JOBS_QUEUED, "store", store)
+        for i in range(3):  # e.g. a batch, only a few of whose jobs are scheduled at a time
+            store.enqueue(ARCHIVE, f"guid{i}")
+        running, _ = store.enqueue(METADATA, "guid0")
+        store.start(running)
+
+        assert sample("pigeon_jobs_queued", kind=ARCHIVE) == 3
+        assert sample("pigeon_jobs_queued", kind=METADATA) == 0
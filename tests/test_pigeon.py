@@ -1,19 +1,58 @@
 import os
+import re
 import json
+import shutil
+import bagit
+import hashlib
+import time
+import random
+import asyncio
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import mock
 import pytest
+import requests
+import responses
+from urllib.parse import urlparse, parse_qs
+from functools import partial
 from osf_pigeon import settings
+from osf_pigeon import pigeon
 
 import tempfile
+from aiohttp import ClientResponseError
 from osf_pigeon.pigeon import (
+    BagPayload,
+    JobProgress,
+    MultipartStream,
+    ReferenceCache,
+    Throttle,
+    create_session,
+    create_zip,
+    download_archived_files,
+    download_files_to_dir,
+    download_range,
+    get_first_page,
+    get_range_size,
+    get_paginated_data,
+    make_bag,
+    iter_pages,
+    get_with_retry,
+    run_in_thread,
+    stage,
+    tracking,
     stream_files_to_dir,
     dump_json_to_dir,
     get_metadata_for_ia_item,
     get_additional_contributor_info,
     sync_metadata,
     upload,
+    upload_multipart,
+    get_upload_state_path,
+    save_upload_state,
     write_datacite_metadata,
 )
-from aioresponses import aioresponses
+from aioresponses import aioresponses, CallbackResult
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
@@ -48,6 +87,529 @@ class TestStreamFilesToDir:
             assert os.listdir(temp_dir)[0] == zip_name
             assert open(os.path.join(temp_dir, zip_name), "rb").read() == zip_data
 
+    @pytest.fixture
+    def zip_url(self, guid):
+        return f"{settings.OSF_FILES_URL}v1/resources/{guid}/providers/osfstorage/?zip="
+
+    @staticmethod
+    def serve_ranges(data, ranges, honour_range=True, cut_off=()):
+        """
+        Serves `data`, or the bytes of it in the `Range` header, recording the ranges asked for.
+        The responses numbered in `cut_off` break off halfway.
+        """
+
+        def callback(url, headers=None, **kwargs):
+            ranges.append((headers or {}).get("Range"))
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", ranges[-1] or "")
+            if not (match and honour_range):
+                body, status, response_headers = data, 200, {}
+            else:
+                start, end = int(match.group(1)), int(match.group(2) or len(data) - 1)
+                body, status = data[start:end + 1], 206
+                response_headers = {"Content-Range": f"bytes {start}-{end}/{len(data)}"}
+            if len(ranges) - 1 in cut_off:
+                body = body[: len(body) // 2]
+            return CallbackResult(status=status, body=body, headers=response_headers)
+
+        return callback
+
+    async def test_ranges_are_downloaded_in_parallel(self, guid, zip_name, zip_data, zip_url):
+        ranges = []
+        with tempfile.TemporaryDirectory() as temp_dir, aioresponses() as m:
+            m.head(
+                zip_url,
+                headers={"Accept-Ranges": "bytes", "Content-Length": str(len(zip_data))},
+            )
+            m.get(zip_url, callback=self.serve_ranges(zip_data, ranges), repeat=True)
+            with mock.patch.object(settings, "OSF_DOWNLOAD_SEGMENT_SIZE", 10):
+                await download_archived_files(guid, temp_dir, zip_name)
+
+            with open(os.path.join(temp_dir, zip_name), "rb") as fp:
+                assert fp.read() == zip_data
+        assert sorted(ranges) == ["bytes=0-9", "bytes=10-19", "bytes=20-24"]
+
+    @pytest.mark.parametrize(
+        "status, headers, size",
+        [
+            (200, {"Accept-Ranges": "bytes", "Content-Length": "25"}, 25),
+            (200, {"Accept-Ranges": "none", "Content-Length": "25"}, None),
+            (200, {"Accept-Ranges": "bytes"}, None),
+            (405, {"Accept-Ranges": "bytes", "Content-Length": "25"}, None),
+        ],
+    )
+    async def test_range_size(self, zip_url, status, headers, size):
+        with aioresponses() as m:
+            m.head(zip_url, status=status, headers=headers)
+            async with create_session() as session:
+                assert await get_range_size(zip_url, session) == size
+
+    async def test_rate_limited_downloads_are_retried(self, zip_url, zip_data):
+        ranges = []
+        with tempfile.TemporaryFile() as fp, aioresponses() as m:
+            m.get(zip_url, status=429, headers={"Retry-After": "0"})
+            m.get(zip_url, callback=self.serve_ranges(zip_data, ranges))
+            with tracking(JobProgress()) as progress:
+                await download_range(zip_url, fp, end=len(zip_data) - 1)
+
+            fp.seek(0)
+            assert fp.read() == zip_data
+        assert progress.retries == 1
+
+    @pytest.mark.parametrize("honour_range", [True, False])
+    async def test_broken_downloads_resume(self, zip_url, zip_data, honour_range):
+        ranges = []
+        with tempfile.TemporaryFile() as fp, aioresponses() as m:
+            m.get(
+                zip_url,
+                callback=self.serve_ranges(zip_data, ranges, honour_range, cut_off=[0]),
+                repeat=True,
+            )
+            with tracking(JobProgress()) as progress:
+                await download_range(zip_url, fp, end=len(zip_data) - 1)
+
+            fp.seek(0)
+            assert fp.read() == zip_data
+        assert ranges == ["bytes=0-24", "bytes=12-24"]
+        assert progress.retries == 1
+
+    async def test_files_are_zipped_without_ranges(self, guid, zip_name, zip_url):
+        listing = f"{settings.OSF_API_URL}v2/registrations/{guid}/files/osfstorage/"
+        files = {"/Jalen Hurts.txt": b"QB1", "/receivers/DeVonta Smith.bin": b"WR" * 100}
+        with tempfile.TemporaryDirectory() as temp_dir, aioresponses() as m:
+            m.head(zip_url)  # no Accept-Ranges
+            m.get(
+                listing,
+                body=json.dumps(
+                    {
+                        "data": [
+                            {
+                                "attributes": {
+                                    "kind": "file",
+                                    "name": os.path.basename(path),
+                                    "materialized_path": path,
+                                    "size": len(data),
+                                    "extra": {
+                                        "hashes": {"sha256": hashlib.sha256(data).hexdigest()}
+                                    },
+                                },
+                                "links": {"download": f"{settings.OSF_FILES_URL}{index}"},
+                            }
+                            for index, (path, data) in enumerate(files.items())
+                        ],
+                        "links": {"next": None},
+                    }
+                ),
+            )
+            m.get(f"{settings.OSF_FILES_URL}0", body=b"QB2")  # doesn't match, downloaded again
+            for index, data in enumerate(files.values()):
+                m.get(f"{settings.OSF_FILES_URL}{index}", body=data)
+            payload = BagPayload(temp_dir)
+            await download_archived_files(guid, temp_dir, zip_name, payload=payload)
+
+            with zipfile.ZipFile(os.path.join(temp_dir, zip_name)) as zip_file:
+                assert {info.filename: zip_file.read(info) for info in zip_file.infolist()} == {
+                    "Jalen Hurts.txt": b"QB1",
+                    "receivers/DeVonta Smith.bin": b"WR" * 100,
+                }
+            assert os.listdir(temp_dir) == [zip_name]
+            assert zip_name in payload.entries
+
+            # without OSF_DOWNLOAD_RANGES the files service isn't even asked
+            with mock.patch.object(settings, "OSF_DOWNLOAD_RANGES", False), mock.patch(
+                "osf_pigeon.pigeon.get_range_size"
+            ) as mock_get_range_size, mock.patch(
+                "osf_pigeon.pigeon.download_files_as_zip"
+            ) as mock_download_files_as_zip:
+                await download_archived_files(guid, temp_dir, zip_name)
+            mock_get_range_size.assert_not_called()
+            mock_download_files_as_zip.assert_called_once()
+
+            # and without the fallback, the zip is streamed as one download
+            with mock.patch.object(settings, "OSF_DOWNLOAD_RANGES", False), mock.patch.object(
+                settings, "OSF_DOWNLOAD_PER_FILE_FALLBACK", False
+            ), mock.patch(
+                "osf_pigeon.pigeon.download_files_as_zip"
+            ) as mock_download_files_as_zip, mock.patch(
+                "osf_pigeon.pigeon.stream_files_to_dir"
+            ) as mock_stream_files_to_dir:
+                await download_archived_files(guid, temp_dir, zip_name)
+            mock_download_files_as_zip.assert_not_called()
+            mock_stream_files_to_dir.assert_called_once()
+
+
+class TestDownloadFilesToDir:
+    @pytest.fixture
+    def files(self):
+        return {
+            "/Jason Peters.txt": b"LT",
+            "/line/Brandon Brooks.txt": b"RG" * 100,
+        }
+
+    @pytest.fixture
+    def payload(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            payload = BagPayload(os.path.join(temp_dir, "bag"))
+            os.makedirs(payload.data_dir)
+            yield payload
+
+    @pytest.fixture
+    def mock_osf(self, files):
+        listing = f"{settings.OSF_API_URL}v2/registrations/guid0/files/osfstorage/"
+        with aioresponses() as m:
+            m.get(
+                listing,
+                body=json.dumps(
+                    {
+                        "data": [
+                            {
+                                "attributes": {
+                                    "kind": "file",
+                                    "name": os.path.basename(path),
+                                    "materialized_path": path,
+                                    "size": len(data),
+                                    "extra": {
+                                        "hashes": {
+                                            "md5": hashlib.md5(data).hexdigest(),
+                                            "sha256": hashlib.sha256(data).hexdigest(),
+                                        }
+                                    },
+                                },
+                                "links": {"download": f"{settings.OSF_FILES_URL}{index}"},
+                            }
+                            for index, (path, data) in enumerate(files.items())
+                        ],
+                        "links": {"next": None},
+                    }
+                ),
+            )
+            yield m
+
+    def download_count(self, mock_osf, index):
+        return sum(
+            len(calls)
+            for (method, url), calls in mock_osf.requests.items()
+            if str(url) == f"{settings.OSF_FILES_URL}{index}"
+        )
+
+    async def test_files_are_bagged_by_path(self, mock_osf, files, payload):
+        for index, data in enumerate(files.values()):
+            mock_osf.get(f"{settings.OSF_FILES_URL}{index}", body=data)
+        files_dir = os.path.join(payload.data_dir, "files")
+        await download_files_to_dir("guid0", files_dir, payload)
+
+        bag = make_bag(payload.bag_dir, payload)
+        assert sorted(bag.payload_files()) == [
+            os.path.join("data", "files", "Jason Peters.txt"),
+            os.path.join("data", "files", "line", "Brandon Brooks.txt"),
+        ]
+        with open(os.path.join(files_dir, "line", "Brandon Brooks.txt"), "rb") as fp:
+            assert fp.read() == b"RG" * 100
+
+    async def test_only_files_that_fail_are_downloaded_again(self, mock_osf, files, payload):
+        mock_osf.get(f"{settings.OSF_FILES_URL}0", body=b"LT")
+        mock_osf.get(f"{settings.OSF_FILES_URL}1", body=b"RT" * 100)  # corrupted on the way
+        mock_osf.get(f"{settings.OSF_FILES_URL}1", body=b"RG" * 100)
+        with tracking(JobProgress()) as progress:
+            await download_files_to_dir("guid0", payload.data_dir, payload)
+
+        assert self.download_count(mock_osf, 0) == 1
+        assert self.download_count(mock_osf, 1) == 2
+        assert progress.retries == 1
+        assert sorted(payload.entries) == [
+            os.path.join("data", "Jason Peters.txt"),
+            os.path.join("data", "line", "Brandon Brooks.txt"),
+        ]
+
+    async def test_files_that_never_match_fail_the_download(self, mock_osf, payload):
+        mock_osf.get(f"{settings.OSF_FILES_URL}0", body=b"LT")
+        mock_osf.get(f"{settings.OSF_FILES_URL}1", body=b"RT" * 100, repeat=True)
+        with mock.patch.object(settings, "OSF_MAX_RETRIES", 1):
+            with pytest.raises(bagit.BagValidationError):
+                await download_files_to_dir("guid0", payload.data_dir, payload)
+
+        assert self.download_count(mock_osf, 1) == 2
+        assert list(payload.entries) == [os.path.join("data", "Jason Peters.txt")]
+
+
+class TestMakeBag:
+    @pytest.fixture
+    def temp_dir(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            yield temp_dir
+
+    @pytest.fixture
+    def payload(self, temp_dir):
+        payload = BagPayload(os.path.join(temp_dir, "bag"))
+        os.makedirs(os.path.join(payload.data_dir, "files"))
+        with payload.open(os.path.join(payload.data_dir, "registration.json")) as fp:
+            json.dump({"title": "Fletcher Cox"}, fp)
+        with payload.open(os.path.join(payload.data_dir, "archived_files.zip")) as fp:
+            fp.write(b"Jason Kelce" * 1000)
+        # written without the payload, so it has to be hashed when bagged
+        with open(os.path.join(payload.data_dir, "files", "notes.txt"), "w") as fp:
+            fp.write("Lane Johnson")
+        return payload
+
+    def test_bag_matches_bagit(self, temp_dir, payload):
+        reference_dir = os.path.join(temp_dir, "reference")
+        shutil.copytree(payload.data_dir, reference_dir)
+        bagit.make_bag(reference_dir)
+
+        make_bag(payload.bag_dir, payload)
+
+        for name in [
+            "bagit.txt",
+            "bag-info.txt",
+            "manifest-sha256.txt",
+            "manifest-sha512.txt",
+        ]:
+            with open(os.path.join(payload.bag_dir, name), "rb") as fp:
+                with open(os.path.join(reference_dir, name), "rb") as reference_fp:
+                    assert fp.read() == reference_fp.read()
+        for name in ["tagmanifest-sha256.txt", "tagmanifest-sha512.txt"]:
+            with open(os.path.join(payload.bag_dir, name)) as fp:
+                with open(os.path.join(reference_dir, name)) as reference_fp:
+                    assert sorted(fp) == sorted(reference_fp)
+
+        assert bagit.Bag(payload.bag_dir).is_valid()
+
+    def test_payload_is_not_read_back(self, payload):
+        with mock.patch(
+            "osf_pigeon.pigeon.hash_file", wraps=pigeon.hash_file
+        ) as mock_hash_file:
+            make_bag(payload.bag_dir, payload)
+
+        hashed = [call[0][0] for call in mock_hash_file.call_args_list]
+        assert os.path.join(payload.data_dir, "files", "notes.txt") in hashed
+        assert not [path for path in hashed if path.endswith((".json", ".zip"))]
+
+    async def test_stream_files_hashes_on_download(self, temp_dir):
+        payload = BagPayload(temp_dir)
+        with aioresponses() as m:
+            m.get(f"{settings.OSF_FILES_URL}zip", body=b"Brandon Graham")
+            await stream_files_to_dir(
+                f"{settings.OSF_FILES_URL}zip", temp_dir, "files.zip", payload=payload
+            )
+
+        assert payload.entries["files.zip"] == (
+            {
+                "sha256": hashlib.sha256(b"Brandon Graham").hexdigest(),
+                "sha512": hashlib.sha512(b"Brandon Graham").hexdigest(),
+            },
+            len(b"Brandon Graham"),
+        )
+
+    def test_full_blocks_are_hashed_off_the_writers_thread(self, temp_dir):
+        payload = BagPayload(temp_dir)
+        data = [os.urandom(1000) for _ in range(10)]
+        threads = []
+        write_block = pigeon.HashingFile._write_block
+
+        def record_thread(self, block):
+            threads.append(threading.current_thread())
+            write_block(self, block)
+
+        with mock.patch.object(settings, "PAYLOAD_WRITE_BUFFER_SIZE", 2500), mock.patch.object(
+            settings, "PAYLOAD_HASH_QUEUE_SIZE", 1
+        ), mock.patch.object(pigeon.HashingFile, "_write_block", record_thread):
+            with payload.open(os.path.join(temp_dir, "data.bin")) as fp:
+                for chunk in data:
+                    fp.write(chunk)
+
+        assert threads[-1] == threading.current_thread()  # the part block, when it's closed
+        assert threading.current_thread() not in threads[:-1]
+        assert len(threads) == 4
+        with open(os.path.join(temp_dir, "data.bin"), "rb") as fp:
+            assert fp.read() == b"".join(data)
+        assert payload.entries["data.bin"] == (
+            {
+                "sha256": hashlib.sha256(b"".join(data)).hexdigest(),
+                "sha512": hashlib.sha512(b"".join(data)).hexdigest(),
+            },
+            10000,
+        )
+
+    def test_failed_block_writes_are_raised(self, temp_dir):
+        payload = BagPayload(temp_dir)
+        with mock.patch.object(settings, "PAYLOAD_WRITE_BUFFER_SIZE", 10), mock.patch.object(
+            pigeon.HashingFile, "_write_block", side_effect=OSError("No space left on device")
+        ):
+            with pytest.raises(OSError):
+                with payload.open(os.path.join(temp_dir, "data.bin")) as fp:
+                    for _ in range(10):
+                        fp.write(b"0123456789")
+        assert not payload.entries
+
+    async def test_configured_digests_go_into_the_manifest(self, temp_dir):
+        with mock.patch.object(settings, "BAG_CHECKSUM_ALGORITHMS", ["md5", "sha256"]):
+            payload = BagPayload(os.path.join(temp_dir, "bag"))
+        os.makedirs(payload.data_dir)
+        with aioresponses() as m:
+            m.get(f"{settings.OSF_FILES_URL}zip", body=b"Darius Slay")
+            await stream_files_to_dir(
+                f"{settings.OSF_FILES_URL}zip",
+                payload.data_dir,
+                "archived_files.zip",
+                payload=payload,
+            )
+
+        with mock.patch("osf_pigeon.pigeon.hash_file", wraps=pigeon.hash_file) as mock_hash:
+            make_bag(payload.bag_dir, payload)
+
+        # only the tag files are hashed for the tagmanifests
+        assert not [
+            call for call in mock_hash.call_args_list if "data" in call[0][0].split(os.sep)
+        ]
+        assert sorted(
+            name for name in os.listdir(payload.bag_dir) if name.startswith("manifest-")
+        ) == ["manifest-md5.txt", "manifest-sha256.txt"]
+        with open(os.path.join(payload.bag_dir, "manifest-md5.txt")) as fp:
+            assert fp.read() == (
+                f"{hashlib.md5(b'Darius Slay').hexdigest()}  data/archived_files.zip\n"
+            )
+        assert bagit.Bag(payload.bag_dir).is_valid()
+
+    def test_unhashed_files_are_hashed_in_parallel(self, temp_dir):
+        payload = BagPayload(os.path.join(temp_dir, "bag"))
+        os.makedirs(payload.data_dir)
+        for i in range(8):
+            with open(os.path.join(payload.data_dir, f"file{i}"), "wb") as fp:
+                fp.write(os.urandom(1024))
+
+        threads = set()
+
+        def slow_hash_file(path, algorithms):
+            threads.add(threading.current_thread().name)
+            time.sleep(0.02)
+            return hash_file(path, algorithms)
+
+        hash_file = pigeon.hash_file
+        with mock.patch("osf_pigeon.pigeon.hash_file", side_effect=slow_hash_file):
+            make_bag(payload.bag_dir, payload)
+
+        assert len(threads) > 1
+        assert len(payload.entries) == 8
+        assert bagit.Bag(payload.bag_dir).is_valid()
+
+    def test_full_validation_catches_bad_digests(self, payload):
+        payload.entries["data/registration.json"][0]["sha256"] = "0" * 64
+        with mock.patch.object(settings, "BAG_FULL_VALIDATION", True):
+            with pytest.raises(bagit.BagValidationError) as exc:
+                make_bag(payload.bag_dir, payload)
+
+        assert [detail.path for detail in exc.value.details] == ["data/registration.json"]
+
+
+class TestCreateZip:
+    @pytest.fixture
+    def temp_dir(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            data_dir = os.path.join(temp_dir, "bag", "data")
+            os.makedirs(data_dir)
+            with open(os.path.join(data_dir, "archived_files.zip"), "wb") as fp:
+                fp.write(os.urandom(100000))
+            for name in ["registration.json", "logs.json", "datacite.xml"]:
+                with open(os.path.join(data_dir, name), "w") as fp:
+                    json.dump([{"action": "Jalen Hurts"}] * 1000, fp)
+            with open(os.path.join(temp_dir, "bag", "bagit.txt"), "w") as fp:
+                fp.write("BagIt-Version: 0.97\n")
+            yield temp_dir
+
+    def read_zip(self, temp_dir):
+        with zipfile.ZipFile(os.path.join(temp_dir, "bag.zip")) as zip_file:
+            assert zip_file.testzip() is None
+            return {
+                info.filename: (info.compress_type, zip_file.read(info))
+                for info in zip_file.infolist()
+            }
+
+    def test_entries_are_compressed_by_type(self, temp_dir):
+        create_zip(temp_dir)
+
+        entries = self.read_zip(temp_dir)
+        assert [name for name in entries] == [
+            os.path.relpath(os.path.join(root, file), temp_dir)
+            for root, dirs, files in os.walk(os.path.join(temp_dir, "bag"))
+            for file in files
+        ]
+        for name, (compress_type, data) in entries.items():
+            with open(os.path.join(temp_dir, name), "rb") as fp:
+                assert data == fp.read()
+            expected = zipfile.ZIP_STORED if name.endswith(".zip") else zipfile.ZIP_DEFLATED
+            assert compress_type == expected
+        assert os.path.getsize(os.path.join(temp_dir, "bag.zip")) < 110000
+
+    def test_entries_are_deflated_in_parallel(self, temp_dir):
+        threads = set()
+
+        def slow_deflate_file(*args):
+            threads.add(threading.current_thread().name)
+            time.sleep(0.02)
+            return deflate_file(*args)
+
+        deflate_file = pigeon.deflate_file
+        with mock.patch("osf_pigeon.pigeon.deflate_file", side_effect=slow_deflate_file):
+            create_zip(temp_dir)
+
+        assert len(threads) > 1
+        assert len(self.read_zip(temp_dir)) == 5
+
+    def test_deflating_stays_close_to_the_writer(self, temp_dir):
+        for index in range(20):
+            with open(os.path.join(temp_dir, "bag", "data", f"wiki{index}.json"), "w") as fp:
+                json.dump({"content": "Jason Kelce"}, fp)
+        counts = {"deflated": 0, "written": 0}
+        ahead = []
+
+        def counting_deflate_file(*args):
+            counts["deflated"] += 1
+            ahead.append(counts["deflated"] - counts["written"])
+            return deflate_file(*args)
+
+        def counting_write_deflated(*args):
+            counts["written"] += 1
+            return write_deflated(*args)
+
+        deflate_file, write_deflated = pigeon.deflate_file, pigeon.write_deflated
+        with mock.patch.object(settings, "ZIP_WORKERS", 1), mock.patch(
+            "osf_pigeon.pigeon.deflate_file", side_effect=counting_deflate_file
+        ), mock.patch("osf_pigeon.pigeon.write_deflated", side_effect=counting_write_deflated):
+            create_zip(temp_dir)
+
+        assert counts == {"deflated": 24, "written": 24}
+        assert max(ahead) <= 2
+        assert len(self.read_zip(temp_dir)) == 25
+
+    def test_large_entries_use_zip64(self, temp_dir):
+        with mock.patch.object(zipfile, "ZIP64_LIMIT", 1000):
+            create_zip(temp_dir)
+
+        with zipfile.ZipFile(os.path.join(temp_dir, "bag.zip")) as zip_file:
+            info = zip_file.getinfo("bag/data/logs.json")
+        assert info.file_size > 1000
+        assert info.extract_version >= zipfile.ZIP64_VERSION
+        assert len(self.read_zip(temp_dir)) == 5
+
+    def test_zip_can_be_written_to_a_stream(self, temp_dir):
+        class Stream:  # write only, like an upload
+            def __init__(self):
+                self.data = bytearray()
+
+            def write(self, data):
+                self.data += data
+                return len(data)
+
+            def flush(self):
+                pass
+
+        stream = Stream()
+        create_zip(temp_dir, stream)
+
+        assert not os.path.exists(os.path.join(temp_dir, "bag.zip"))
+        with open(os.path.join(temp_dir, "bag.zip"), "wb") as fp:
+            fp.write(stream.data)
+        assert len(self.read_zip(temp_dir)) == 5
+
 
 class TestDumpJSONFilesToDir:
     @pytest.fixture
@@ -133,6 +695,320 @@ class TestDumpJSONFilesToDirMultipage:
                 assert info == expected_json
 
 
+class TestPagination:
+    @pytest.fixture
+    def url(self):
+        return f"{settings.OSF_API_URL}v2/registrations/guid0/logs/"
+
+    @pytest.fixture
+    def page_count(self):
+        return 20
+
+    @pytest.fixture
+    def mock_pages(self, url, page_count):
+        in_flight = []
+        stats = {"peak": [], "fetched": []}
+
+        async def mock_get_with_retry(page_url, session=None, throttle=None, **kwargs):
+            page = int(re.search(r"page=(\d+)", page_url).group(1)) if "?" in page_url else 1
+            in_flight.append(page)
+            stats["peak"].append(len(in_flight))
+            await asyncio.sleep(random.uniform(0, 0.01))
+            in_flight.remove(page)
+            stats["fetched"].append(page)
+            return {
+                "data": [{"id": f"{page}-{i}"} for i in range(10)],
+                "links": {
+                    "next": f"{url}?page={page + 1}" if page < page_count else None,
+                    "meta": {"total": page_count * 10, "per_page": 10},
+                },
+            }
+
+        with mock.patch(
+            "osf_pigeon.pigeon.get_with_retry", side_effect=mock_get_with_retry
+        ):
+            yield stats
+
+    async def test_pages_in_flight_are_bounded(self, url, mock_pages, page_count):
+        with mock.patch.object(settings, "OSF_MAX_PAGES_IN_FLIGHT", 3):
+            data = await get_paginated_data(url)
+
+        assert max(mock_pages["peak"]) == 3
+        assert [item["id"] for item in data] == [
+            f"{page}-{i}" for page in range(1, page_count + 1) for i in range(10)
+        ]
+
+    async def test_pages_are_streamed_to_disk(self, url, mock_pages, page_count):
+        with mock.patch.object(settings, "OSF_MAX_PAGES_IN_FLIGHT", 3):
+            expected = await get_paginated_data(url)
+            with tempfile.TemporaryDirectory() as temp_dir:
+                await dump_json_to_dir(url, temp_dir, "logs.json")
+                with open(os.path.join(temp_dir, "logs.json")) as fp:
+                    assert fp.read() == json.dumps(expected)
+
+    async def test_pages_buffered_are_bounded(self, url, mock_pages, page_count):
+        with mock.patch.object(settings, "OSF_MAX_PAGES_IN_FLIGHT", 3):
+            async with create_session() as session:
+                throttle = Throttle(3)
+                data, is_paginated = await get_first_page(url, None, session, throttle)
+                assert is_paginated
+
+                consumed = 0
+                async for _ in iter_pages(url, data, None, session, throttle):
+                    consumed += 1
+                    await asyncio.sleep(0.02)  # a slow consumer
+                    assert len(mock_pages["fetched"]) - consumed <= 3
+
+        assert consumed == page_count
+
+    async def test_concurrent_paginations_are_isolated(self):
+        async def mock_get_with_retry(page_url, session=None, throttle=None, **kwargs):
+            guid = re.search(r"registrations/(\w+)/", page_url).group(1)
+            page = int(re.search(r"page=(\d+)", page_url).group(1)) if "?" in page_url else 1
+            await asyncio.sleep(random.uniform(0, 0.005))
+            return {
+                "data": [f"{guid}-{page}-{i}" for i in range(3)],
+                "links": {
+                    "next": "next" if page == 1 else None,
+                    "meta": {"total": 3 * len(guid), "per_page": 3},
+                },
+            }
+
+        # guids of different lengths have different page counts
+        guids = [f"guid{'x' * (i % 7)}{i}" for i in range(100)]
+        with mock.patch(
+            "osf_pigeon.pigeon.get_with_retry", side_effect=mock_get_with_retry
+        ):
+            async with create_session() as session:
+                results = await asyncio.gather(
+                    *[
+                        get_paginated_data(
+                            f"{settings.OSF_API_URL}v2/registrations/{guid}/logs/",
+                            session=session,
+                        )
+                        for guid in guids
+                    ]
+                )
+
+        for guid, result in zip(guids, results):
+            assert result == [
+                f"{guid}-{page}-{i}" for page in range(1, len(guid) + 1) for i in range(3)
+            ]
+
+    async def test_retry_after(self, url):
+        with aioresponses() as m:
+            m.get(url, status=429, headers={"Retry-After": "0"})
+            m.get(url, status=429)
+            m.get(url, body=json.dumps({"data": []}))
+            data = await get_with_retry(url, retry_on=(429,))
+
+        assert data == {"data": []}
+
+    async def test_retry_gives_up(self, url):
+        with mock.patch.object(settings, "OSF_MAX_RETRIES", 1):
+            with aioresponses() as m:
+                m.get(url, status=429, headers={"Retry-After": "0"})
+                m.get(url, status=429, headers={"Retry-After": "0"})
+                with pytest.raises(ClientResponseError):
+                    await get_with_retry(url, retry_on=(429,))
+
+    async def test_provider_registrations(self):
+        url = (
+            f"{settings.OSF_API_URL}v2/providers/registrations/osf/registrations/?page[size]=100"
+        )
+
+        def page(guids, page_number):
+            return json.dumps(
+                {
+                    "data": [{"id": guid} for guid in guids],
+                    "links": {
+                        "next": f"{url}&page=2" if page_number == 1 else None,
+                        "meta": {"total": 3, "per_page": 2},
+                    },
+                }
+            )
+
+        with aioresponses() as m:
+            m.get(url, body=page(["guid0", "guid1"], 1))
+            m.get(f"{url}&page=2&page=2", body=page(["guid2"], 2))
+            pages = [guids async for guids in pigeon.iter_provider_registrations("osf")]
+
+        assert pages == [["guid0", "guid1"], ["guid2"]]
+
+    async def test_walk_files(self):
+        root = f"{settings.OSF_API_URL}v2/registrations/guid0/files/osfstorage/"
+        folder = f"{root}folder0/"
+
+        def listing(records):
+            return json.dumps({"data": records, "links": {"next": None}})
+
+        def file(name, size):
+            return {"attributes": {"kind": "file", "name": name, "size": size}}
+
+        with aioresponses() as m:
+            m.get(
+                root,
+                body=listing(
+                    [
+                        file("a.txt", 10),
+                        {
+                            "attributes": {"kind": "folder", "name": "folder0"},
+                            "relationships": {"files": {"links": {"related": {"href": folder}}}},
+                        },
+                    ]
+                ),
+            )
+            m.get(folder, body=listing([file("b.txt", 20), file("empty.txt", None)]))
+            names = [record["attributes"]["name"] async for record in pigeon.walk_files("guid0")]
+            m.get(root, body=listing([file("a.txt", 100)]))
+            footprint = await pigeon.get_archive_footprint("guid0")
+
+        assert sorted(names) == ["a.txt", "b.txt", "empty.txt"]
+        assert footprint == 100 * settings.ARCHIVE_DISK_FACTOR + settings.ARCHIVE_DISK_OVERHEAD
+
+    async def test_throttle_back_off_holds_all_requests(self):
+        throttle = Throttle(2)
+        throttle.back_off(0.1)
+        start = time.monotonic()
+        await asyncio.gather(throttle.wait(), throttle.wait())
+        assert time.monotonic() - start >= 0.1
+
+
+class TestJobProgress:
+    @pytest.fixture
+    def url(self):
+        return f"{settings.OSF_API_URL}v2/registrations/guid0/"
+
+    def test_stages_are_timed(self):
+        with tracking(JobProgress()) as progress:
+            with stage("download"):
+                time.sleep(0.01)
+                assert progress.as_dict()["stage"] == "download"
+                assert progress.as_dict()["stage_seconds"]["download"] > 0
+            with stage("bag"):
+                pass
+
+        report = progress.as_dict()
+        assert report["stage"] is None
+        assert list(report["stage_seconds"]) == ["download", "bag"]
+        assert report["stage_seconds"]["download"] >= 0.01
+
+    def test_nothing_is_recorded_outside_a_job(self):
+        with stage("download"):
+            pigeon.record(retries=1)
+        assert pigeon.current_job.get() is None
+
+    async def test_retries_and_bytes_are_recorded(self, url):
+        body = json.dumps({"data": []})
+        with aioresponses() as m:
+            m.get(url, status=429, headers={"Retry-After": "0"})
+            m.get(url, body=body)
+            with tracking(JobProgress()) as progress:
+                await get_with_retry(url, retry_on=(429,))
+
+        assert progress.retries == 1
+        assert progress.bytes_downloaded == len(body)
+
+    async def test_threads_record_into_the_callers_job(self):
+        def blocking():
+            pigeon.record(bytes_uploaded=10)
+
+        with tracking(JobProgress()) as progress:
+            await asyncio.gather(run_in_thread(blocking), run_in_thread(blocking))
+
+        assert progress.bytes_uploaded == 20
+
+
+class TestReferenceCache:
+    @pytest.fixture
+    def fetch(self):
+        calls = []
+
+        async def fetch(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value
+
+        fetch.calls = calls
+        return fetch
+
+    async def test_hits_and_misses(self, fetch):
+        cache = ReferenceCache(maxsize=10, ttl=60)
+        assert await cache.get("a", partial(fetch, 1)) == 1
+        assert await cache.get("a", partial(fetch, 2)) == 1
+        assert fetch.calls == [1]
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    async def test_concurrent_misses_are_coalesced(self, fetch):
+        cache = ReferenceCache(maxsize=10, ttl=60)
+        results = await asyncio.gather(*[cache.get("a", partial(fetch, i)) for i in range(5)])
+        assert results == [0] * 5
+        assert fetch.calls == [0]
+        assert (cache.misses, cache.coalesced) == (1, 4)
+
+    async def test_entries_expire(self, fetch):
+        cache = ReferenceCache(maxsize=10, ttl=0.05)
+        await cache.get("a", partial(fetch, 1))
+        await asyncio.sleep(0.06)
+        assert await cache.get("a", partial(fetch, 2)) == 2
+        assert cache.misses == 2
+
+    async def test_least_recently_used_is_evicted(self, fetch):
+        cache = ReferenceCache(maxsize=2, ttl=60)
+        await cache.get("a", partial(fetch, "a"))
+        await cache.get("b", partial(fetch, "b"))
+        await cache.get("a", partial(fetch, "a"))
+        await cache.get("c", partial(fetch, "c"))
+        await cache.get("a", partial(fetch, "a"))
+        await cache.get("b", partial(fetch, "b"))
+        assert fetch.calls == ["a", "b", "c", "b"]
+
+    async def test_failures_are_not_cached(self):
+        cache = ReferenceCache(maxsize=10, ttl=60)
+
+        async def fail():
+            raise ValueError()
+
+        with pytest.raises(ValueError):
+            await cache.get("a", fail)
+        assert await cache.get("a", partial(asyncio.sleep, 0, "ok")) == "ok"
+
+    async def test_contributor_institutions_are_cached(self):
+        contributors = {
+            "data": [
+                {
+                    "embeds": {
+                        "users": {
+                            "data": {
+                                "relationships": {
+                                    "institutions": {
+                                        "links": {
+                                            "related": {
+                                                "href": f"{settings.OSF_API_URL}v2/users/"
+                                                f"s3rbx/institutions/"
+                                            }
+                                        }
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            ]
+        }
+        with mock.patch(
+            "osf_pigeon.pigeon.get_with_retry",
+            return_value={"data": [{"attributes": {"name": "COS"}}]},
+        ) as mock_get:
+            for _ in range(3):
+                response = await get_additional_contributor_info(
+                    json.loads(json.dumps(contributors))
+                )
+                assert response["data"][0]["affiliated_institutions"] == ["COS"]
+
+        assert mock_get.call_count == 1
+
+
 class TestContributors:
     @pytest.fixture
     def guid(self):
@@ -185,6 +1061,105 @@ class TestContributors:
                 )
                 assert info[0]["affiliated_institutions"] == ["Center For Open Science"]
 
+    async def test_institution_lookups_are_concurrent_and_deduplicated(
+        self, contributors_file
+    ):
+        contributor = json.loads(contributors_file)["data"][0]
+        users = ["user0", "user1", "user0", "user2", "user1", "user3"]
+        contributors = []
+        for user in users:
+            contributor = json.loads(json.dumps(contributor))
+            contributor["embeds"]["users"]["data"]["relationships"]["institutions"][
+                "links"
+            ]["related"]["href"] = f"{settings.OSF_API_URL}v2/users/{user}/institutions/"
+            contributors.append(contributor)
+
+        in_flight = []
+        peak = []
+
+        async def mock_get_with_retry(url, **kwargs):
+            user = re.search(r"users/(\w+)/", url).group(1)
+            in_flight.append(user)
+            peak.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(user)
+            return {"data": [{"attributes": {"name": f"{user} University"}}]}
+
+        with mock.patch(
+            "osf_pigeon.pigeon.get_with_retry", side_effect=mock_get_with_retry
+        ) as mock_get:
+            response = await get_additional_contributor_info({"data": contributors})
+
+        assert mock_get.call_count == 4
+        assert max(peak) == 4
+        assert [contrib["affiliated_institutions"] for contrib in response["data"]] == [
+            [f"{user} University"] for user in users
+        ]
+
+
+class TestSharedSession:
+    @pytest.fixture
+    def guid(self):
+        return "ft3ae"
+
+    @pytest.fixture
+    def contributors_file(self):
+        with open(os.path.join(HERE, "fixtures/ft3ae-contributors.json"), "r") as fp:
+            return fp.read()
+
+    @pytest.fixture
+    def institutions_file(self):
+        with open(os.path.join(HERE, "fixtures/ft3ae-institutions.json"), "r") as fp:
+            return fp.read()
+
+    async def test_injected_session_is_reused(
+        self, guid, contributors_file, institutions_file
+    ):
+        with aioresponses() as m:
+            m.get(
+                f"{settings.OSF_API_URL}v2/registrations/{guid}/contributors/",
+                body=contributors_file,
+            )
+            m.get(
+                "http://localhost:8000/v2/users/s3rbx/institutions/",
+                body=institutions_file,
+            )
+            m.get(
+                f"{settings.OSF_FILES_URL}v1/resources/{guid}/providers/osfstorage/?zip=",
+                body=b"Randall Cunningham",
+            )
+
+            async with create_session() as session:
+                with mock.patch.object(session, "get", wraps=session.get) as mock_get:
+                    with tempfile.TemporaryDirectory() as temp_dir:
+                        await dump_json_to_dir(
+                            f"{settings.OSF_API_URL}v2/registrations/{guid}/contributors/",
+                            temp_dir,
+                            "contributors.json",
+                            parse_json=partial(
+                                get_additional_contributor_info, session=session
+                            ),
+                            session=session,
+                        )
+                        await stream_files_to_dir(
+                            f"{settings.OSF_FILES_URL}v1/resources/{guid}/providers/"
+                            f"osfstorage/?zip=",
+                            temp_dir,
+                            "archived_files.zip",
+                            session=session,
+                        )
+
+                    assert mock_get.call_count == 3
+                assert not session.closed
+
+    async def test_session_pool_settings(self):
+        async with create_session() as session:
+            assert session.connector.limit == settings.OSF_CONNECTION_POOL_SIZE
+            assert (
+                session.connector.limit_per_host
+                == settings.OSF_CONNECTION_POOL_SIZE_PER_HOST
+            )
+
 
 class TestDatacite:
     @pytest.fixture
@@ -207,6 +1182,29 @@ class TestDatacite:
         xml = await write_datacite_metadata(guid, temp_dir, metadata)
         assert xml == "pretend this is XML."
 
+    async def test_datacite_does_not_block_the_event_loop(self, guid, temp_dir, metadata):
+        ticks = []
+
+        def slow_metadata_get(doi):
+            time.sleep(0.2)
+            return "pretend this is XML."
+
+        async def tick():
+            while len(ticks) < 5:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        with mock.patch(
+            "osf_pigeon.pigeon.DataCiteMDSClient.metadata_get", side_effect=slow_metadata_get
+        ):
+            start = time.monotonic()
+            xml, _ = await asyncio.gather(
+                write_datacite_metadata(guid, temp_dir, metadata), tick()
+            )
+
+        assert xml == "pretend this is XML."
+        assert ticks[-1] - start < 0.2
+
 
 class TestMetadata:
     @pytest.fixture
@@ -326,24 +1324,62 @@ class TestMetadata:
         mock_ia_client.item.modify_metadata.assert_called_with(metadata)
 
     def test_modify_metadata_not_public(self, mock_ia_client, guid):
+        mock_ia_client.item.metadata = {
+            "title": "Test Component",
+            "description": "Test Description",
+            "date": "2017-12-20",
+        }
         metadata = {
             "title": "Test Component",
             "description": "Test Description",
             "date": "2017-12-20",
-            "moderation_state": "withdrawn",
+            "withdrawal_justification": "Duplicate",
         }
-        sync_metadata(guid, metadata)
+        _, updated = sync_metadata(guid, metadata)
         mock_ia_client.session.get_item.assert_called_with(
             f"osf-registrations-guid0-{settings.ID_VERSION}"
         )
 
-        metadata["noindex"] = True
-        metadata[
-            "description"
-        ] = "Note this registration has been withdrawn: \nTest Description"
+        # withdrawal and noindex are one write, unchanged values aren't written again
+        mock_ia_client.item.modify_metadata.assert_called_once_with(
+            {
+                "description": "Note this registration has been withdrawn: \nTest Description",
+                "withdrawal_justification": "Duplicate",
+                "noindex": True,
+            }
+        )
+        assert updated == ["description", "withdrawal_justification", "noindex"]
+
+    def test_withdrawal_is_idempotent(self, mock_ia_client, guid):
+        mock_ia_client.item.metadata = {
+            "description": "Note this registration has been withdrawn: \nTest Description",
+            "withdrawal_justification": "Duplicate",
+            "noindex": "true",
+        }
+        _, updated = sync_metadata(guid, {"withdrawal_justification": "Duplicate"})
+
+        mock_ia_client.item.modify_metadata.assert_not_called()
+        assert updated == []
 
-        mock_ia_client.item.modify_metadata.assert_any_call({"noindex": True})
-        mock_ia_client.item.modify_metadata.assert_any_call(metadata)
+    def test_unchanged_metadata_is_not_written(self, mock_ia_client, guid):
+        mock_ia_client.item.metadata = {
+            "title": "Test Component",
+            "osf_tags": "birds",  # IA returns a list of one as its only value
+            "osf_subjects": ["Life Sciences", "Biology"],
+        }
+        _, updated = sync_metadata(
+            guid,
+            {
+                "title": "Test Component",
+                "osf_tags": ["birds"],
+                "osf_subjects": ["Life Sciences", "Biology"],
+                "article_doi": "",
+                "description": "New",
+            },
+        )
+
+        mock_ia_client.item.modify_metadata.assert_called_once_with({"description": "New"})
+        assert updated == ["description"]
 
 
 class TestUpload:
@@ -448,6 +1484,8 @@ class TestUpload:
                     "parent": f"https://archive.org/details/"
                     f"osf-registrations-dgkjr-{settings.ID_VERSION}",
                     "license": "https://creativecommons.org/publicdomain/zero/1.0/legalcode",
+                    "osf_date_modified": "2017-12-08T15:28:30.110842Z",
+                    "osf_file_count": "0",
                 },
                 secret_key=settings.IA_SECRET_KEY,
                 access_key=settings.IA_ACCESS_KEY,
@@ -519,7 +1557,452 @@ class TestUpload:
                     "parent": f"https://archive.org/details/"
                     f"osf-registrations-dgkjr-{settings.ID_VERSION}",
                     "license": "https://creativecommons.org/publicdomain/zero/1.0/legalcode",
+                    "osf_date_modified": "2017-12-08T15:28:30.110842Z",
+                    "osf_file_count": "0",
                 },
                 secret_key=settings.IA_SECRET_KEY,
                 access_key=settings.IA_ACCESS_KEY,
             )
+
+
+class TestMultipartUpload:
+    @pytest.fixture
+    def state_dir(self):
+        with tempfile.TemporaryDirectory() as state_dir:
+            with mock.patch.object(settings, "IA_UPLOAD_STATE_DIR", state_dir):
+                yield state_dir
+
+    @pytest.fixture
+    def bag_zip(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "bag.zip")
+            with open(path, "wb") as fp:
+                fp.write(b"Nick Foles" + b"Zach Ertz" + b"Corey Clement")
+            with mock.patch.object(settings, "IA_MULTIPART_PART_SIZE", 10):
+                yield path
+
+    @pytest.fixture
+    def url(self):
+        return f"{settings.IA_S3_URL}guid0/bag.zip"
+
+    @pytest.fixture
+    def mock_s3(self, url):
+        requests_made = {"initiate": [], "parts": [], "complete": [], "abort": []}
+        failures = {}
+        missing = set()  # upload ids IA doesn't have
+        no_such_upload = (404, {}, "<Error><Code>NoSuchUpload</Code></Error>")
+
+        def get_upload_id(request):
+            return parse_qs(urlparse(request.url).query).get("uploadId", [None])[0]
+
+        def post(request):
+            if get_upload_id(request) in missing:
+                return no_such_upload
+            if "uploads" in request.url:
+                requests_made["initiate"].append(request)
+                return (
+                    200,
+                    {},
+                    "<InitiateMultipartUploadResult "
+                    "xmlns='http://s3.amazonaws.com/doc/2006-03-01/'>"
+                    "<UploadId>upload0</UploadId></InitiateMultipartUploadResult>",
+                )
+            requests_made["complete"].append(request)
+            return 200, {}, ""
+
+        def put(request):
+            number = int(parse_qs(urlparse(request.url).query)["partNumber"][0])
+            if get_upload_id(request) in missing:
+                return no_such_upload
+            if failures.get(number):
+                failures[number] -= 1
+                return 500, {}, ""
+            requests_made["parts"].append((number, request.body))
+            return 200, {"ETag": f'"{hashlib.md5(request.body).hexdigest()}"'}, ""
+
+        def delete(request):
+            requests_made["abort"].append(get_upload_id(request))
+            return 204, {}, ""
+
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            rsps.add_callback(responses.POST, url, callback=post)
+            rsps.add_callback(responses.PUT, url, callback=put)
+            rsps.add_callback(responses.DELETE, url, callback=delete)
+            requests_made["failures"] = failures
+            requests_made["missing"] = missing
+            yield requests_made
+
+    def test_upload_in_parts(self, mock_s3, bag_zip, state_dir):
+        upload_multipart("guid0", bag_zip, {"collection": "osf-registration-providers-osf"})
+
+        assert len(mock_s3["initiate"]) == 1
+        assert (
+            mock_s3["initiate"][0].headers["x-archive-meta00-collection"]
+            == "osf-registration-providers-osf"
+        )
+        assert sorted(mock_s3["parts"]) == [
+            (1, b"Nick Foles"),
+            (2, b"Zach ErtzC"),
+            (3, b"orey Cleme"),
+            (4, b"nt"),
+        ]
+        complete = mock_s3["complete"][0]
+        assert "uploadId=upload0" in complete.url
+        assert complete.body.count("<PartNumber>") == 4
+        assert not os.listdir(state_dir)
+
+    def test_resume_skips_uploaded_parts(self, mock_s3, bag_zip, state_dir):
+        save_upload_state(
+            get_upload_state_path("guid0", "bag.zip"),
+            {
+                "upload_id": "upload0",
+                "size": os.path.getsize(bag_zip),
+                "part_size": 10,
+                "parts": {
+                    "1": f'"{hashlib.md5(b"Nick Foles").hexdigest()}"',
+                    "2": f'"{hashlib.md5(b"stale part").hexdigest()}"',
+                },
+            },
+        )
+
+        upload_multipart("guid0", bag_zip, {})
+
+        assert not mock_s3["initiate"]
+        assert sorted(number for number, _ in mock_s3["parts"]) == [2, 3, 4]
+        assert "uploadId=upload0" in mock_s3["complete"][0].url
+
+    def test_failed_parts_are_retried(self, mock_s3, bag_zip, state_dir):
+        mock_s3["failures"][2] = 2
+        upload_multipart("guid0", bag_zip, {})
+        assert sorted(number for number, _ in mock_s3["parts"]) == [1, 2, 3, 4]
+
+    def test_failed_upload_keeps_state(self, mock_s3, bag_zip, state_dir):
+        mock_s3["failures"][3] = settings.IA_MULTIPART_RETRIES + 1
+        with pytest.raises(Exception):
+            upload_multipart("guid0", bag_zip, {})
+
+        with open(get_upload_state_path("guid0", "bag.zip")) as fp:
+            state = json.load(fp)
+        assert sorted(state["parts"]) == ["1", "2", "4"]
+
+    @pytest.mark.parametrize("all_parts_sent", [False, True])
+    def test_upload_ia_no_longer_has_starts_over(
+        self, mock_s3, bag_zip, state_dir, all_parts_sent
+    ):
+        # it expired or was aborted, or was completed before the state was removed, and so fails
+        # on a part, or on completing it
+        mock_s3["missing"].add("expired0")
+        parts = {}
+        if all_parts_sent:
+            with open(bag_zip, "rb") as fp:
+                for number, data in enumerate(iter(partial(fp.read, 10), b""), 1):
+                    parts[str(number)] = f'"{hashlib.md5(data).hexdigest()}"'
+        save_upload_state(
+            get_upload_state_path("guid0", "bag.zip"),
+            {
+                "upload_id": "expired0",
+                "size": os.path.getsize(bag_zip),
+                "part_size": 10,
+                "parts": parts,
+            },
+        )
+
+        upload_multipart("guid0", bag_zip, {})
+
+        assert len(mock_s3["initiate"]) == 1
+        assert sorted(number for number, _ in mock_s3["parts"]) == [1, 2, 3, 4]
+        assert "uploadId=upload0" in mock_s3["complete"][0].url
+        assert not os.listdir(state_dir)
+
+    def test_changed_file_aborts_saved_upload(self, mock_s3, bag_zip, state_dir):
+        save_upload_state(
+            get_upload_state_path("guid0", "bag.zip"),
+            {"upload_id": "stale0", "size": 1, "part_size": 10, "parts": {"1": '"etag"'}},
+        )
+
+        upload_multipart("guid0", bag_zip, {})
+
+        assert mock_s3["abort"] == ["stale0"]
+        assert "uploadId=upload0" in mock_s3["complete"][0].url
+
+    async def test_large_bags_use_multipart(self, mock_ia_client, bag_zip):
+        with mock.patch.object(settings, "IA_MULTIPART_THRESHOLD", 1), mock.patch(
+            "osf_pigeon.pigeon.get_metadata_for_ia_item", return_value={"title": "Test"}
+        ), mock.patch("osf_pigeon.pigeon.upload_multipart") as mock_upload_multipart:
+            await upload(
+                "guid0",
+                os.path.dirname(bag_zip),
+                {
+                    "data": {
+                        "attributes": {"date_modified": "2021-02-05T21:00:02.954298Z"},
+                        "embeds": {"provider": {"data": {"id": "osf"}}},
+                        "relationships": {"files": {"links": {"related": {"meta": {"count": 2}}}}},
+                    }
+                },
+            )
+
+        mock_upload_multipart.assert_called_with(
+            "guid0",
+            bag_zip,
+            {
+                "collection": f"osf-registration-providers-osf-{settings.ID_VERSION}",
+                "title": "Test",
+                "osf_date_modified": "2021-02-05T21:00:02.954298Z",
+                "osf_file_count": "2",
+            },
+        )
+        mock_ia_client.item.upload.assert_not_called()
+
+    async def test_uploads_have_threads_of_their_own(self, mock_ia_client, bag_zip):
+        threads = []
+        mock_ia_client.item.upload.side_effect = lambda *args, **kwargs: threads.append(
+            threading.current_thread().name
+        )
+        with mock.patch(
+            "osf_pigeon.pigeon.get_metadata_for_ia_item", return_value={"title": "Test"}
+        ):
+            await upload(
+                "guid0",
+                os.path.dirname(bag_zip),
+                {
+                    "data": {
+                        "attributes": {"date_modified": "2021-02-05T21:00:02.954298Z"},
+                        "embeds": {"provider": {"data": {"id": "osf"}}},
+                        "relationships": {"files": {"links": {"related": {"meta": {"count": 2}}}}},
+                    }
+                },
+            )
+
+        assert len(threads) == 1
+        assert threads[0].startswith("pigeon_ia_uploads")
+
+    def test_stream_upload_in_parts(self, mock_s3, state_dir):
+        with mock.patch.object(settings, "IA_MULTIPART_PART_SIZE", 10):
+            with MultipartStream("guid0", "bag.zip", {"collection": "osf"}) as stream:
+                for chunk in [b"Nick Foles", b"Zach Ertz", b"Corey Clement"]:
+                    stream.write(chunk)
+
+        assert mock_s3["initiate"][0].headers["x-archive-meta00-collection"] == "osf"
+        assert sorted(mock_s3["parts"]) == [
+            (1, b"Nick Foles"),
+            (2, b"Zach ErtzC"),
+            (3, b"orey Cleme"),
+            (4, b"nt"),
+        ]
+        assert mock_s3["complete"][0].body.count("<PartNumber>") == 4
+        assert stream.size == 32
+        assert not os.listdir(state_dir)
+
+    def test_stream_upload_fails_with_a_part(self, mock_s3):
+        mock_s3["failures"][1] = settings.IA_MULTIPART_RETRIES + 1
+        with mock.patch.object(settings, "IA_MULTIPART_PART_SIZE", 10):
+            with pytest.raises(requests.HTTPError):
+                with MultipartStream("guid0", "bag.zip", {}) as stream:
+                    stream.write(b"Nick Foles" + b"Zach Ertz")
+
+        assert not mock_s3["complete"]
+        assert mock_s3["abort"] == ["upload0"]
+
+    def test_stream_upload_is_aborted_with_the_zip(self, mock_s3):
+        with mock.patch.object(settings, "IA_MULTIPART_PART_SIZE", 10):
+            with pytest.raises(zipfile.LargeZipFile):
+                with MultipartStream("guid0", "bag.zip", {}) as stream:
+                    stream.write(b"Nick Foles")
+                    raise zipfile.LargeZipFile()
+
+        assert not mock_s3["complete"]
+        assert mock_s3["abort"] == ["upload0"]
+
+    async def test_bags_can_be_zipped_as_they_are_uploaded(self, mock_ia_client):
+        with mock.patch.object(settings, "IA_STREAM_UPLOAD", True), mock.patch(
+            "osf_pigeon.pigeon.get_metadata_for_ia_item", return_value={"title": "Test"}
+        ), mock.patch("osf_pigeon.pigeon.stream_zip", return_value=32) as mock_stream_zip:
+            await upload(
+                "guid0",
+                "/tmp/guid0",
+                {
+                    "data": {
+                        "attributes": {"date_modified": "2021-02-05T21:00:02.954298Z"},
+                        "embeds": {"provider": {"data": {"id": "osf"}}},
+                        "relationships": {"files": {"links": {"related": {"meta": {"count": 2}}}}},
+                    }
+                },
+            )
+
+        mock_stream_zip.assert_called_once_with(
+            "/tmp/guid0",
+            "guid0",
+            {
+                "collection": f"osf-registration-providers-osf-{settings.ID_VERSION}",
+                "title": "Test",
+                "osf_date_modified": "2021-02-05T21:00:02.954298Z",
+                "osf_file_count": "2",
+            },
+        )
+        mock_ia_client.item.upload.assert_not_called()
+
+
+class TestIncrementalArchive:
+    @pytest.fixture
+    def metadata(self):
+        with open(os.path.join(HERE, "fixtures/metadata-resp-with-embeds.json"), "rb") as fp:
+            return json.loads(fp.read())
+
+    @pytest.fixture
+    def ia_item(self, metadata):
+        ia_item = mock.Mock()
+        ia_item.exists = True
+        ia_item.files = [{"name": "bag.zip"}]
+        ia_item.metadata = {"title": "Test Component", **pigeon.get_archived_version(metadata)}
+        return ia_item
+
+    def test_unchanged(self, ia_item, metadata):
+        assert pigeon.get_changes_since_archived(ia_item, metadata) is None
+
+    def test_metadata_changed(self, ia_item, metadata):
+        metadata["data"]["attributes"]["date_modified"] = "2021-02-05T21:00:02.954298Z"
+        assert pigeon.get_changes_since_archived(ia_item, metadata) == pigeon.METADATA_CHANGED
+
+    def test_files_changed(self, ia_item, metadata):
+        metadata["data"]["relationships"]["files"]["links"]["related"]["meta"]["count"] = 1
+        assert pigeon.get_changes_since_archived(ia_item, metadata) == pigeon.FILES_CHANGED
+
+    @pytest.mark.parametrize(
+        "exists, files, item_metadata",
+        [
+            (False, [], {}),
+            (True, [], None),  # the bag was never uploaded
+            (True, [{"name": "bag.zip"}], {}),  # archived before versions were recorded
+        ],
+    )
+    def test_not_archived(self, ia_item, metadata, exists, files, item_metadata):
+        ia_item.exists = exists
+        ia_item.files = files
+        if item_metadata is not None:
+            ia_item.metadata = item_metadata
+        assert pigeon.get_changes_since_archived(ia_item, metadata) == pigeon.FILES_CHANGED
+
+    async def test_current_items_are_skipped(self, mock_ia_client, ia_item, metadata):
+        mock_ia_client.session.get_item.return_value = ia_item
+        with mock.patch(
+            "osf_pigeon.pigeon.get_registration", return_value=metadata
+        ), mock.patch("osf_pigeon.pigeon.upload") as mock_upload:
+            assert await pigeon.archive("guid0") == (ia_item, "guid0")
+
+        mock_upload.assert_not_called()
+        ia_item.modify_metadata.assert_not_called()
+
+    async def test_only_metadata_is_synced(self, mock_ia_client, ia_item, metadata):
+        mock_ia_client.session.get_item.return_value = ia_item
+        metadata["data"]["attributes"]["date_modified"] = "2021-02-05T21:00:02.954298Z"
+        with mock.patch(
+            "osf_pigeon.pigeon.get_registration", return_value=metadata
+        ), mock.patch(
+            "osf_pigeon.pigeon.get_metadata_for_ia_item", return_value={"title": "New Title"}
+        ), mock.patch(
+            "osf_pigeon.pigeon.upload"
+        ) as mock_upload:
+            await pigeon.archive("guid0")
+
+        mock_upload.assert_not_called()
+        ia_item.modify_metadata.assert_called_once_with(
+            {
+                "title": "New Title",
+                "osf_date_modified": "2021-02-05T21:00:02.954298Z",
+                "osf_file_count": "0",
+            }
+        )
+
+    async def test_existing_items_record_the_archived_version(
+        self, mock_ia_client, ia_item, metadata
+    ):
+        ia_item.metadata = {"title": "Test Component"}  # archived before versions were recorded
+        ia_item.modify_metadata.side_effect = ia_item.metadata.update
+        mock_ia_client.session.get_item.return_value = ia_item
+        with mock.patch(
+            "osf_pigeon.pigeon.get_registration", return_value=metadata
+        ), mock.patch("osf_pigeon.pigeon.write_datacite_metadata"), mock.patch(
+            "osf_pigeon.pigeon.dump_json_to_dir"
+        ), mock.patch(
+            "osf_pigeon.pigeon.get_metadata_for_ia_item", return_value={}
+        ):
+            await pigeon.archive("guid0")
+            ia_item.upload.assert_called_once()
+            ia_item.modify_metadata.assert_called_once_with(
+                pigeon.get_archived_version(metadata)
+            )
+
+            await pigeon.archive("guid0")
+            ia_item.upload.assert_called_once()
+            ia_item.modify_metadata.assert_called_once()
+
+    async def test_forced_archives_are_not_compared(self, mock_ia_client, ia_item, metadata):
+        with mock.patch(
+            "osf_pigeon.pigeon.get_registration", return_value=metadata
+        ), mock.patch("osf_pigeon.pigeon.write_datacite_metadata"), mock.patch(
+            "osf_pigeon.pigeon.dump_json_to_dir"
+        ), mock.patch(
+            "osf_pigeon.pigeon.upload", return_value=ia_item
+        ) as mock_upload:
+            assert await pigeon.archive("guid0", incremental=False) == (ia_item, "guid0")
+
+        mock_upload.assert_called_once()
+        mock_ia_client.session.get_item.assert_not_called()
+
+    async def test_files_can_be_archived_one_by_one(self, mock_ia_client, ia_item, metadata):
+        metadata["data"]["relationships"]["files"]["links"]["related"]["meta"]["count"] = 2
+        with mock.patch(
+            "osf_pigeon.pigeon.get_registration", return_value=metadata
+        ), mock.patch("osf_pigeon.pigeon.write_datacite_metadata"), mock.patch(
+            "osf_pigeon.pigeon.dump_json_to_dir"
+        ), mock.patch(
+            "osf_pigeon.pigeon.download_files_to_dir"
+        ) as mock_download_files, mock.patch(
+            "osf_pigeon.pigeon.download_archived_files"
+        ) as mock_download_zip, mock.patch(
+            "osf_pigeon.pigeon.upload", return_value=ia_item
+        ):
+            await pigeon.archive("guid0", incremental=False, per_file=True)
+
+        mock_download_zip.assert_not_called()
+        mock_download_files.assert_called_once()
+        assert mock_download_files.call_args[0][1].endswith(os.path.join("bag", "data", "files"))
+
+
+class TestIASessions:
+    def test_sessions_are_reused_per_thread(self):
+        sessions = pigeon.IASessions()
+        first = sessions.get()
+        assert sessions.get() is first
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            other = pool.submit(sessions.get).result()
+        assert other is not first
+
+    def test_connection_pools_are_sized(self):
+        session = pigeon.IASessions().get()
+        for url in ("https://archive.org/metadata/", settings.IA_S3_URL):
+            adapter = session.get_adapter(url)
+            assert adapter._pool_maxsize == settings.IA_MULTIPART_CONCURRENCY
+
+    def test_items_are_cached_for_metadata_syncs(self, mock_ia_client):
+        mock_ia_client.item.metadata = {"title": "Test Component"}
+        sync_metadata("guid0", {"title": "Test Component"})
+        sync_metadata("guid0", {"title": "Test Component"})
+        assert mock_ia_client.session.get_item.call_count == 1
+        assert mock_ia_client.call_count == 1  # one session
+
+        # writing invalidates the item
+        sync_metadata("guid0", {"title": "New"})
+        sync_metadata("guid0", {"title": "New"})
+        assert mock_ia_client.session.get_item.call_count == 2
+
+    def test_item_cache_expires(self):
+        cache = pigeon.ItemCache(maxsize=1, ttl=0.05)
+        fetch = mock.Mock(side_effect=["item0", "item1", "item2"])
+        assert cache.get("guid0", fetch) == "item0"
+        assert cache.get("guid0", fetch) == "item0"
+        time.sleep(0.06)
+        assert cache.get("guid0", fetch) == "item1"
+        cache.get("guid1", fetch)  # evicts guid0
+        assert cache._entries.keys() == {"guid1"}
@@ -0,0 +1,442 @@
+import os
+import time
+import asyncio
+import tempfile
+import threading
+
+import mock
+import pytest
+from prometheus_client import REGISTRY
+
+from osf_pigeon import pigeon
+from osf_pigeon import settings
+from osf_pigeon.scheduler import Scheduler, DiskSpace
+from osf_pigeon.store import JobStore, ARCHIVE, METADATA, DONE, FAILED
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class TestScheduler:
+    @pytest.fixture
+    def store(self):
+        return JobStore(":memory:")
+
+    @pytest.fixture
+    def on_archive_done(self):
+        return mock.Mock()
+
+    @pytest.fixture
+    def scheduler(self, store, on_archive_done):
+        scheduler = Scheduler(
+            archive_concurrency=2,
+            metadata_concurrency=1,
+            store=store,
+            on_archive_done=on_archive_done,
+        )
+        scheduler.start()
+        yield scheduler
+        scheduler.stop()
+
+    def test_archive_concurrency_is_bounded(self, scheduler):
+        running = []
+        peak = []
+        loops = set()
+
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            loops.add(asyncio.get_event_loop())
+            running.append(guid)
+            peak.append(len(running))
+            await asyncio.sleep(0.05)
+            running.remove(guid)
+            return None, guid
+
+        with mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive):
+            futures = [scheduler.submit_archive(f"guid{i}") for i in range(6)]
+            results = [future.result(timeout=5) for future in futures]
+
+        assert [guid for _, guid in results] == [f"guid{i}" for i in range(6)]
+        assert max(peak) == 2
+        assert loops == {scheduler.loop}
+
+    def test_archive_jobs_share_session(self, scheduler):
+        sessions = set()
+
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            sessions.add(session)
+            return None, guid
+
+        with mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive):
+            for future in [scheduler.submit_archive(f"guid{i}") for i in range(3)]:
+                future.result(timeout=5)
+
+        assert sessions == {scheduler.session}
+
+    def test_metadata_does_not_wait_behind_archives(self, scheduler):
+        release = threading.Event()
+
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            while not release.is_set():
+                await asyncio.sleep(0.01)
+            return None, guid
+
+        with mock.patch(
+            "osf_pigeon.pigeon.archive", side_effect=mock_archive
+        ), mock.patch(
+            "osf_pigeon.pigeon.sync_metadata", return_value=(None, ["title"])
+        ):
+            archives = [scheduler.submit_archive(f"guid{i}") for i in range(4)]
+            start = time.monotonic()
+            metadata = scheduler.submit_metadata("guid0", {"title": "Test"})
+            assert metadata.result(timeout=5) == (None, ["title"])
+            assert time.monotonic() - start < 1
+            assert not any(future.done() for future in archives)
+
+            release.set()
+            for future in archives:
+                future.result(timeout=5)
+
+    def test_duplicate_archives_are_deduplicated(self, scheduler):
+        release = threading.Event()
+
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            while not release.is_set():
+                await asyncio.sleep(0.01)
+            return None, guid
+
+        with mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive) as archive:
+            first = scheduler.submit_archive("guid0")
+            second = scheduler.submit_archive("guid0")
+            release.set()
+            assert first.result(timeout=5) == (None, "guid0")
+
+        assert first is second
+        assert archive.call_count == 1
+
+    def test_job_is_done_after_callback(self, scheduler, store, on_archive_done):
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            return "ia_item", guid
+
+        with mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive):
+            scheduler.submit_archive("guid0").result(timeout=5)
+
+        on_archive_done.assert_called_once_with(("ia_item", "guid0"))
+        assert store.get(1)["state"] == DONE
+
+    def test_failed_callback_fails_the_job(self, scheduler, store, on_archive_done):
+        on_archive_done.side_effect = ValueError("osf.io is down")
+
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            return "ia_item", guid
+
+        with mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive):
+            with pytest.raises(ValueError):
+                scheduler.submit_archive("guid0").result(timeout=5)
+
+        assert store.get(1)["state"] == FAILED
+        assert "osf.io is down" in store.get(1)["error"]
+
+    def test_metadata_runs_with_merged_payload(self, store):
+        store.enqueue(METADATA, "guid0", {"title": "Old"})
+        store.enqueue(METADATA, "guid0", {"title": "New", "description": "Birds"})
+        scheduler = Scheduler(store=store)
+
+        with mock.patch(
+            "osf_pigeon.pigeon.sync_metadata", return_value=(None, [])
+        ) as sync_metadata:
+            scheduler.start()
+            try:
+                wait_for(lambda: store.get(1)["state"] == DONE)
+            finally:
+                scheduler.stop()
+
+        sync_metadata.assert_called_once_with("guid0", {"title": "New", "description": "Birds"})
+        assert store.get(1)["state"] == DONE
+
+    def test_unfinished_jobs_are_requeued_on_start(self, store):
+        running, _ = store.enqueue(ARCHIVE, "guid0")
+        store.start(running)
+        queued, _ = store.enqueue(ARCHIVE, "guid1")
+        finished, _ = store.enqueue(ARCHIVE, "guid2")
+        store.finish(finished)
+        archived = []
+
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            archived.append(guid)
+            return None, guid
+
+        scheduler = Scheduler(store=store)
+        with mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive):
+            scheduler.start()
+            try:
+                wait_for(lambda: store.get(queued)["state"] == DONE)
+                wait_for(lambda: store.get(running)["state"] == DONE)
+            finally:
+                scheduler.stop()
+
+        assert sorted(archived) == ["guid0", "guid1"]
+
+    def test_job_status(self, scheduler, store):
+        in_upload = threading.Event()
+        release = threading.Event()
+
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            with pigeon.stage("download"):
+                pigeon.record(bytes_downloaded=100)
+            with pigeon.stage("upload"):
+                in_upload.set()
+                while not release.is_set():
+                    await asyncio.sleep(0.01)
+            return None, guid
+
+        with mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive):
+            futures = [scheduler.submit_archive(f"guid{i}") for i in range(4)]
+            in_upload.wait(timeout=5)
+            wait_for(lambda: [job["state"] for job in scheduler.jobs()].count("running") == 2)
+            assert REGISTRY.get_sample_value("pigeon_jobs_in_flight", {"kind": ARCHIVE}) == 2
+            assert REGISTRY.get_sample_value("pigeon_jobs_queued", {"kind": ARCHIVE}) == 2
+
+            running, _, queued, last = scheduler.jobs()
+            assert running["progress"]["stage"] == "upload"
+            assert running["progress"]["bytes_downloaded"] == 100
+            assert queued["queue_position"] == 1
+            assert last["queue_position"] == 2
+            assert "queue_position" not in running
+
+            release.set()
+            for future in futures:
+                future.result(timeout=5)
+
+        assert scheduler.jobs() == []
+        [finished] = scheduler.jobs("guid0")
+        assert finished["state"] == DONE
+        assert finished["progress"]["stage"] is None
+        assert list(finished["progress"]["stage_seconds"]) == ["download", "upload", "callback"]
+
+    def test_queue_positions_are_counted_in_one_pass(self, store):
+        running, _ = store.enqueue(ARCHIVE, "guid0")
+        store.start(running)
+        for guid in ("guid1", "guid2"):
+            store.enqueue(ARCHIVE, guid)
+            store.enqueue(METADATA, guid)
+
+        scheduler = Scheduler(store=store)
+        with mock.patch.object(store, "queue_position") as mock_queue_position:
+            jobs = scheduler.jobs()
+        mock_queue_position.assert_not_called()
+        assert [(job["kind"], job.get("queue_position")) for job in jobs] == [
+            (ARCHIVE, None),
+            (ARCHIVE, 1),
+            (METADATA, 1),
+            (ARCHIVE, 2),
+            (METADATA, 2),
+        ]
+        assert [job.get("queue_position") for job in scheduler.jobs("guid2")] == [2, 2]
+
+    def test_batch_archives_each_guid_once(self, scheduler):
+        scheduler.batch_concurrency = 1
+        running = []
+        peak = []
+        archived = []
+
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            running.append(guid)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(guid)
+            archived.append(guid)
+            return None, guid
+
+        with mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive):
+            batch_id = scheduler.submit_batch(guids=["guid0", "guid1", "guid0", "guid2"])
+            wait_for(lambda: scheduler.batch(batch_id)["jobs"][DONE] == 3)
+
+        assert archived == ["guid0", "guid1", "guid2"]
+        assert max(peak) == 1
+        assert scheduler.batch(batch_id)["total"] == 3
+
+    def test_provider_batch(self, scheduler):
+        async def mock_provider_registrations(provider_id, session=None):
+            assert provider_id == "osf"
+            yield ["guid0", "guid1"]
+            yield ["guid2"]
+
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            return None, guid
+
+        with mock.patch(
+            "osf_pigeon.pigeon.iter_provider_registrations",
+            side_effect=mock_provider_registrations,
+        ), mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive) as archive:
+            batch_id = scheduler.submit_batch(provider="osf")
+            wait_for(lambda: scheduler.batch(batch_id)["jobs"][DONE] == 3)
+
+        assert scheduler.batch(batch_id)["enumerated"]
+        assert sorted(call[0][0] for call in archive.call_args_list) == [
+            "guid0",
+            "guid1",
+            "guid2",
+        ]
+
+    def test_unfinished_batches_are_resumed_on_start(self, store):
+        batch_id = store.create_batch()
+        store.add_to_batch(batch_id, ["guid0", "guid1"])
+        store.finish_enumerating(batch_id)
+        store.start(store.batch_job_ids(batch_id)[0])
+
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            return None, guid
+
+        scheduler = Scheduler(store=store)
+        with mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive):
+            scheduler.start()
+            try:
+                wait_for(lambda: store.get_batch(batch_id)["jobs"][DONE] == 2)
+            finally:
+                scheduler.stop()
+
+    def test_stage_limits_are_shared(self, scheduler):
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            return limits, guid
+
+        with mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive):
+            first, _ = scheduler.submit_archive("guid0").result(timeout=5)
+            second, _ = scheduler.submit_archive("guid1").result(timeout=5)
+
+        assert first is second
+        assert set(first) == {"download", "upload"}
+
+    def test_forced_archives_are_not_incremental(self, scheduler):
+        async def mock_archive(guid, session=None, limits=None, incremental=None):
+            return incremental, guid
+
+        with mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive):
+            assert scheduler.submit_archive("guid0").result(timeout=5) == (None, "guid0")
+            assert scheduler.submit_archive("guid0", force=True).result(timeout=5) == (
+                False,
+                "guid0",
+            )
+
+    def test_metadata_edits_are_debounced(self, scheduler, store):
+        scheduler.metadata_debounce = 0.2
+
+        with mock.patch(
+            "osf_pigeon.pigeon.sync_metadata", return_value=(None, [])
+        ) as sync_metadata:
+            first = scheduler.submit_metadata("guid0", {"title": "Old"})
+            time.sleep(0.1)
+            second = scheduler.submit_metadata("guid0", {"title": "New", "description": "Birds"})
+            first.result(timeout=5)
+
+        assert first is second
+        sync_metadata.assert_called_once_with("guid0", {"title": "New", "description": "Birds"})
+
+    def test_jobs_are_admitted_by_disk_space(self, store):
+        footprints = {"big0": 80, "big1": 80, "small": 10}
+        started = []
+        release = threading.Event()
+
+        async def mock_footprint(guid, session=None):
+            return footprints[guid]
+
+        async def mock_archive(guid, session=None, limits=None, incremental=None, admission=None):
+            async with admission(guid):
+                started.append(guid)
+                while guid == "big0" and not release.is_set():
+                    await asyncio.sleep(0.01)
+            return None, guid
+
+        scheduler = Scheduler(archive_concurrency=2, store=store, disk_admission=True)
+        with mock.patch.object(settings, "ARCHIVE_DISK_HEADROOM", 0), mock.patch.object(
+            DiskSpace, "free_space", return_value=100
+        ), mock.patch(
+            "osf_pigeon.pigeon.get_archive_footprint", side_effect=mock_footprint
+        ), mock.patch(
+            "osf_pigeon.pigeon.archive", side_effect=mock_archive
+        ):
+            scheduler.start()
+            try:
+                big0, big1, small = [
+                    scheduler.submit_archive(guid) for guid in ("big0", "big1", "small")
+                ]
+                small.result(timeout=5)
+                # big1 doesn't fit beside big0, the small job went around it
+                assert started == ["big0", "small"]
+                assert scheduler.disk.reserved == 80
+
+                release.set()
+                big1.result(timeout=5)
+                assert started == ["big0", "small", "big1"]
+                assert scheduler.disk.reserved == 0
+            finally:
+                scheduler.stop()
+
+    def test_oversized_jobs_run_alone(self, store):
+        async def mock_footprint(guid, session=None):
+            return 1000
+
+        async def mock_archive(guid, session=None, limits=None, incremental=None, admission=None):
+            async with admission(guid):
+                return None, guid
+
+        scheduler = Scheduler(store=store, disk_admission=True)
+        with mock.patch.object(DiskSpace, "free_space", return_value=100), mock.patch(
+            "osf_pigeon.pigeon.get_archive_footprint", side_effect=mock_footprint
+        ), mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive):
+            scheduler.start()
+            try:
+                assert scheduler.submit_archive("guid0").result(timeout=5) == (None, "guid0")
+            finally:
+                scheduler.stop()
+
+    @pytest.mark.parametrize("temporary", [True, False])
+    def test_job_stores_that_wont_persist_are_warned_about(self, caplog, temporary):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "pigeon-jobs.db")
+            scheduler = Scheduler()
+            with mock.patch.object(settings, "JOB_STORE_PATH", path), mock.patch(
+                "tempfile.gettempdir", return_value=temp_dir if temporary else "/elsewhere"
+            ):
+                scheduler.start()
+            scheduler.stop()
+            scheduler.store.close()
+
+        warned = [record for record in caplog.records if "temporary directory" in record.message]
+        assert bool(warned) == temporary
+
+    def test_skipped_jobs_are_not_estimated(self, store):
+        async def mock_archive(guid, session=None, limits=None, incremental=None, admission=None):
+            return None, guid  # current on IA, so never admitted
+
+        scheduler = Scheduler(store=store, disk_admission=True)
+        with mock.patch(
+            "osf_pigeon.pigeon.get_archive_footprint"
+        ) as mock_footprint, mock.patch("osf_pigeon.pigeon.archive", side_effect=mock_archive):
+            scheduler.start()
+            try:
+                assert scheduler.submit_archive("guid0").result(timeout=5) == (None, "guid0")
+            finally:
+                scheduler.stop()
+
+        mock_footprint.assert_not_called()
+
+    def test_big_jobs_stop_others_going_around_them(self):
+        with mock.patch.object(DiskSpace, "free_space", return_value=100):
+            disk = DiskSpace("/", headroom=0, poll_interval=30, max_wait=60)
+            assert disk.try_reserve(80, disk.wait())
+            big = disk.wait()
+            assert not disk.try_reserve(80, big)
+            assert disk.try_reserve(10, disk.wait())
+
+            disk.waiting[big] -= 60  # it has waited long enough
+            small = disk.wait()
+            assert not disk.try_reserve(10, small)
+            disk.release(80)
+            disk.release(10)
+            assert not disk.try_reserve(10, small)
+            assert disk.try_reserve(80, big)
+            assert disk.try_reserve(10, small)
@@ -0,0 +1,115 @@
+import os
+import tempfile
+
+import pytest
+
+from osf_pigeon.store import JobStore, ARCHIVE, METADATA, QUEUED, RUNNING, DONE, FAILED
+
+
+class TestJobStore:
+    @pytest.fixture
+    def path(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            yield os.path.join(temp_dir, "jobs.db")
+
+    @pytest.fixture
+    def store(self, path):
+        store = JobStore(path)
+        yield store
+        store.close()
+
+    def test_wal_mode(self, store):
+        assert store._connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    def test_job_states(self, store):
+        job_id, created = store.enqueue(ARCHIVE, "guid0")
+        assert created
+        assert store.get(job_id)["state"] == QUEUED
+
+        assert store.start(job_id)["state"] == RUNNING
+        store.finish(job_id)
+        assert store.get(job_id)["state"] == DONE
+
+        job_id, _ = store.enqueue(ARCHIVE, "guid0")
+        store.start(job_id)
+        store.fail(job_id, "ValueError()")
+        assert store.get(job_id)["state"] == FAILED
+        assert store.get(job_id)["error"] == "ValueError()"
+
+    def test_queued_counts(self, store):
+        assert store.queued_counts() == {ARCHIVE: 0, METADATA: 0}
+        for guid in ("guid0", "guid1"):
+            store.enqueue(ARCHIVE, guid)
+        job_id, _ = store.enqueue(METADATA, "guid0")
+        store.start(job_id)
+        assert store.queued_counts() == {ARCHIVE: 2, METADATA: 0}
+
+    def test_archives_are_deduplicated_while_pending(self, store):
+        job_id, _ = store.enqueue(ARCHIVE, "guid0")
+        assert store.enqueue(ARCHIVE, "guid0") == (job_id, False)
+        store.start(job_id)
+        assert store.enqueue(ARCHIVE, "guid0") == (job_id, False)
+        store.finish(job_id)
+        assert store.enqueue(ARCHIVE, "guid0")[1]
+
+    def test_queued_metadata_is_merged(self, store):
+        job_id, _ = store.enqueue(METADATA, "guid0", {"title": "Old", "osf_tags": ["a"]})
+        assert store.enqueue(METADATA, "guid0", {"title": "New"}) == (job_id, False)
+        assert store.get(job_id)["payload"] == {"title": "New", "osf_tags": ["a"]}
+
+        # a running sync has already read its payload, so later edits need a job of their own
+        store.start(job_id)
+        new_job_id, created = store.enqueue(METADATA, "guid0", {"title": "Newer"})
+        assert created
+        assert store.get(job_id)["payload"] == {"title": "New", "osf_tags": ["a"]}
+        assert store.get(new_job_id)["payload"] == {"title": "Newer"}
+
+    def test_unfinished_jobs_survive_a_restart(self, store, path):
+        running, _ = store.enqueue(ARCHIVE, "guid0")
+        store.start(running)
+        queued, _ = store.enqueue(METADATA, "guid1", {"title": "Test"})
+        finished, _ = store.enqueue(ARCHIVE, "guid2")
+        store.finish(finished)
+        store.close()
+
+        store = JobStore(path)
+        jobs = store.unfinished()
+        assert [(job["id"], job["guid"], job["state"]) for job in jobs] == [
+            (running, "guid0", QUEUED),
+            (queued, "guid1", QUEUED),
+        ]
+        assert jobs[1]["payload"] == {"title": "Test"}
+        assert store.get(running)["state"] == QUEUED
+        store.close()
+
+    def test_batches_hold_each_guid_once(self, store):
+        pending, _ = store.enqueue(ARCHIVE, "guid1")
+        batch_id = store.create_batch()
+        assert store.add_to_batch(batch_id, ["guid0", "guid1", "guid0"]) == 2
+        assert store.add_to_batch(batch_id, ["guid1", "guid2"]) == 1
+        store.finish_enumerating(batch_id)
+
+        job_ids = store.batch_job_ids(batch_id)
+        assert [store.get(job_id)["guid"] for job_id in job_ids] == ["guid0", "guid1", "guid2"]
+        assert pending in job_ids  # the guid already queued joined the batch with its job
+
+        store.start(job_ids[0])
+        store.finish(job_ids[0])
+        store.start(job_ids[1])
+        batch = store.get_batch(batch_id)
+        assert batch["enumerated"]
+        assert batch["total"] == 3
+        assert batch["jobs"] == {QUEUED: 1, RUNNING: 1, DONE: 1, FAILED: 0}
+
+    def test_batches_are_resumed_separately(self, store):
+        individual, _ = store.enqueue(ARCHIVE, "guid0")
+        listed = store.create_batch()
+        store.add_to_batch(listed, ["guid1"])
+        store.finish_enumerating(listed)
+        enumerating = store.create_batch(provider="osf")
+        finished = store.create_batch()
+        store.finish_enumerating(finished)
+
+        assert [job["id"] for job in store.unfinished()] == [individual]
+        assert store.unfinished_batches() == [listed, enumerating]
+        assert store.get_batch(enumerating)["provider"] == "osf"